@@ -0,0 +1,85 @@
+""" Archiving of the search history.
+
+Queries older than the retention period (except the latest query of every user and the queries
+of searches which are still repeated) are moved to "query_archive". Pending decisions of these queries
+go to "decision_archive"; liked and disliked people stay in "decision", so they are never shown again.
+Search states which have not been used during the retention period are deleted.
+
+The job works in batches, each in its own transaction. Run it from cron: python -m db.archive """
+
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, exists, insert, literal, or_, select, update
+from sqlalchemy.orm import aliased
+
+from db.database import Connect, Decision, DecisionArchive, Query, QueryArchive, SearchState
+
+RETENTION_DAYS = int(os.getenv("VKINDER_RETENTION_DAYS", 180))
+BATCH_SIZE = int(os.getenv("VKINDER_ARCHIVE_BATCH", 10000))
+
+
+def expired_queries(cutoff: datetime, limit: int):
+
+    """ Old queries which have a newer query of the same user (by datetime: a repeated search refreshes
+    the datetime of its query) and whose search has not been repeated since the cutoff.
+    NOT EXISTS is used instead of NOT IN, which matches nothing when the subquery yields NULL """
+
+    newer = aliased(Query)
+    has_newer = exists().where(and_(newer.user_id == Query.user_id,
+                                    or_(newer.datetime > Query.datetime,
+                                        and_(newer.datetime == Query.datetime, newer.id > Query.id))))
+    repeated = exists().where(and_(SearchState.query_id == Query.id, SearchState.last_run >= cutoff))
+    return (select(Query.id)
+            .where(Query.datetime < cutoff, has_newer, ~repeated)
+            .order_by(Query.id)
+            .limit(limit))
+
+
+def archive_batch(connection, query_ids, now: datetime) -> None:
+
+    """ Moving one batch of queries and their pending decisions to the archive tables """
+
+    pending = (Decision.query_id.in_(query_ids), Decision.viewed.is_(False))
+    decision_columns = ['id', 'user_id', 'vk_id', 'query_id', 'viewed', 'black_list']
+    connection.execute(insert(DecisionArchive.__table__).from_select(
+        decision_columns + ['archived_at'],
+        select(*[Decision.__table__.c[name] for name in decision_columns], literal(now)).where(*pending)))
+    connection.execute(delete(Decision.__table__).where(*pending))
+
+    # decided people keep their decisions, only the link to the query is lost
+    connection.execute(update(Decision.__table__).where(Decision.query_id.in_(query_ids)).values(query_id=None))
+
+    query_columns = ['id', 'datetime', 'sex_id', 'city_id', 'age_from', 'age_to', 'status_id', 'sort_id', 'user_id']
+    connection.execute(insert(QueryArchive.__table__).from_select(
+        query_columns + ['archived_at'],
+        select(*[Query.__table__.c[name] for name in query_columns], literal(now)).where(Query.id.in_(query_ids))))
+    connection.execute(delete(Query.__table__).where(Query.id.in_(query_ids)))
+
+
+def archive_history(retention_days: int = RETENTION_DAYS, batch_size: int = BATCH_SIZE) -> int:
+
+    """ Archives everything older than the retention period, returns the number of archived queries """
+
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=retention_days)
+
+    with Connect.engine.begin() as connection:
+        connection.execute(delete(SearchState.__table__).where(SearchState.last_run < cutoff))
+
+    archived = 0
+    while True:
+        with Connect.engine.begin() as connection:
+            query_ids = [row[0] for row in connection.execute(expired_queries(cutoff, batch_size))]
+            if not query_ids:
+                break
+            archive_batch(connection, query_ids, now)
+        archived += len(query_ids)
+    return archived
+
+
+if __name__ == '__main__':
+
+    started = datetime.now()
+    print(f'Archived queries: {archive_history()}')
+    print(datetime.now() - started)
@@ -0,0 +1,135 @@
+""" Asynchronous counterpart of db.database.Connect for dialogue coroutines.
+
+The four helpers of Connect (insert_to_db, select_from_db, update_data, delete_from_db) keep their
+signatures, but are awaited. Nothing in the bot awaits them yet: the layer is kept to these helpers
+until the dialogues become coroutines. Every call works in its own
+AsyncSession, so concurrent coroutines never share one. With PostgreSQL the engine uses the asyncpg driver,
+which keeps a cache of prepared statements on every connection of the pool; a SQLite database is opened
+with aiosqlite. The in-memory backend cannot be shared with the synchronous engine. """
+
+import os
+from typing import Any, Dict, List
+
+from sqlalchemy import delete, inspect, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from db import slow_queries
+from db.database import POOL_OPTIONS, Connect
+
+PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("VKINDER_PREPARED_CACHE", 500))
+ASYNC_POOL_SIZE = int(os.getenv("VKINDER_ASYNC_POOL_SIZE", 10))
+
+
+def _as_tuple(value) -> tuple:
+    if not isinstance(value, tuple):
+        value = (value,)
+    return tuple(item for item in value if item is not None)
+
+
+class AsyncQuery:
+
+    """Awaitable analogue of the ORM Query returned by Connect.select_from_db"""
+
+    def __init__(self, connect: 'AsyncConnect', statement, entity: bool):
+        self.connect = connect
+        self.statement = statement
+        self.entity = entity
+
+    def order_by(self, *clauses) -> 'AsyncQuery':
+        return AsyncQuery(self.connect, self.statement.order_by(*clauses), self.entity)
+
+    def limit(self, limit: int) -> 'AsyncQuery':
+        return AsyncQuery(self.connect, self.statement.limit(limit), self.entity)
+
+    async def _execute(self):
+        async with self.connect.Session() as session:
+            result = await session.execute(self.statement)
+            return result.scalars() if self.entity else result
+
+    async def all(self) -> List[Any]:
+        return (await self._execute()).all()
+
+    async def first(self) -> Any:
+        return (await self.limit(1)._execute()).first()
+
+    async def scalar(self) -> Any:
+        async with self.connect.Session() as session:
+            return await session.scalar(self.statement)
+
+
+class AsyncConnect:
+
+    engine = None
+    Session = None
+
+    @classmethod
+    def connect(cls, **engine_options) -> None:
+
+        """ Creating the engine on first use: the URL of the synchronous engine with an asynchronous driver """
+
+        url = Connect.engine.url
+        if url.get_backend_name() == 'sqlite':
+            url = url.set(drivername='sqlite+aiosqlite')
+            engine_options = {k: v for k, v in engine_options.items() if k not in POOL_OPTIONS}
+        else:
+            url = url.set(drivername='postgresql+asyncpg')
+            engine_options.setdefault('pool_size', ASYNC_POOL_SIZE)
+            engine_options.setdefault('connect_args',
+                                      {'prepared_statement_cache_size': PREPARED_STATEMENT_CACHE_SIZE})
+        cls.engine = create_async_engine(url, **engine_options)
+        slow_queries.instrument(cls.engine.sync_engine)
+        cls.Session = sessionmaker(bind=cls.engine, class_=AsyncSession, expire_on_commit=False)
+
+    def __init__(self):
+        if AsyncConnect.engine is None:
+            AsyncConnect.connect()
+
+    async def insert_to_db(self, model, fields: Dict[str, Any]):
+
+        """ General method for writing new data to the database """
+
+        entity = model(**fields)
+        async with self.Session() as session:
+            session.add(entity)
+            await session.commit()
+        return entity
+
+    def select_from_db(self, model_fields, expression=None, join=None) -> AsyncQuery:
+
+        """ Method for checking the presence of records in the database, the result is awaited:
+        await self.select_from_db(User.id, User.id == user_id).first() """
+
+        model_fields = _as_tuple(model_fields)
+        statement = select(*model_fields)
+        if join:
+            statement = statement.join(*_as_tuple(join))
+        statement = statement.where(*_as_tuple(expression))
+        entity = len(model_fields) == 1 and hasattr(model_fields[0], '__table__')
+        return AsyncQuery(self, statement, entity)
+
+    async def update_data(self, model_fields, expression, fields: Dict[Any, Any]) -> None:
+        model = getattr(_as_tuple(model_fields)[0], 'class_', _as_tuple(model_fields)[0])
+        statement = update(model).where(*_as_tuple(expression)).values(fields)
+        async with self.Session() as session:
+            await session.execute(statement.execution_options(synchronize_session=False))
+            await session.commit()
+
+    async def delete_from_db(self, model_fields, expression=None, join=None) -> None:
+
+        """ General method for deleting data from DB.
+        A DELETE statement cannot join, so with a join the rows are matched by their primary key
+        in the joined select: DELETE ... WHERE id IN (SELECT id ... JOIN ...) """
+
+        model = getattr(_as_tuple(model_fields)[0], 'class_', _as_tuple(model_fields)[0])
+        if join:
+            primary_key = inspect(model).primary_key
+            if len(primary_key) != 1:
+                raise NotImplementedError(f'Delete with a join needs a single-column primary key of {model}')
+            matched = select(primary_key[0]).join(*_as_tuple(join)).where(*_as_tuple(expression))
+            statement = delete(model).where(primary_key[0].in_(matched))
+        else:
+            statement = delete(model).where(*_as_tuple(expression))
+        async with self.Session() as session:
+            await session.execute(statement.execution_options(synchronize_session=False))
+            await session.commit()
@@ -0,0 +1,253 @@
+""" Fuzzy search of cities by trigrams.
+
+Titles are split into trigrams of letters and the cities sharing most of them with the user's
+answer are suggested, so a typo, a missing hyphen or a Cyrillic letter in a Latin title
+(and the other way round) still finds the city. Similarity is the same as pg_trgm: shared trigrams
+divided by all distinct trigrams of both strings.
+
+Building the index takes a while on the full list of cities, so it is never built on the way of
+a user's answer. It is compiled next to the geo index, after it:
+
+    python -m db.geo_index
+    python -m db.city_search
+
+and the file is opened with mmap like the geo index. Without the file the index is built in memory
+at startup by prepare_city_search(), before the worker processes are forked, from the geo index
+or from the City table.
+
+Layout of the file (the arrays are little-endian):
+    header   - magic, version, number of cities and size of the geo index it belongs to, section offsets
+    sizes    - number of distinct trigrams of every city (uint16), by its number in the geo index
+    grams    - (trigram in UTF-8 padded with zeros, first posting, count) sorted by the trigram
+    postings - numbers of the cities having the trigram (uint32) """
+
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from db.database import City, Connect
+from db.geo_index import FIX_DIR, INDEX_PATH, GeoCity, GeoIndex, geo_index, normalize
+
+logger = logging.getLogger(__name__)
+
+SIMILARITY = float(os.getenv("VKINDER_CITY_SIMILARITY", 0.25))
+SUGGESTIONS = 6
+
+TRIGRAMS_PATH = os.getenv("VKINDER_CITY_TRIGRAMS", os.path.join(FIX_DIR, 'trigrams.idx'))
+MAGIC = b'VKTRGIDX'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQQ')
+GRAM = struct.Struct('<12sII')
+
+# Latin letters which look like Cyrillic ones; both the titles and the answers are folded the same way
+HOMOGLYPHS = str.maketrans('aceopxykmtbh', 'асеорхукмтвн')
+
+
+def fold(title: str) -> str:
+    title = normalize(title).translate(HOMOGLYPHS)
+    return re.sub(r'[^\w]+', ' ', title).strip()
+
+
+def trigrams(title: str) -> set:
+
+    """ Trigrams of every word, padded like pg_trgm: two spaces in front and one after """
+
+    grams = set()
+    for word in fold(title).split():
+        word = f'  {word} '
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def _little_endian(values: array) -> array:
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def _read_array(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    return _little_endian(values)
+
+
+class TrigramIndex:
+
+    """Index built in memory from a list of cities"""
+
+    def __init__(self, cities: Iterable[GeoCity]):
+        self.cities: List[GeoCity] = []
+        self.sizes = array('H')
+        postings: Dict[str, array] = {}
+        for number, city in enumerate(cities):
+            grams = trigrams(city.title)
+            self.cities.append(city)
+            self.sizes.append(min(len(grams), 0xFFFF))
+            for gram in grams:
+                postings.setdefault(gram, array('I')).append(number)
+        self.postings = postings
+
+    def _postings(self, gram: str) -> Sequence[int]:
+        return self.postings.get(gram, ())
+
+    def _city(self, number: int) -> GeoCity:
+        return self.cities[number]
+
+    def search(self, text: str, limit: int = SUGGESTIONS, similarity: float = SIMILARITY) -> List[GeoCity]:
+
+        """ The most similar cities, the important ones first among equally similar """
+
+        grams = trigrams(text)
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings(gram))
+
+        ranked = []
+        for number, count in shared.items():
+            score = count / (len(grams) + self.sizes[number] - count)
+            if score >= similarity:
+                ranked.append((score, number))
+        # the cities are read only for the candidates, which matters for the file
+        ranked = [(score, self._city(number).important or 0, -number) for score, number in ranked]
+        ranked.sort(reverse=True)
+        return [self._city(-number) for _, _, number in ranked[:limit]]
+
+    def save(self, path: str, geo_size: int) -> None:
+
+        """ Writing the index of the cities of the geo index (of geo_size bytes) to a file """
+
+        grams = sorted((gram.encode('utf-8'), numbers) for gram, numbers in self.postings.items())
+        gram_records = bytearray()
+        postings = array('I')
+        for gram, numbers in grams:
+            gram_records += GRAM.pack(gram, len(postings), len(numbers))
+            postings.extend(numbers)
+
+        sections = (_little_endian(array('H', self.sizes)).tobytes(), bytes(gram_records),
+                    _little_endian(postings).tobytes())
+        offsets = []
+        position = HEADER.size
+        for section in sections:
+            offsets.append(position)
+            position += len(section)
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.cities), geo_size, len(grams), *offsets[1:]))
+            for section in sections:
+                f.write(section)
+        os.replace(tmp_path, path)
+
+
+class TrigramFile(TrigramIndex):
+
+    """Read-only view of the index file; the cities are read from the geo index by their numbers"""
+
+    def __init__(self, path: str, geo: GeoIndex):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, cities_count, geo_size, self.grams_count, self.grams_at, self.postings_at = \
+            HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a trigram index of version {VERSION}, rebuild it')
+        if cities_count != geo.cities_count or geo_size != geo.buffer.size():
+            raise ValueError(f'{path} is built for another geo index, rebuild it')
+        self.geo = geo
+        self.sizes = _read_array('H', self.buffer[HEADER.size:self.grams_at])
+
+    @classmethod
+    def load(cls, path: str = TRIGRAMS_PATH) -> Optional['TrigramFile']:
+
+        """ The index, or None if it has not been built or does not match the geo index """
+
+        geo = geo_index()
+        if geo is None or not os.path.exists(path):
+            return None
+        try:
+            return cls(path, geo)
+        except ValueError as error:
+            logger.warning('%s', error)
+            return None
+
+    def _postings(self, gram: str) -> Sequence[int]:
+        key = gram.encode('utf-8').ljust(GRAM.size - 8, b'\0')
+        low, high = 0, self.grams_count
+        while low < high:
+            middle = (low + high) // 2
+            found, start, count = GRAM.unpack_from(self.buffer, self.grams_at + middle * GRAM.size)
+            if found == key:
+                at = self.postings_at + start * 4
+                return _read_array('I', self.buffer[at:at + count * 4])
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return ()
+
+    def _city(self, number: int) -> GeoCity:
+        return self.geo.city_at(number)
+
+
+def _all_cities() -> Iterable[GeoCity]:
+    index = geo_index()
+    if index:
+        return index.cities()
+    # only the columns of GeoCity, without building an ORM object for every city
+    rows = Connect().session.query(City.id, City.title, City.area, City.region, City.region_id, City.important)
+    return [GeoCity(city_id, title, area, region, region_id, None, important)
+            for city_id, title, area, region, region_id, important in rows]
+
+
+_index = None
+
+
+def city_search() -> Optional[TrigramIndex]:
+
+    """ The trigram index of the process: the file, or the index built by prepare_city_search();
+    None if there is neither, then the bot makes no suggestions """
+
+    global _index
+    if _index is None:
+        _index = TrigramFile.load()
+    return _index
+
+
+def prepare_city_search() -> None:
+
+    """ Building the index in memory at startup if its file has not been built.
+    Called before the worker processes are forked, so they share the built index """
+
+    global _index
+    if city_search() is None:
+        started = time.perf_counter()
+        _index = TrigramIndex(_all_cities())
+        logger.info('No %s, the trigram index of %s cities is built in memory in %.2f s',
+                    TRIGRAMS_PATH, len(_index.cities), time.perf_counter() - started)
+
+
+def build(path: str = TRIGRAMS_PATH) -> None:
+
+    """ Compiling the index of the cities of the geo index """
+
+    geo = GeoIndex.load()
+    if geo is None:
+        raise SystemExit(f'{INDEX_PATH} is not built: python -m db.geo_index')
+    TrigramIndex(geo.cities()).save(path, geo.buffer.size())
+
+
+if __name__ == '__main__':
+
+    now = datetime.now()
+    build()
+    print(f'Trigram index is written to {TRIGRAMS_PATH}')
+    print(datetime.now() - now)
@@ -0,0 +1,247 @@
+""" Compact read-only index of cities, regions and countries compiled from the fixtures in db/fix.
+
+The file is opened with mmap, so all bot processes share one copy of it in the page cache
+and city lookups never touch the database. Build it after updating the fixtures:
+
+    python -m db.geo_index
+
+Layout (little-endian):
+    header      - magic, version, record counts and section offsets
+    cities      - fixed-width city records sorted by normalized title
+    city ids    - (id, record number) pairs sorted by id
+    regions     - (id, country id, title) sorted by id
+    countries   - (id, title) sorted by id
+    string pool - UTF-8 strings referenced by (offset, length) """
+
+import json
+import mmap
+import os
+import re
+import struct
+from datetime import datetime
+from typing import Iterator, List, NamedTuple, Optional
+
+FIX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fix')
+INDEX_PATH = os.getenv("VKINDER_GEO_INDEX", os.path.join(FIX_DIR, 'geo.idx'))
+
+MAGIC = b'VKGEOIDX'
+VERSION = 1
+
+HEADER = struct.Struct('<8sIIII5Q')
+# key, title, area, region title (offset, length each), id, region id, country id, important
+CITY = struct.Struct('<IHIHIHIHIIIB')
+CITY_ID = struct.Struct('<II')
+REGION = struct.Struct('<IIIH')
+COUNTRY = struct.Struct('<IIH')
+
+
+def normalize(title: str) -> str:
+
+    """ Search key of a toponym: lower case, "е" instead of "ё", one kind of dash, single spaces """
+
+    title = title.strip().lower().replace('ё', 'е')
+    title = re.sub(r'\s*[‐‑‒–—-]\s*', '-', title)
+    return re.sub(r'\s+', ' ', title)
+
+
+class GeoCity(NamedTuple):
+    id: int
+    title: str
+    area: str
+    region: str
+    region_id: int
+    country_id: int
+    important: int
+
+
+class StringPool:
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = {}
+
+    def add(self, value: Optional[str]):
+        if not value:
+            return 0, 0
+        encoded = value.encode('utf-8')
+        if encoded not in self.offsets:
+            self.offsets[encoded] = len(self.data)
+            self.data += encoded
+        return self.offsets[encoded], len(encoded)
+
+
+def _load_fixture(name: str) -> List[dict]:
+    with open(os.path.join(FIX_DIR, name), encoding='utf-8') as f:
+        return [item['fields'] for item in json.load(f)]
+
+
+def build(path: str = INDEX_PATH) -> None:
+
+    """ Compiling the fixtures into the index file """
+
+    countries = sorted(_load_fixture('countries.json'), key=lambda c: c['id'])
+    regions = sorted(_load_fixture('regions.json'), key=lambda r: r['id'])
+    region_countries = {region['id']: region.get('country_id', 0) for region in regions}
+    region_titles = {region['id']: region['title'] for region in regions}
+
+    pool = StringPool()
+    cities = []
+    for city in _load_fixture('cities.json'):
+        key = normalize(city['title']).encode('utf-8')
+        cities.append((key, city))
+    cities.sort(key=lambda item: (item[0], item[1]['id']))
+
+    city_records = bytearray()
+    city_ids = []
+    for number, (key, city) in enumerate(cities):
+        region_id = city.get('region_id') or 0
+        city_records += CITY.pack(*pool.add(key.decode('utf-8')), *pool.add(city['title']),
+                                  *pool.add(city.get('area')),
+                                  *pool.add(city.get('region') or region_titles.get(region_id)),
+                                  city['id'], region_id, region_countries.get(region_id, 0),
+                                  city.get('important') or 0)
+        city_ids.append((city['id'], number))
+    city_ids.sort()
+
+    id_records = b''.join(CITY_ID.pack(*pair) for pair in city_ids)
+    region_records = b''.join(REGION.pack(region['id'], region.get('country_id', 0), *pool.add(region['title']))
+                              for region in regions)
+    country_records = b''.join(COUNTRY.pack(country['id'], *pool.add(country['title'])) for country in countries)
+
+    offsets = []
+    position = HEADER.size
+    for section in (city_records, id_records, region_records, country_records, pool.data):
+        offsets.append(position)
+        position += len(section)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(cities), len(regions), len(countries), *offsets))
+        for section in (city_records, id_records, region_records, country_records, pool.data):
+            f.write(section)
+    os.replace(tmp_path, path)
+
+
+class GeoIndex:
+
+    """Read-only view of the index file"""
+
+    def __init__(self, path: str = INDEX_PATH):
+        with open(path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.cities_count, self.regions_count, self.countries_count, *offsets = \
+            HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a geo index of version {VERSION}, rebuild it')
+        self.cities_at, self.ids_at, self.regions_at, self.countries_at, self.pool_at = offsets
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> Optional['GeoIndex']:
+
+        """ The index, or None if it has not been built """
+
+        if not os.path.exists(path):
+            return None
+        return cls(path)
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self.pool_at + offset
+        return self.buffer[start:start + length].decode('utf-8')
+
+    def _key(self, number: int) -> bytes:
+        offset, length = CITY.unpack_from(self.buffer, self.cities_at + number * CITY.size)[:2]
+        start = self.pool_at + offset
+        return self.buffer[start:start + length]
+
+    def _city(self, number: int) -> GeoCity:
+        values = CITY.unpack_from(self.buffer, self.cities_at + number * CITY.size)
+        return GeoCity(values[8], self._string(*values[2:4]), self._string(*values[4:6]),
+                       self._string(*values[6:8]), values[9], values[10], values[11])
+
+    def _bisect(self, key: bytes) -> int:
+        low, high = 0, self.cities_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def iter_prefix(self, prefix: str) -> Iterator[GeoCity]:
+        key = normalize(prefix).encode('utf-8')
+        number = self._bisect(key)
+        while number < self.cities_count and self._key(number).startswith(key):
+            yield self._city(number)
+            number += 1
+
+    def find(self, prefix: str) -> List[GeoCity]:
+
+        """ Cities whose title starts with the text, ordered by region like the database search """
+
+        return sorted(self.iter_prefix(prefix), key=lambda city: (city.region, city.id))
+
+    def city_at(self, number: int) -> GeoCity:
+
+        """ The city by its position in the index, the order of cities() """
+
+        return self._city(number)
+
+    def cities(self) -> Iterator[GeoCity]:
+        for number in range(self.cities_count):
+            yield self._city(number)
+
+    def city(self, city_id: int) -> Optional[GeoCity]:
+        low, high = 0, self.cities_count
+        while low < high:
+            middle = (low + high) // 2
+            found_id, number = CITY_ID.unpack_from(self.buffer, self.ids_at + middle * CITY_ID.size)
+            if found_id == city_id:
+                return self._city(number)
+            if found_id < city_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _find_by_id(self, at: int, count: int, record: struct.Struct, item_id: int) -> Optional[tuple]:
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            values = record.unpack_from(self.buffer, at + middle * record.size)
+            if values[0] == item_id:
+                return values
+            if values[0] < item_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def region_title(self, region_id: int) -> Optional[str]:
+        values = self._find_by_id(self.regions_at, self.regions_count, REGION, region_id)
+        return self._string(*values[2:]) if values else None
+
+    def country_title(self, country_id: int) -> Optional[str]:
+        values = self._find_by_id(self.countries_at, self.countries_count, COUNTRY, country_id)
+        return self._string(*values[1:]) if values else None
+
+
+_index = None
+
+
+def geo_index() -> Optional[GeoIndex]:
+
+    """ The index of the process, opened on first use """
+
+    global _index
+    if _index is None:
+        _index = GeoIndex.load() or False
+    return _index or None
+
+
+if __name__ == '__main__':
+
+    now = datetime.now()
+    build()
+    print(f'Geo index is written to {INDEX_PATH}')
+    print(datetime.now() - now)
@@ -0,0 +1,88 @@
+""" Migration of found people from the old "datinguser" table,
+where the profile was repeated for every query, to the "candidate" profiles and per-user "decision" rows,
+and the columns added to the existing tables since then.
+
+Run once after updating: python -m db.migrations """
+
+from datetime import datetime
+
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, MetaData, String, Table, func, insert, inspect, select, \
+    text
+
+from db.database import Candidate, Connect, Decision, Query, User, base
+
+legacy = MetaData()
+
+datinguser = Table(
+    'datinguser', legacy,
+    Column('id', Integer, primary_key=True),
+    Column('vk_id', Integer),
+    Column('first_name', String),
+    Column('last_name', String),
+    Column('city_id', Integer),
+    Column('city_title', String),
+    Column('link', String),
+    Column('verified', Integer),
+    Column('query_id', Integer, ForeignKey(Query.id)),
+    Column('viewed', Boolean),
+    Column('black_list', Boolean),
+)
+
+
+def migrate_datingusers(connection) -> None:
+
+    """ Copying profiles and decisions out of "datinguser" and dropping it.
+    For every VK id the latest profile wins; for every (user, VK id) pair the latest viewed row wins """
+
+    # profiles: one row per VK id
+    latest = select(func.max(datinguser.c.id)).group_by(datinguser.c.vk_id)
+    profiles = select(datinguser.c.vk_id, datinguser.c.first_name, datinguser.c.last_name, datinguser.c.city_id,
+                      datinguser.c.city_title, datinguser.c.link, datinguser.c.verified
+                      ).where(datinguser.c.id.in_(latest))
+    connection.execute(insert(Candidate.__table__).from_select(
+        ['vk_id', 'first_name', 'last_name', 'city_id', 'city_title', 'link', 'verified'], profiles))
+
+    # decisions: one row per user and VK id, a decided row is preferred over a pending one
+    ranked = select(
+        Query.user_id, datinguser.c.vk_id, datinguser.c.query_id, datinguser.c.viewed, datinguser.c.black_list,
+        func.row_number().over(partition_by=(Query.user_id, datinguser.c.vk_id),
+                               order_by=(datinguser.c.viewed.desc(), datinguser.c.id.desc())).label('position')
+    ).join(Query.__table__, Query.id == datinguser.c.query_id).subquery()
+    decisions = select(ranked.c.user_id, ranked.c.vk_id, ranked.c.query_id,
+                       func.coalesce(ranked.c.viewed, False), ranked.c.black_list
+                       ).where(ranked.c.position == 1)
+    connection.execute(insert(Decision.__table__).from_select(
+        ['user_id', 'vk_id', 'query_id', 'viewed', 'black_list'], decisions))
+
+    datinguser.drop(connection)
+
+
+# columns which create_all() does not add to a table created by an older version
+ADDED_COLUMNS = (User.__table__.c.last_seen,)
+
+
+def add_columns(connection) -> None:
+    preparer = connection.dialect.identifier_preparer
+    for column in ADDED_COLUMNS:
+        existing = {info['name'] for info in inspect(connection).get_columns(column.table.name)}
+        if column.name not in existing:
+            connection.execute(text(f'ALTER TABLE {preparer.format_table(column.table)} '
+                                    f'ADD COLUMN {preparer.format_column(column)} '
+                                    f'{column.type.compile(connection.dialect)}'))
+            print(f'Column "{column.table.name}.{column.name}" is added')
+
+
+def migrate() -> None:
+    base.metadata.create_all(Connect.engine)
+    with Connect.engine.begin() as connection:
+        if inspect(connection).has_table(datinguser.name):
+            migrate_datingusers(connection)
+            print('Found people are moved to "candidate" and "decision"')
+        add_columns(connection)
+
+
+if __name__ == '__main__':
+
+    now = datetime.now()
+    migrate()
+    print(datetime.now() - now)
@@ -0,0 +1,96 @@
+""" Registry of the static reference tables (sex, marital status, sort order).
+
+The tables are read once at startup and kept in memory; the registry is invalidated
+whenever an INSERT, UPDATE or DELETE statement of this process touches one of these tables.
+Changes made by other processes (workers, the scheduler, a manual fix of the tables) are noticed
+by re-reading the tables every VKINDER_REFERENCE_TTL seconds. """
+
+import os
+import time
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from db.database import Connect, Sex, Status, Sort
+
+TTL = float(os.getenv("VKINDER_REFERENCE_TTL", 5 * 60))
+
+
+class ReferenceDataMissing(LookupError):
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.table = model.__tablename__
+
+    def __str__(self):
+        return (f'Reference table "{self.table}" is empty, fill the database first: '
+                f'python -m db.database')
+
+
+class ReferenceData:
+
+    MODELS = (Sex, Status, Sort)
+
+    def __init__(self, ttl: float = TTL):
+        self.ttl = ttl
+        self._titles: Dict[type, Tuple[str, ...]] = {}
+        self._loaded_at = time.monotonic()
+        self._listeners: List[Callable[[], None]] = []
+
+    def load(self) -> None:
+
+        """ Reading all reference tables at once """
+
+        for model in self.MODELS:
+            self.titles(model)
+
+    def titles(self, model) -> Tuple[str, ...]:
+
+        """ Titles of the table ordered by id, so the position of a title is its id """
+
+        if model not in self._titles:
+            titles = self._read(model)
+            if not titles:
+                raise ReferenceDataMissing(model)
+            self._titles[model] = titles
+        return self._titles[model]
+
+    @staticmethod
+    def _read(model) -> Tuple[str, ...]:
+        # a session of its own: the registry is read by the dialogues and by the scheduler thread
+        session = Connect.Session()
+        try:
+            return tuple(row[0] for row in session.query(model.title).order_by(model.id).all())
+        finally:
+            session.close()
+
+    def check(self) -> None:
+
+        """ Re-reading the loaded tables once the TTL has passed; the registry is invalidated if they differ """
+
+        now = time.monotonic()
+        if now - self._loaded_at < self.ttl:
+            return
+        self._loaded_at = now
+        if any(self._read(model) != titles for model, titles in list(self._titles.items())):
+            self.invalidate()
+
+    def on_invalidate(self, callback: Callable[[], None]) -> None:
+        self._listeners.append(callback)
+
+    def invalidate(self) -> None:
+        self._titles.clear()
+        self._loaded_at = time.monotonic()
+        for callback in self._listeners:
+            callback()
+
+
+reference = ReferenceData()
+_reference_tables = {model.__table__ for model in ReferenceData.MODELS}
+
+
+@event.listens_for(Engine, 'after_execute')
+def _invalidate_on_change(conn, clauseelement, multiparams, params, execution_options, result) -> None:
+    if getattr(clauseelement, 'is_dml', False) and getattr(clauseelement, 'table', None) in _reference_tables:
+        reference.invalidate()
@@ -0,0 +1,221 @@
+""" Timings of SQL statements by the place of the code which runs them.
+
+The helpers of Connect accept any ORM expression, so a slow statement is hard to trace back to the
+dialogue step it comes from. With VKINDER_SQL_PROFILE=1 every statement of the engine is timed and
+counted per call site (the first frame outside SQLAlchemy and the helpers of db.database) and statement;
+the lists of values of IN and of a multi-row INSERT are collapsed, so a statement is counted once whatever
+the number of its values. At most VKINDER_SQL_MAX_STATEMENTS statements are kept apart, the rest are counted
+together as "<other statements>".
+A statement slower than VKINDER_SLOW_QUERY_MS gets its plan captured on the same connection. On PostgreSQL
+a SELECT is run again with EXPLAIN (ANALYZE, BUFFERS) for the real row counts, timings and buffer hits,
+INSERT, UPDATE and DELETE only get EXPLAIN, which does not run them; both are run in a savepoint,
+so a failing EXPLAIN does not abort the transaction of the caller. SQLite gets EXPLAIN QUERY PLAN.
+Every VKINDER_SQL_REPORT_INTERVAL seconds the VKINDER_SQL_REPORT_TOP call sites with the largest total
+time are written to the log with their slowest plan. """
+
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("VKINDER_SQL_PROFILE") == '1'
+SLOW_QUERY_MS = float(os.getenv("VKINDER_SLOW_QUERY_MS", 100))
+REPORT_INTERVAL = int(os.getenv("VKINDER_SQL_REPORT_INTERVAL", 10 * 60))
+REPORT_TOP = int(os.getenv("VKINDER_SQL_REPORT_TOP", 10))
+MAX_STATEMENTS = int(os.getenv("VKINDER_SQL_MAX_STATEMENTS", 1000))
+OTHER = ('<other statements>', '')
+
+EXPLAIN = {
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+# read-only statements, which may be run once more to be analyzed
+EXPLAIN_ANALYZE = {
+    'postgresql': 'EXPLAIN (ANALYZE, BUFFERS) ',
+}
+SAVEPOINT = 'vkinder_explain'
+# statements which have a plan; DDL and PRAGMA are timed only
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+# a parameter of the DB-API driver: ?, :name, %s, %(name)s or $1
+_PARAMETER = r'(?:\?|:\w+|%s|%\(\w+\)s|\$\d+)'
+_IN_LIST = re.compile(rf'\bIN \(\s*{_PARAMETER}(?:\s*,\s*{_PARAMETER})*\s*\)', re.IGNORECASE)
+_ROW = r'\((?:[^()]|\([^()]*\))*\)'
+_VALUES_LIST = re.compile(rf'(\bVALUES\s*{_ROW})(?:\s*,\s*{_ROW})+', re.IGNORECASE)
+
+# frames of these files are not call sites; frames of the helpers are named in the call site
+_SKIPPED = (os.path.dirname(sqlalchemy.__file__), os.path.abspath(__file__))
+_DB_DIR = os.path.dirname(os.path.abspath(__file__))
+_HELPERS = (os.path.join(_DB_DIR, 'database.py'), os.path.join(_DB_DIR, 'async_database.py'))
+_ROOT = os.path.dirname(_DB_DIR)
+
+
+def call_site() -> str:
+
+    """ "main_bot/vk_bot.py:412 get_city via update_data" for the statement being run """
+
+    helper = None
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_HELPERS):
+            helper = frame.f_code.co_name
+        elif not filename.startswith(_SKIPPED):
+            site = f'{os.path.relpath(filename, _ROOT)}:{frame.f_lineno} {frame.f_code.co_name}'
+            return f'{site} via {helper}' if helper else site
+        frame = frame.f_back
+    # the statements of the asynchronous engine run in a greenlet without the frames of the caller
+    return f'<unknown> via {helper}' if helper else '<unknown>'
+
+
+def normalize(statement: str) -> str:
+
+    """ The statement without its formatting and with one entry of IN and VALUES lists """
+
+    statement = ' '.join(statement.split())
+    statement = _IN_LIST.sub('IN (...)', statement)
+    return _VALUES_LIST.sub(r'\1, ...', statement)
+
+
+class StatementStats:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.slow = 0
+        self.plan: Optional[str] = None
+        self.plan_duration = 0.0
+
+    def add(self, duration: float, slow: bool) -> None:
+        self.count += 1
+        self.total += duration
+        self.slowest = max(self.slowest, duration)
+        self.slow += slow
+
+
+class SqlProfile:
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_MS):
+        self.threshold = threshold_ms / 1000
+        self.stats: Dict[Tuple[str, str], StatementStats] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def instrument(self, engine) -> None:
+
+        """ Timing the statements of the engine (of AsyncEngine.sync_engine for the asynchronous one) """
+
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    @staticmethod
+    def _before(conn, cursor, statement, parameters, context, executemany) -> None:
+        context.vkinder_started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        started = getattr(context, 'vkinder_started', None)
+        if started is None:
+            return
+        duration = time.perf_counter() - started
+        slow = duration >= self.threshold
+
+        key = (call_site(), normalize(statement))
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                if len(self.stats) >= MAX_STATEMENTS:
+                    key = OTHER
+                stats = self.stats.setdefault(key, StatementStats())
+            stats.add(duration, slow)
+            # the plan is kept for the slowest run only
+            explain = slow and not executemany and key != OTHER and duration > stats.plan_duration
+            if explain:
+                stats.plan_duration = duration
+
+        if explain:
+            plan = self.explain(conn, statement, parameters)
+            if plan is not None:
+                with self.lock:
+                    stats.plan = plan
+
+    @staticmethod
+    def explain(conn, statement: str, parameters) -> Optional[str]:
+
+        """ Plan of the statement, run with a separate cursor of the same connection and transaction """
+
+        dialect = conn.dialect.name
+        prefix = EXPLAIN.get(dialect)
+        command = statement.lstrip().upper()
+        if prefix is None or not command.startswith(EXPLAINABLE):
+            return None
+        # WITH may wrap an INSERT, UPDATE or DELETE, so only a plain SELECT is analyzed
+        if command.startswith('SELECT'):
+            prefix = EXPLAIN_ANALYZE.get(dialect, prefix)
+
+        cursor = conn.connection.cursor()
+        savepoint = False
+        try:
+            if dialect == 'postgresql':
+                cursor.execute(f'SAVEPOINT {SAVEPOINT}')
+                savepoint = True
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception as error:
+            logger.warning('No plan for %s: %s', statement, error)
+            if savepoint:
+                cursor.execute(f'ROLLBACK TO SAVEPOINT {SAVEPOINT}')
+            return None
+        finally:
+            if savepoint:
+                cursor.execute(f'RELEASE SAVEPOINT {SAVEPOINT}')
+            cursor.close()
+        return '\n'.join(' '.join(str(value) for value in row) for row in rows)
+
+    def top(self, count: int = REPORT_TOP) -> List[Tuple[Tuple[str, str], StatementStats]]:
+        with self.lock:
+            return sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)[:count]
+
+    def report(self, count: int = REPORT_TOP) -> str:
+        lines = [f'SQL statements by total time, slow from {self.threshold * 1000:g} ms:']
+        for (site, statement), stats in self.top(count):
+            lines.append(f'{stats.total * 1000:10.1f} ms  {stats.count:6} calls  '
+                         f'mean {stats.total / stats.count * 1000:.1f} ms  max {stats.slowest * 1000:.1f} ms  '
+                         f'slow {stats.slow}  {site}')
+            if statement:
+                lines.append(f'    {statement}')
+            if stats.plan:
+                lines.extend(f'        {line}' for line in stats.plan.splitlines())
+        return '\n'.join(lines)
+
+    def _loop(self) -> None:
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            if self.stats:
+                logger.info(self.report())
+
+    def start(self) -> None:
+        # a forked worker process has no threads of its parent
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._loop, name='vkinder-sql-report', daemon=True)
+            self.thread.start()
+
+
+profile = SqlProfile()
+
+
+def instrument(engine) -> None:
+
+    """ Profiling the engine and starting the periodic report, if the profile is enabled """
+
+    if ENABLED:
+        profile.instrument(engine)
+        profile.start()
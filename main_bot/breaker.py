@@ -0,0 +1,149 @@
+""" Protection of the bot from VK API brownouts.
+
+Every call gets a timeout of its method instead of waiting for the answer forever.
+Failures of a method (timeouts, connection and server errors) are counted by its circuit breaker,
+one per token bucket and method, so a token in trouble does not stop the calls of the other tokens:
+after VKINDER_BREAKER_FAILURES failures in a row the breaker opens and the calls of the method fail
+at once with CircuitOpen for VKINDER_BREAKER_COOLDOWN seconds; then one trial call is let through,
+and its success closes the breaker again. Other errors (a wrong request, a private profile) say nothing
+about the health of VK and do not change the count. The callers fall back to cached data meanwhile. """
+
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+import requests
+from vk_api.exceptions import ApiError, ApiHttpError, VkApiError
+
+DEFAULT_TIMEOUT = float(os.getenv("VKINDER_VK_TIMEOUT", 10))
+
+# seconds to wait for the answer of a method
+METHOD_TIMEOUTS = {
+    'messages.send': 5,
+    'users.get': 5,
+    'photos.get': 5,
+    'database.getCities': 5,
+    'database.getRegions': 5,
+    'users.search': 10,
+    'execute': 15,
+}
+
+FAILURES = int(os.getenv("VKINDER_BREAKER_FAILURES", 5))
+COOLDOWN = float(os.getenv("VKINDER_BREAKER_COOLDOWN", 30))
+
+# API errors meaning that VK itself is in trouble, not that the request is wrong
+SERVER_ERRORS = {1, 6, 10}
+
+
+class CircuitOpen(VkApiError):
+
+    def __init__(self, method: str, retry_in: float, bucket: str = None):
+        super().__init__(method, retry_in, bucket)
+        self.method = method
+        self.retry_in = retry_in
+        self.bucket = bucket
+
+    def __str__(self):
+        return f'VK method {self.method} ({self.bucket}) is failing, calls are paused for {self.retry_in:.0f} s'
+
+
+# everything a VK call may fail with when VK is unavailable
+VK_FAILURES = (VkApiError, requests.RequestException)
+
+
+def is_brownout(error: Exception) -> bool:
+    if isinstance(error, requests.RequestException):
+        return True
+    if isinstance(error, ApiHttpError):
+        return True
+    return isinstance(error, ApiError) and error.code in SERVER_ERRORS
+
+
+class TimeoutSession(requests.Session):
+
+    """HTTP session of vk_api which puts the timeout of the current call of the thread into every request"""
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault('timeout', getattr(self.local, 'timeout', None) or DEFAULT_TIMEOUT)
+        return super().request(*args, **kwargs)
+
+
+class CircuitBreaker:
+
+    def __init__(self, method: str, bucket: str = None, failures: int = FAILURES, cooldown: float = COOLDOWN):
+        self.method = method
+        self.bucket = bucket
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def before_call(self) -> None:
+
+        """ Raises CircuitOpen unless the call may go to VK """
+
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return
+            retry_in = max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+            raise CircuitOpen(self.method, retry_in, self.bucket)
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    def neutral(self) -> None:
+
+        """ The call failed for a reason of its own; a trial call does not decide anything then """
+
+        with self._lock:
+            self.trial = False
+
+
+class Breakers:
+
+    """Circuit breakers of all token buckets and methods of the process"""
+
+    def __init__(self):
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket: str, method: str) -> CircuitBreaker:
+        with self._lock:
+            if (bucket, method) not in self._breakers:
+                self._breakers[(bucket, method)] = CircuitBreaker(method, bucket)
+            return self._breakers[(bucket, method)]
+
+    def stats(self) -> Dict[str, str]:
+        return {f'{bucket}:{method}': breaker.state for (bucket, method), breaker in list(self._breakers.items())}
+
+
+breakers = Breakers()
@@ -0,0 +1,35 @@
+""" In-memory caches of the bot shared between the dialogues (and between worker processes) """
+
+import time
+from typing import Any, MutableMapping, Optional
+
+
+class PhotoCache:
+
+    """Cache of the top photos of the found people, keyed by VK id.
+    The storage is a plain dict by default; in the multi-process mode it is replaced
+    with a multiprocessing.Manager dict, so that every worker sees the photos fetched by others"""
+
+    TTL = 24 * 60 * 60
+
+    def __init__(self, storage: MutableMapping = None, ttl: int = TTL):
+        self.storage = {} if storage is None else storage
+        self.ttl = ttl
+
+    def get(self, vk_id: int, stale: bool = False) -> Optional[Any]:
+
+        """ Returns cached photos or None. Expired entries are returned only if stale=True """
+
+        entry = self.storage.get(vk_id)
+        if entry is None:
+            return None
+        saved, photos = entry
+        if not stale and time.time() - saved > self.ttl:
+            return None
+        return photos
+
+    def set(self, vk_id: int, photos: Any) -> None:
+        self.storage[vk_id] = (time.time(), photos)
+
+    def __contains__(self, vk_id: int) -> bool:
+        return self.get(vk_id) is not None
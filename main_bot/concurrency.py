@@ -0,0 +1,197 @@
+""" Adaptive limits of the parallel work of a process: VK API calls and database work.
+
+Every limit works like a semaphore whose size is tuned by AIMD (additive increase, multiplicative decrease)
+once per VKINDER_ADJUST_INTERVAL seconds:
+    - the size is multiplied by 0.7 when VK answered with error 6 ("Too many requests per second")
+      or when the 99th percentile of the latency of the recent calls is above the target,
+    - it grows by one while the latency is fine and there is more work than the limit lets through:
+      callers are waiting for a slot or the inbox of the bot has unanswered messages,
+    - otherwise it stays the same.
+The limits of the process and their state are returned by limits.stats(), written to the log every
+VKINDER_LIMITS_REPORT_INTERVAL seconds (0 turns it off), and every decrease is logged.
+
+Every SQL statement of the process, whoever runs it (the helpers of Connect, the scheduler, the search stream),
+takes a slot of the database limit while it runs. A slot is held for one statement, not for a transaction,
+so slots never nest; a statement waiting for a lock of a transaction whose next statement waits for a slot
+is released by the growth of the limit while callers are waiting. """
+
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+ADJUST_INTERVAL = float(os.getenv("VKINDER_ADJUST_INTERVAL", 5))
+REPORT_INTERVAL = float(os.getenv("VKINDER_LIMITS_REPORT_INTERVAL", 60))
+# the latencies of this many recent calls give the percentile
+WINDOW = 200
+DECREASE = 0.7
+
+VK_CONCURRENCY = int(os.getenv("VKINDER_VK_CONCURRENCY", 4))
+VK_CONCURRENCY_MAX = int(os.getenv("VKINDER_VK_CONCURRENCY_MAX", 16))
+VK_TARGET_P99 = float(os.getenv("VKINDER_VK_TARGET_P99", 2))
+
+# the maximum should not exceed the connection pool of the process
+DB_CONCURRENCY = int(os.getenv("VKINDER_DB_CONCURRENCY", 2))
+DB_CONCURRENCY_MAX = int(os.getenv("VKINDER_DB_CONCURRENCY_MAX", 8))
+DB_TARGET_P99 = float(os.getenv("VKINDER_DB_TARGET_P99", 0.5))
+
+
+class AdaptiveLimit:
+
+    def __init__(self, name: str, initial: int, maximum: int, target_p99: float, minimum: int = 1,
+                 demand: Callable[[], int] = lambda: 0):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.target_p99 = target_p99
+        # amount of work waiting outside of the limit, e.g. the backlog of the inbox
+        self.demand = demand
+
+        self.in_flight = 0
+        self.waiting = 0
+        self.congestion_signals = 0
+        self.latencies = deque(maxlen=WINDOW)
+        self.adjusted_at = time.monotonic()
+        self.condition = threading.Condition()
+
+    def resize(self, maximum: int) -> None:
+        with self.condition:
+            self.maximum = max(self.minimum, maximum)
+            self.limit = min(self.limit, self.maximum)
+
+    @contextmanager
+    def slot(self):
+
+        """ Runs the block when the limit lets it through and records its latency """
+
+        self.acquire()
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - started)
+
+    def acquire(self) -> None:
+        with self.condition:
+            self.waiting += 1
+            try:
+                while self.in_flight >= int(self.limit):
+                    # the limit may grow while nothing is released
+                    self.condition.wait(ADJUST_INTERVAL)
+                    self._adjust()
+            finally:
+                self.waiting -= 1
+            self.in_flight += 1
+
+    def release(self, latency: float) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            self.latencies.append(latency)
+            self._adjust()
+            self.condition.notify_all()
+
+    def congestion(self) -> None:
+
+        """ VK asked to slow down (error 6) """
+
+        with self.condition:
+            self.congestion_signals += 1
+            self._adjust()
+
+    def p99(self) -> float:
+        if not self.latencies:
+            return 0.0
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+
+    def _adjust(self) -> None:
+        now = time.monotonic()
+        if now - self.adjusted_at < ADJUST_INTERVAL:
+            return
+        self.adjusted_at = now
+
+        p99 = self.p99()
+        if self.congestion_signals or p99 > self.target_p99:
+            limit = max(self.minimum, self.limit * DECREASE)
+            if int(limit) != int(self.limit):
+                logger.info('Concurrency of %s: %s -> %s (p99 %.2f s, error 6: %s)', self.name, int(self.limit),
+                            int(limit), p99, self.congestion_signals)
+            self.limit = limit
+            # the latencies of the old limit must not decrease the new one again
+            self.latencies.clear()
+        elif self.waiting or self.demand() > 0:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.condition.notify_all()
+        self.congestion_signals = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self.condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight, 'waiting': self.waiting,
+                    'p99': round(self.p99(), 3), 'max': self.maximum}
+
+
+class Limits:
+
+    """The limits of the process; the backlog of the inboxes of its bots counts as demand for both"""
+
+    def __init__(self):
+        self._inboxes = weakref.WeakSet()
+        self.vk = AdaptiveLimit('vk', VK_CONCURRENCY, VK_CONCURRENCY_MAX, VK_TARGET_P99, demand=self.backlog)
+        self.db = AdaptiveLimit('db', DB_CONCURRENCY, DB_CONCURRENCY_MAX, DB_TARGET_P99, demand=self.backlog)
+        self.thread = None
+
+    def watch(self, inbox) -> None:
+        self._inboxes.add(inbox)
+
+    def backlog(self) -> int:
+        return sum(inbox.size for inbox in list(self._inboxes))
+
+    def stats(self) -> Dict[str, Any]:
+        return {'backlog': self.backlog(), 'vk': self.vk.stats(), 'db': self.db.stats()}
+
+    def _report_loop(self) -> None:
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            logger.info('Concurrency limits (pid %s): %s', os.getpid(), self.stats())
+
+    def start_report(self) -> None:
+        # a forked worker process has no threads of its parent
+        if REPORT_INTERVAL > 0 and (self.thread is None or not self.thread.is_alive()):
+            self.thread = threading.Thread(target=self._report_loop, name='vkinder-limits-report', daemon=True)
+            self.thread.start()
+
+
+limits = Limits()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _db_acquire(conn, cursor, statement, parameters, context, executemany) -> None:
+    limits.db.acquire()
+    context.vkinder_db_slot = time.monotonic()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _db_release(conn, cursor, statement, parameters, context, executemany) -> None:
+    _release_slot(context)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _db_release_on_error(exception_context) -> None:
+    _release_slot(exception_context.execution_context)
+
+
+def _release_slot(context) -> None:
+    # a failed statement may reach both listeners
+    started = context.__dict__.pop('vkinder_db_slot', None) if context is not None else None
+    if started is not None:
+        limits.db.release(time.monotonic() - started)
@@ -0,0 +1,141 @@
+""" Memoizing cache of the VK geo lookups (database.getCities / database.getRegions).
+
+Answers are kept in memory and in the "geolookup" table, so they survive restarts and are shared
+by all workers. Empty answers are cached too, but for a shorter time. Resolved cities and regions
+are written through to the City / Region tables in batches: once VKINDER_GEO_BATCH of them are pending,
+once the oldest of them has waited VKINDER_GEO_FLUSH_INTERVAL seconds (checked at every lookup and write)
+and when the process exits. A batch which could not be written stays pending and is written with the next one. """
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+from db.database import City, Connect, GeoLookup, Region
+from main_bot.breaker import VK_FAILURES
+
+logger = logging.getLogger(__name__)
+
+POSITIVE_TTL = timedelta(days=int(os.getenv("VKINDER_GEO_TTL_DAYS", 30)))
+NEGATIVE_TTL = timedelta(hours=int(os.getenv("VKINDER_GEO_NEGATIVE_TTL_HOURS", 24)))
+
+BATCH_SIZE = int(os.getenv("VKINDER_GEO_BATCH", 50))
+FLUSH_INTERVAL = float(os.getenv("VKINDER_GEO_FLUSH_INTERVAL", 60))
+
+# every row of a batch must have the same keys; a city without a region has no "region_id"
+CITY_DEFAULTS = {"area": None, "region": None, "region_id": None, "important": None}
+
+
+class GeoCache(Connect):
+
+    def __init__(self):
+        self.memory: Dict[str, tuple] = {}
+        self.known_cities = set()
+        self.pending_cities: Dict[int, Dict[str, Any]] = {}
+        self.pending_regions: Dict[int, Dict[str, Any]] = {}
+        self.pending_since = None
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def key(method: str, values: Dict[str, Any]) -> str:
+        return f"{method}:{values.get('country_id')}:{str(values.get('q', '')).strip().lower()}"
+
+    def lookup(self, method: str, values: Dict[str, Any], fetch: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+
+        """ The answer of the VK method: from memory, from the database or from VK (and then remembered) """
+
+        self._flush_if_due()
+        key = self.key(method, values)
+        now = datetime.utcnow()
+
+        cached = self.memory.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+
+        row = self.select_from_db((GeoLookup.result, GeoLookup.expires_at), GeoLookup.key == key).first()
+        if row and row[1] > now:
+            result = json.loads(row[0])
+        else:
+            try:
+                result = fetch()
+            except VK_FAILURES:
+                # an expired answer is used while VK is unavailable
+                if not row:
+                    raise
+                return json.loads(row[0])
+            ttl = POSITIVE_TTL if result.get('items') else NEGATIVE_TTL
+            self.upsert(GeoLookup, [{'key': key, 'result': json.dumps(result, ensure_ascii=False),
+                                     'expires_at': now + ttl}])
+            row = (None, now + ttl)
+
+        self.memory[key] = (row[1], result)
+        return result
+
+    def city_known(self, city_id: int) -> bool:
+
+        """ Whether the city is already in the City table (or waits to be written to it);
+        checked in the database once per process """
+
+        if city_id in self.known_cities or city_id in self.pending_cities:
+            return True
+        if self.select_from_db(City.id, City.id == city_id).first():
+            self.known_cities.add(city_id)
+            return True
+        return False
+
+    def write_through(self, city: Dict[str, Any], region: Optional[Dict[str, Any]] = None) -> None:
+
+        """ Queueing the resolved city and its region; the batch is written when it is full or old enough """
+
+        with self._lock:
+            if region:
+                self.pending_regions[region['id']] = region
+            self.pending_cities[city['id']] = {**CITY_DEFAULTS, **city}
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+        self._flush_if_due()
+
+    def _flush_if_due(self) -> None:
+        with self._lock:
+            due = self.pending_since is not None and (len(self.pending_cities) >= BATCH_SIZE or
+                                                      time.monotonic() - self.pending_since >= FLUSH_INTERVAL)
+        if due:
+            # the batch is written later, the lookup of the user does not depend on it
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Geo batch is not written')
+
+    def ensure(self, city_id: int) -> None:
+
+        """ Writing the pending batch at once if it holds the city, e.g. before a row referencing it is written """
+
+        if city_id in self.pending_cities:
+            self.flush()
+
+    def flush(self) -> None:
+
+        """ Writing the resolved regions and cities in one batch """
+
+        with self._lock:
+            pending_since, self.pending_since = self.pending_since, None
+            regions, self.pending_regions = self.pending_regions, {}
+            cities, self.pending_cities = self.pending_cities, {}
+        try:
+            self.upsert(Region, list(regions.values()))
+            self.upsert(City, list(cities.values()))
+        except Exception:
+            self.session.rollback()
+            with self._lock:
+                # the rows queued meanwhile are newer
+                self.pending_regions = {**regions, **self.pending_regions}
+                self.pending_cities = {**cities, **self.pending_cities}
+                if pending_since is not None:
+                    self.pending_since = min(pending_since, self.pending_since or pending_since)
+            raise
+        self.known_cities.update(cities)
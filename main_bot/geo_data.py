@@ -0,0 +1,145 @@
+"""Collecting toponyms from the VK database into the fixtures of db/fix.
+Used to fill the database, not by the bot itself: python -m main_bot.geo_data"""
+
+import json
+import os
+from datetime import datetime
+
+from tqdm import tqdm
+
+from db.database import FIX_DIR
+from main_bot.main_menu import LIST_OF_DICTS, VKAuth
+
+
+class VKGeoData(VKAuth):
+    """ Class with utility methods for collecting information for the database.
+    The calls are paced by the shared limiter of the VK session """
+
+    def get_countries(self) -> LIST_OF_DICTS:
+        """ Service method for collecting all countries.
+        Used to fill the database """
+
+        print('Страны')
+        countries = []
+        countries_query = self.vk_session.method('database.getCountries',
+                                                 values={'need_all': 1, 'count': 1000})['items']
+
+        for country in countries_query:
+            new_dic = {'model': 'country', 'fields': country}
+            countries.append(new_dic)
+
+        with open(os.path.join(FIX_DIR, 'countries.json'), 'w', encoding='utf-8') as f:
+            json.dump(countries, f)
+        return countries_query
+
+    def get_regions(self, countries: LIST_OF_DICTS = None) -> LIST_OF_DICTS:
+
+        print('Регионы')
+        regions = [{'model': 'region', 'fields': {"id": 1, "title": "Москва город", "country_id": 1}},
+                   {'model': 'region', 'fields': {"id": 2, "title": "Санкт-Петербург город", "country_id": 1}}]
+
+        if not countries:
+            try:
+                with open(os.path.join(FIX_DIR, 'countries.json'), 'r', encoding='utf-8') as f:
+                    countries = json.load(f)
+            except (FileNotFoundError, FileExistsError):
+                countries = self.get_countries()
+
+        for country in countries:
+            print(".", end='')
+
+            regions_quantity = self.vk_session.method('database.getRegions', values={'country_id': country['fields']['id'],
+                                                                                        'count': 100})['count']
+            if regions_quantity:
+                search_values = {'country_id': country['fields']['id'], 'count': 100}
+                regions_quantity = self.vk_session.method('database.getRegions', values=search_values)['count']
+                if regions_quantity > 100:
+                    queries = regions_quantity // 100 + 1
+                    values = {'country_id': country['fields']['id'],
+                              'count': 100,
+                              'offset': 0}
+                    for query in tqdm(range(queries), desc=f"Обход регионов в стране {country['fields']['title']}"):
+                        values['offset'] = 100 * query
+                        regions_list = self.vk_session.method('database.getRegions', values=values)['items']
+                        if regions_list:
+                            for region in regions_list:
+                                region.update({'country_id': country['fields']['id']})
+                                new_dict = {'model': 'region', 'fields': region}
+                                regions.append(new_dict)
+
+                else:
+                    regions_list = self.vk_session.method('database.getRegions', values=search_values)['items']
+                    if regions_list:
+                        for region in regions_list:
+                            region.update({'country_id': country['fields']['id']})
+                            new_dict = {'model': 'region', 'fields': region}
+                            regions.append(new_dict)
+
+        with open(os.path.join(FIX_DIR, 'regions.json'), 'w', encoding='utf-8') as f:
+            json.dump(regions, f)
+        return regions
+
+    def get_cities(self, regions: LIST_OF_DICTS = None) -> LIST_OF_DICTS:
+
+        """ A service method for collecting all cities in all countries.
+        Used to fill the database """
+
+        print('Загрузка названий городов')
+        cities = []
+
+        if not regions:
+            try:
+                with open(os.path.join(FIX_DIR, 'regions.json'), 'r', encoding='utf-8') as f:
+                    regions = json.load(f)
+            except (FileNotFoundError, FileExistsError):
+                regions = self.get_regions()
+
+        for region in regions:
+            print(".", end='')
+
+            search_values = {'country_id': region['fields']['country_id'],
+                             'region_id': region['fields']['id'],
+                             'need_all': 1,
+                             'count ': 100}
+            cities_quantity = self.vk_session.method('database.getCities', values=search_values)['count']
+
+            if cities_quantity:
+                if cities_quantity > 100:
+                    queries = cities_quantity // 100 + 1
+                    values = {'country_id': region['fields']['country_id'],
+                              'region_id': region['fields']['id'],
+                              'offset': 0,
+                              'need_all': 1,
+                              'count ': 100}
+                    for query in tqdm(range(queries), desc=f"Обход всех городов в регионе {region['fields']['title']}"):
+
+                        values['offset'] = 100 * query
+                        cities_list = self.vk_session.method('database.getCities', values=values)['items']
+                        if cities_list:
+                            for city in cities_list:
+                                city.update({'region_id': region['fields']['id']})
+                                new_dic = {'model': 'city', 'fields': city}
+                                cities.append(new_dic)
+
+                else:
+                    cities_list = self.vk_session.method('database.getCities', values=search_values)['items']
+                    if cities_list:
+                        for city in cities_list:
+                            city.update({'region_id': region['fields']['id']})
+                            new_dic = {'model': 'city', 'fields': city}
+                            cities.append(new_dic)
+
+        with open(os.path.join(FIX_DIR, 'cities.json'), 'w', encoding='utf-8') as f:
+            json.dump(cities, f)
+        return cities
+
+
+
+if __name__ == '__main__':
+    geo = VKGeoData()
+    now = datetime.now()
+    print(now)
+    geo.get_countries()
+    geo.get_regions()
+    geo.get_cities()
+    print(datetime.now() - now)
\ No newline at end of file
@@ -0,0 +1,141 @@
+""" Bounded per-user queues of incoming messages.
+
+A pump thread reads the events (VkLongPoll or the queue of a worker) and puts the messages to the bot
+into a queue of their user; the dialogue takes them user by user in turn, so a user who sends a lot
+of messages does not hold up the others. While a message is waiting:
+    - the same text sent again by the same user (repeated taps on a button) is dropped,
+    - a user keeps at most VKINDER_INBOX_PER_USER messages, older ones are superseded by new ones,
+      and only the latest one while the backlog is more than half full,
+    - with VKINDER_INBOX_LIMIT messages waiting the pump stops reading events until the bot catches up,
+      unless the dialogue waits for the answer of a user who has nothing in the inbox yet.
+A dialogue in progress takes only the messages of its user; the others wait for it to end. """
+
+import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Any, Dict, Iterable, Optional
+
+from vk_api.longpoll import Event, VkEventType
+
+PER_USER = int(os.getenv("VKINDER_INBOX_PER_USER", 3))
+BACKLOG_LIMIT = int(os.getenv("VKINDER_INBOX_LIMIT", 200))
+
+
+class InboxClosed(Exception):
+
+    """The events are over, e.g. a worker process is stopped"""
+
+
+class AnswerTimeout(Exception):
+
+    """The user of the dialogue has not answered in time while other users are waiting"""
+
+    def __init__(self, user_id: int):
+        super().__init__(user_id)
+        self.user_id = user_id
+
+
+class Inbox:
+
+    def __init__(self, events: Iterable[Event], per_user: int = PER_USER, limit: int = BACKLOG_LIMIT):
+        self.events = events
+        self.per_user = per_user
+        self.limit = limit
+        self.queues: 'OrderedDict[int, deque]' = OrderedDict()
+        self.size = 0
+        self.dropped = Counter()
+        self.closed = False
+        self.error: Optional[BaseException] = None
+        self.condition = threading.Condition()
+        self.thread = None
+        # the user whose answer the dialogue is waiting for
+        self.waiting_for: Optional[int] = None
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._pump, name='vkinder-inbox', daemon=True)
+            self.thread.start()
+
+    def _pump(self) -> None:
+        try:
+            for event in self.events:
+                if event.type == VkEventType.MESSAGE_NEW and event.to_me:
+                    self.put(event)
+        except BaseException as error:
+            self.error = error
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
+    def put(self, event: Event) -> None:
+        with self.condition:
+            # backpressure: events stay unread in LongPoll until there is room
+            while self.size >= self.limit and not self._awaited_empty():
+                self.condition.wait()
+
+            queue = self.queues.setdefault(event.user_id, deque())
+            if queue and queue[-1].text == event.text:
+                self.dropped['repeated'] += 1
+                return
+
+            capacity = 1 if self.size * 2 >= self.limit else self.per_user
+            while len(queue) >= capacity:
+                queue.popleft()
+                self.size -= 1
+                self.dropped['superseded'] += 1
+
+            queue.append(event)
+            self.size += 1
+            self.condition.notify_all()
+
+    def _awaited_empty(self) -> bool:
+        return self.waiting_for is not None and not self.queues.get(self.waiting_for)
+
+    def get(self, user_id: Optional[int] = None, timeout: Optional[float] = None) -> Event:
+
+        """ The next message: of the given user, or of all users in turn.
+        Waiting for a user ends with AnswerTimeout after timeout seconds, but only if other users
+        have written meanwhile; InboxClosed (or the error of the events) is raised when the events are over """
+
+        with self.condition:
+            if user_id is None:
+                self._wait(lambda: self.size)
+                user_id, queue = self.queues.popitem(last=False)
+            else:
+                deadline = time.monotonic() + timeout if timeout is not None else None
+                self.waiting_for = user_id
+                try:
+                    self._wait(lambda: self.queues.get(user_id), user_id, deadline)
+                finally:
+                    self.waiting_for = None
+                queue = self.queues.pop(user_id)
+
+            event = queue.popleft()
+            self.size -= 1
+            if queue:
+                # the user goes to the end of the line
+                self.queues[user_id] = queue
+            self.condition.notify_all()
+            return event
+
+    def _wait(self, ready, user_id: Optional[int] = None, deadline: Optional[float] = None) -> None:
+        while not ready():
+            if self.closed:
+                if self.error is not None:
+                    raise self.error
+                raise InboxClosed()
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if self.size:
+                        raise AnswerTimeout(user_id)
+                    # nobody else is waiting, the user may answer later
+                    remaining = None
+            self.condition.wait(remaining)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.condition:
+            return {'backlog': self.size, 'users': len(self.queues), 'dropped': dict(self.dropped)}
@@ -0,0 +1,241 @@
+""" Prebuilt keyboards of the bot.
+
+Every keyboard is built and serialized to JSON once and then reused for every message.
+Keyboards made of reference data are rebuilt after the reference tables change
+(in this process, or in another one: the tables are compared again every VKINDER_REFERENCE_TTL seconds).
+
+Every button carries a payload with its command, e.g. {"command": "yes"} or {"command": "sex", "id": 1},
+so the dialogue does not depend on the text of the button. A message typed by hand is matched
+with the labels of the buttons; only free input (cities, ages) is parsed as text. """
+
+import json
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from vk_api.keyboard import VkKeyboard, VkKeyboardColor
+
+from db.database import Sex, Status, Sort
+from db.reference import reference
+
+
+def scan_request(text: str) -> str:
+
+    """Words of the message in lower case, without punctuation and emoji"""
+
+    request = text.lower().strip()
+    query = re.findall(r'([А-Яа-яЁёA-Za-z0-9]+)', request)
+    if len(query) > 1:
+        return ' '.join(query)
+    try:
+        return query[0]
+    except IndexError:
+        return request
+
+
+class KeyboardCache:
+
+    def __init__(self):
+        self._builders: Dict[str, Callable[[], VkKeyboard]] = {}
+        self._cache: Dict[str, str] = {}
+        self._commands: Dict[str, Dict[str, Any]] = {}
+
+    def register(self, name: str):
+
+        """ Decorator registering a function which builds the keyboard """
+
+        def decorator(builder: Callable[[], VkKeyboard]):
+            self._builders[name] = builder
+            return builder
+        return decorator
+
+    def get(self, name: str) -> str:
+
+        """ JSON of the keyboard ready to be sent """
+
+        reference.check()
+        keyboard = self._cache.get(name)
+        if keyboard is None:
+            keyboard = self._cache[name] = self._builders[name]().get_keyboard()
+        return keyboard
+
+    def add_button(self, keyboard: VkKeyboard, label: str, color: str, command: str, **values) -> None:
+
+        """ A button with the payload of the command; its label is remembered for the typed messages """
+
+        payload = dict(values, command=command)
+        keyboard.add_button(label, color, payload=payload)
+        self._commands[scan_request(label)] = payload
+
+    def command(self, text: str) -> Optional[Dict[str, Any]]:
+
+        """ Payload of the button whose label is the text """
+
+        self.build_all()
+        return self._commands.get(scan_request(text))
+
+    def build_all(self) -> None:
+        for name in self._builders:
+            self.get(name)
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._commands.clear()
+
+
+keyboards = KeyboardCache()
+reference.on_invalidate(keyboards.clear)
+button = keyboards.add_button
+
+# a button label is cut by VK after 40 characters
+LABEL_LENGTH = 40
+# limits of a carousel: elements, and characters of the title and the description of an element
+CAROUSEL_SIZE = 10
+CAROUSEL_TEXT_LENGTH = 80
+
+
+def choice(buttons: Iterable[Tuple[str, Dict[str, Any]]]) -> str:
+
+    """ One-off keyboard with a button for every (label, payload) and "Отмена" at the bottom """
+
+    keyboard = VkKeyboard(one_time=True)
+    for label, payload in buttons:
+        keyboard.add_button(label[:LABEL_LENGTH], VkKeyboardColor.PRIMARY, payload=payload)
+        keyboard.add_line()
+    keyboard.add_button("Отмена", VkKeyboardColor.NEGATIVE, payload={'command': 'cancel'})
+    return keyboard.get_keyboard()
+
+
+def carousel_element(title: str, description: str, link: str,
+                     buttons: Iterable[Tuple[str, str, Dict[str, Any]]]) -> Dict[str, Any]:
+
+    """ Element of a carousel opening the link, with text buttons (label, color, payload) """
+
+    keyboard = VkKeyboard(inline=True)
+    for label, color, payload in buttons:
+        keyboard.add_button(label[:LABEL_LENGTH], color, payload=payload)
+    return {'title': title[:CAROUSEL_TEXT_LENGTH], 'description': description[:CAROUSEL_TEXT_LENGTH],
+            'action': {'type': 'open_link', 'link': link}, 'buttons': keyboard.lines[0]}
+
+
+def carousel(elements: List[Dict[str, Any]]) -> str:
+
+    """ JSON of a carousel template; all elements must have the same fields """
+
+    return json.dumps({'type': 'carousel', 'elements': elements[:CAROUSEL_SIZE]}, ensure_ascii=False)
+
+
+@keyboards.register('cancel')
+def _cancel() -> VkKeyboard:
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, "Отмена", VkKeyboardColor.NEGATIVE, 'cancel')
+    return keyboard
+
+
+@keyboards.register('decision')
+def _decision() -> VkKeyboard:
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, "Да", VkKeyboardColor.POSITIVE, 'yes')
+    button(keyboard, "Нет", VkKeyboardColor.NEGATIVE, 'no')
+    keyboard.add_line()
+    button(keyboard, "Отмена", VkKeyboardColor.SECONDARY, 'cancel')
+    return keyboard
+
+
+@keyboards.register('yes_no')
+def _yes_no() -> VkKeyboard:
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, "Да", VkKeyboardColor.POSITIVE, 'yes')
+    button(keyboard, "Нет", VkKeyboardColor.NEGATIVE, 'no')
+    return keyboard
+
+
+@keyboards.register('welcome')
+def _welcome() -> VkKeyboard:
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, "Привет", VkKeyboardColor.SECONDARY, 'hello')
+    button(keyboard, "Новый поиск", VkKeyboardColor.POSITIVE, 'new_search')
+    return keyboard
+
+
+@keyboards.register('welcome_back')
+def _welcome_back() -> VkKeyboard:
+    keyboard = _welcome()
+    keyboard.add_line()
+    button(keyboard, "Результаты последнего поиска", VkKeyboardColor.SECONDARY, 'last_results')
+    keyboard.add_line()
+    button(keyboard, "Все, кто понравился", VkKeyboardColor.POSITIVE, 'liked')
+    button(keyboard, "кто не понравился", VkKeyboardColor.NEGATIVE, 'disliked')
+    return keyboard
+
+
+@keyboards.register('carousel')
+def _carousel() -> VkKeyboard:
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, "Ещё", VkKeyboardColor.PRIMARY, 'more')
+    keyboard.add_line()
+    button(keyboard, "Отмена", VkKeyboardColor.NEGATIVE, 'cancel')
+    return keyboard
+
+
+@keyboards.register('next_page')
+def _next_page() -> VkKeyboard:
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, "Следующая страница", VkKeyboardColor.PRIMARY, 'next_page')
+    keyboard.add_line()
+    button(keyboard, "Отмена", VkKeyboardColor.NEGATIVE, 'cancel')
+    return keyboard
+
+
+@keyboards.register('search_type')
+def _search_type() -> VkKeyboard:
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, "обычный", VkKeyboardColor.PRIMARY, 'simple')
+    button(keyboard, "подробный", VkKeyboardColor.SECONDARY, 'detailed')
+    keyboard.add_line()
+    button(keyboard, "отмена", VkKeyboardColor.NEGATIVE, 'cancel')
+    return keyboard
+
+
+# the payload of a reference button holds the id of the record (sex and sort ids start from 0, status ids from 1)
+
+@keyboards.register('sex')
+def _sex() -> VkKeyboard:
+    sex = reference.titles(Sex)
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, sex[1].capitalize(), VkKeyboardColor.NEGATIVE, 'sex', id=1)
+    button(keyboard, sex[2].capitalize(), VkKeyboardColor.PRIMARY, 'sex', id=2)
+    keyboard.add_line()
+    button(keyboard, sex[0].capitalize(), VkKeyboardColor.SECONDARY, 'sex', id=0)
+    button(keyboard, 'Отмена', VkKeyboardColor.NEGATIVE, 'cancel')
+    return keyboard
+
+
+@keyboards.register('status')
+def _status() -> VkKeyboard:
+    statuses = reference.titles(Status)
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, statuses[0], VkKeyboardColor.POSITIVE, 'status', id=1)
+    button(keyboard, statuses[1], VkKeyboardColor.PRIMARY, 'status', id=2)
+    keyboard.add_line()
+    button(keyboard, statuses[2], VkKeyboardColor.SECONDARY, 'status', id=3)
+    button(keyboard, statuses[3], VkKeyboardColor.NEGATIVE, 'status', id=4)
+    keyboard.add_line()
+    button(keyboard, statuses[5], VkKeyboardColor.POSITIVE, 'status', id=6)
+    button(keyboard, statuses[4], VkKeyboardColor.PRIMARY, 'status', id=5)
+    keyboard.add_line()
+    button(keyboard, statuses[6], VkKeyboardColor.SECONDARY, 'status', id=7)
+    button(keyboard, statuses[7], VkKeyboardColor.NEGATIVE, 'status', id=8)
+    keyboard.add_line()
+    button(keyboard, "Отмена", VkKeyboardColor.NEGATIVE, 'cancel')
+    return keyboard
+
+
+@keyboards.register('sort')
+def _sort() -> VkKeyboard:
+    sort_names = reference.titles(Sort)
+    keyboard = VkKeyboard(one_time=False)
+    button(keyboard, sort_names[0], VkKeyboardColor.POSITIVE, 'sort', id=0)
+    button(keyboard, sort_names[1], VkKeyboardColor.PRIMARY, 'sort', id=1)
+    keyboard.add_line()
+    button(keyboard, "Отмена", VkKeyboardColor.NEGATIVE, 'cancel')
+    return keyboard
@@ -1,44 +1,75 @@
 '''Vkontakte entity module responsible for:
-    - authorization of the program as a VK user,
+    - authorization of the program as a VK user (at startup by VKAuth.authorize(), not at import),
     - creating instances of VK user entities in a dialogue with the bot,
     - creating instances of VK users' entities obtained as a result of a search
     - processing of search results.
-    Additionally, the module has a separate class "VKGeoData" for collecting information about any toponyms from the VK database
-    for its subsequent recording into the program's own database.'''
+    Collecting toponyms from the VK database is done by "VKGeoData" in main_bot.geo_data.'''
 
 import os
+import sys
+from datetime import datetime
 import vk_api
 import json
-import operator
 from typing import List, Dict, Any
-from ratelimit import limits
-from tqdm import tqdm
-from db.database import Connect, User
-from datetime import datetime
+from db.database import Connect, User, lazy_class_attribute
+from main_bot import ranking
+from main_bot.breaker import VK_FAILURES
+from main_bot.cache import PhotoCache
+from main_bot.rate_limit import LimitedVkApi
+from main_bot.token_pool import TokenPool
 
 
 LIST_OF_DICTS = List[Dict[str, Any]]
 
+PHOTO_VALUES = {'album_id': 'profile',
+                'count': 1000,
+                'extended': 1,
+                'photo_sizes': 1,
+                'type': 'm'}
+
+# maximum number of API calls inside one "execute"
+EXECUTE_LIMIT = 25
+
 
 class VKAuth:
 
     TOKEN = os.getenv("VK_USER_TOKEN")
 
-    if TOKEN:
-        vk_session = vk_api.VkApi(token=TOKEN)
-    else:
-        username = os.getenv("VK_USER_LOGIN")
-        password = os.getenv("VK_USER_PASS")
-        scope = 'users,notify,friends,photos,status,notifications,offline,wall,audio,video'
-        if not username or not password:
-            username: str = input('Введите свой логин: ')
-            password: str = input('Введите свой пароль: ')
-        vk_session = vk_api.VkApi(username, password, scope=scope)
-
-    try:
-        vk_session.auth(token_only=True)
-    except vk_api.AuthError as error_message:
-        print(error_message)
+    @lazy_class_attribute
+    def vk_session(cls) -> LimitedVkApi:
+        if cls.TOKEN:
+            vk_session = LimitedVkApi(token=cls.TOKEN, bucket='user')
+        else:
+            username = os.getenv("VK_USER_LOGIN")
+            password = os.getenv("VK_USER_PASS")
+            scope = 'users,notify,friends,photos,status,notifications,offline,wall,audio,video'
+            if not username or not password:
+                # nobody can answer the prompt in a worker process or in a service
+                if not sys.stdin or not sys.stdin.isatty():
+                    raise SystemExit('Укажите VK_USER_TOKEN или VK_USER_LOGIN и VK_USER_PASS')
+                username: str = input('Введите свой логин: ')
+                password: str = input('Введите свой пароль: ')
+            vk_session = LimitedVkApi(username, password, scope=scope, bucket='user')
+
+        try:
+            vk_session.auth(token_only=True)
+        except vk_api.AuthError as error_message:
+            print(error_message)
+        return vk_session
+
+    # searches and photos are spread over all user tokens from the config
+    @lazy_class_attribute
+    def token_pool(cls) -> TokenPool:
+        return TokenPool.from_env(cls.vk_session)
+
+    @classmethod
+    def authorize(cls) -> TokenPool:
+
+        """ Authorization and the token pool at startup, before the first dialogue and before the workers
+        are forked, so the login is never asked in the middle of a dialogue and the rate limits of all tokens
+        are shared by the workers """
+
+        return cls.token_pool
 
 
 class VKUser(VKAuth, Connect):
@@ -62,6 +93,22 @@ class VKUser(VKAuth, Connect):
             self.city = info[0].get('city')
             self.country = info[0].get('country')
 
+    # the profile of the user, kept over a warm restart of the bot
+    SNAPSHOT_FIELDS = ('user_id', 'first_name', 'last_name', 'sex', 'link', 'city', 'country')
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {field: getattr(self, field) for field in self.SNAPSHOT_FIELDS}
+
+    @classmethod
+    def restore(cls, fields: Dict[str, Any]) -> 'VKUser':
+
+        """ The user from a snapshot, without requesting the profile from VK """
+
+        user = cls.__new__(cls)
+        user.__dict__.update(fields)
+        user.welcomed = False
+        return user
+
     def get_self_info(self, user_id: int):
 
         """ Method to get all information about a user """
@@ -80,7 +127,8 @@ class VKUser(VKAuth, Connect):
             'last_name': self.last_name,
             'sex_id': self.sex,
             'city_id': self.city['id'],
-            'link': self.link
+            'link': self.link,
+            'last_seen': datetime.utcnow()
         }
 
         if not self.select_from_db(User.id, User.id == self.user_id).first():
@@ -92,6 +140,8 @@ class VKDatingUser(VKAuth):
     """This class is responsible for the selection of a person at the user's request
     and produces three of his popular photos"""
 
+    photo_cache = PhotoCache()
+
     def __init__(self, db_id: int, vk_id: int, first_name: str, last_name: str, vk_link: str):
         self.db_id = db_id
         self.id = vk_id
@@ -104,156 +154,48 @@ class VKDatingUser(VKAuth):
 
     def get_photo(self):
 
-        search_values = {'owner_id': self.id,
-                         'album_id': 'profile',
-                         'count': 1000,
-                         'extended': 1,
-                         'photo_sizes': 1,
-                         'type': 'm'}
-
-        response = self.vk_session.method('photos.get', values=search_values)
-        photos = []
-
-        for photo in response['items']:
-            photos.append((photo['id'], photo['owner_id'], photo['likes']['count']))
-
-        sorted_photos = sorted(photos, key=operator.itemgetter(2), reverse=True)
-        top_photos = [(id, photo) for id, photo, _ in sorted_photos][:3]
-        return top_photos
+        top_photos = self.photo_cache.get(self.id)
+        if top_photos is not None:
+            return top_photos
 
-class VKGeoData(VKAuth):
-    """ Class with utility methods for collecting information for the database """
+        search_values = dict(PHOTO_VALUES, owner_id=self.id)
 
-    REQUESTS_PER = 3
-    SECOND = 1
+        try:
+            response = self.token_pool.method('photos.get', values=search_values)
+        except VK_FAILURES:
+            # while VK is unavailable expired photos are better than none
+            return self.photo_cache.get(self.id, stale=True) or []
+        photos = ranking.top_photos(response['items'])
+        self.photo_cache.set(self.id, photos)
+        return photos
 
-    def get_countries(self) -> LIST_OF_DICTS:
-        """ Service method for collecting all countries.
-        Used to fill the database """
+    @classmethod
+    def get_photos_batch(cls, dating_users: List['VKDatingUser']) -> None:
 
-        print('Страны')
-        countries = []
-        countries_query = self.vk_session.method('database.getCountries',
-                                                 values={'need_all': 1, 'count': 1000})['items']
+        """ Fetching the albums of several people with one "execute" call per 25 of them
+        and ranking all their photos in one pass """
 
-        for country in countries_query:
-            new_dic = {'model': 'country', 'fields': country}
-            countries.append(new_dic)
+        missing = []
+        for d_user in dating_users:
+            d_user.photos = cls.photo_cache.get(d_user.id)
+            if d_user.photos is None:
+                missing.append(d_user)
 
-        with open('../db/fix/countries.json', 'w', encoding='utf-8') as f:
-            json.dump(countries, f)
-        return countries_query
-
-    @limits(REQUESTS_PER, SECOND)
-    def get_regions(self, countries: LIST_OF_DICTS = None) -> LIST_OF_DICTS:
-
-        print('Регионы')
-        regions = [{'model': 'region', 'fields': {"id": 1, "title": "Москва город", "country_id": 1}},
-                   {'model': 'region', 'fields': {"id": 2, "title": "Санкт-Петербург город", "country_id": 1}}]
-
-        if not countries:
-            try:
-                with open('../db/fix/countries.json', 'r', encoding='utf-8') as f:
-                    countries = json.load(f)
-            except (FileNotFoundError, FileExistsError):
-                countries = self.get_countries()
-
-        for country in countries:
-            print(".", end='')
-
-            regions_quantity = self.vk_session.method('database.getRegions', values={'country_id': country['fields']['id'],
-                                                                                        'count': 100})['count']
-            if regions_quantity:
-                search_values = {'country_id': country['fields']['id'], 'count': 100}
-                regions_quantity = self.vk_session.method('database.getRegions', values=search_values)['count']
-                if regions_quantity > 100:
-                    queries = regions_quantity // 100 + 1
-                    values = {'country_id': country['fields']['id'],
-                              'count': 100,
-                              'offset': 0}
-                    for query in tqdm(range(queries), desc=f"Обход регионов в стране {country['fields']['title']}"):
-                        values['offset'] = 100 * query
-                        regions_list = self.vk_session.method('database.getRegions', values=values)['items']
-                        if regions_list:
-                            for region in regions_list:
-                                region.update({'country_id': country['fields']['id']})
-                                new_dict = {'model': 'region', 'fields': region}
-                                regions.append(new_dict)
-
-                else:
-                    regions_list = self.vk_session.method('database.getRegions', values=search_values)['items']
-                    if regions_list:
-                        for region in regions_list:
-                            region.update({'country_id': country['fields']['id']})
-                            new_dict = {'model': 'region', 'fields': region}
-                            regions.append(new_dict)
-
-        with open('../db/fix/regions.json', 'w', encoding='utf-8') as f:
-            json.dump(regions, f)
-        return regions
-
-    @limits(REQUESTS_PER, SECOND)
-    def get_cities(self, regions: LIST_OF_DICTS = None) -> LIST_OF_DICTS:
-
-        """ A service method for collecting all cities in all countries.
-        Used to fill the database """
-
-        print('Загрузка названий городов')
-        cities = []
-
-        if not regions:
+        for start in range(0, len(missing), EXECUTE_LIMIT):
+            chunk = missing[start:start + EXECUTE_LIMIT]
+            calls = [f'API.photos.get({json.dumps(dict(PHOTO_VALUES, owner_id=d_user.id))})' for d_user in chunk]
             try:
-                with open('../db/fix/regions.json', 'r', encoding='utf-8') as f:
-                    regions = json.load(f)
-            except (FileNotFoundError, FileExistsError):
-                regions = self.get_regions()
-
-        for region in regions:
-            print(".", end='')
-
-            search_values = {'country_id': region['fields']['country_id'],
-                             'region_id': region['fields']['id'],
-                             'need_all': 1,
-                             'count ': 100}
-            cities_quantity = self.vk_session.method('database.getCities', values=search_values)['count']
-
-            if cities_quantity:
-                if cities_quantity > 100:
-                    queries = cities_quantity // 100 + 1
-                    values = {'country_id': region['fields']['country_id'],
-                              'region_id': region['fields']['id'],
-                              'offset': 0,
-                              'need_all': 1,
-                              'count ': 100}
-                    for query in tqdm(range(queries), desc=f"Обход всех городов в регионе {region['fields']['title']}"):
-
-                        values['offset'] = 100 * query
-                        cities_list = self.vk_session.method('database.getCities', values=values)['items']
-                        if cities_list:
-                            for city in cities_list:
-                                city.update({'region_id': region['fields']['id']})
-                                new_dic = {'model': 'city', 'fields': city}
-                                cities.append(new_dic)
-
-                else:
-                    cities_list = self.vk_session.method('database.getCities', values=search_values)['items']
-                    if cities_list:
-                        for city in cities_list:
-                            city.update({'region_id': region['fields']['id']})
-                            new_dic = {'model': 'city', 'fields': city}
-                            cities.append(new_dic)
-
-        with open('../db/fix/cities.json', 'w', encoding='utf-8') as f:
-            json.dump(cities, f)
-        return cities
-
-
-
-if __name__ == '__main__':
-    geo = VKGeoData()
-    now = datetime.now()
-    print(now)
-    geo.get_countries()
-    geo.get_regions()
-    geo.get_cities()
-    print(datetime.now() - now)
\ No newline at end of file
+                responses = cls.token_pool.method('execute', values={'code': f'return [{",".join(calls)}];'})
+            except VK_FAILURES:
+                for d_user in chunk:
+                    d_user.photos = cls.photo_cache.get(d_user.id, stale=True)
+                continue
+
+            # closed albums come back as false
+            albums = {d_user.id: [] for d_user in chunk}
+            for d_user, response in zip(chunk, responses or []):
+                albums[d_user.id] = (response or {}).get('items', [])
+            ranked = ranking.rank_albums(albums)
+            for d_user in chunk:
+                d_user.photos = ranked[d_user.id]
+                cls.photo_cache.set(d_user.id, d_user.photos)
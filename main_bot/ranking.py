@@ -0,0 +1,102 @@
+""" Popularity ranking of candidates' photos.
+
+Photos are kept in array-backed columns (likes, comments, reposts, date) instead of per-photo tuples.
+The score is a weighted sum of the columns, and only the top k photos of every owner are selected
+with a partial selection instead of a full sort. A whole batch of albums is scored in one pass.
+The weights are configured through environment variables. """
+
+import heapq
+import os
+import time
+from array import array
+from typing import Any, Dict, Iterable, List, Tuple
+
+# popularity is likes plus comments; reposts and recency are available for tuning
+WEIGHTS = {
+    'likes': float(os.getenv("VKINDER_WEIGHT_LIKES", 1)),
+    'comments': float(os.getenv("VKINDER_WEIGHT_COMMENTS", 1)),
+    'reposts': float(os.getenv("VKINDER_WEIGHT_REPOSTS", 0)),
+    'recency': float(os.getenv("VKINDER_WEIGHT_RECENCY", 0)),
+}
+
+TOP_PHOTOS = 3
+
+# age in days after which the recency bonus of a photo is halved
+RECENCY_HALF_LIFE = 365
+
+
+class PhotoColumns:
+
+    """Columns of photos of one or several albums"""
+
+    def __init__(self):
+        self.ids = array('q')
+        self.owners = array('q')
+        self.likes = array('d')
+        self.comments = array('d')
+        self.reposts = array('d')
+        self.dates = array('d')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def extend(self, photos: Iterable[Dict[str, Any]]) -> None:
+
+        """ Adds the items of a photos.get response (extended=1) """
+
+        for photo in photos:
+            self.ids.append(photo['id'])
+            self.owners.append(photo['owner_id'])
+            self.likes.append(photo.get('likes', {}).get('count', 0))
+            self.comments.append(photo.get('comments', {}).get('count', 0))
+            self.reposts.append(photo.get('reposts', {}).get('count', 0))
+            self.dates.append(photo.get('date', 0))
+
+    def scores(self, weights: Dict[str, float] = None) -> array:
+        weights = weights or WEIGHTS
+        w_likes, w_comments = weights.get('likes', 0), weights.get('comments', 0)
+        w_reposts, w_recency = weights.get('reposts', 0), weights.get('recency', 0)
+        now = time.time()
+        decay = RECENCY_HALF_LIFE * 24 * 60 * 60
+
+        if w_recency:
+            recency = (w_recency * 0.5 ** ((now - date) / decay) for date in self.dates)
+        else:
+            recency = (0 for _ in self.dates)
+
+        return array('d', (w_likes * likes + w_comments * comments + w_reposts * reposts + bonus
+                           for likes, comments, reposts, bonus
+                           in zip(self.likes, self.comments, self.reposts, recency)))
+
+
+def top_photos(photos: Iterable[Dict[str, Any]], k: int = TOP_PHOTOS,
+               weights: Dict[str, float] = None) -> List[Tuple[int, int]]:
+
+    """ The k most popular photos of one album as (photo_id, owner_id) """
+
+    columns = PhotoColumns()
+    columns.extend(photos)
+    scores = columns.scores(weights)
+    best = heapq.nlargest(k, range(len(columns)), key=scores.__getitem__)
+    return [(columns.ids[i], columns.owners[i]) for i in best]
+
+
+def rank_albums(albums: Dict[int, Iterable[Dict[str, Any]]], k: int = TOP_PHOTOS,
+                weights: Dict[str, float] = None) -> Dict[int, List[Tuple[int, int]]]:
+
+    """ The k most popular photos of every album of the batch, keyed by owner id.
+    All albums are put into the same columns and scored in one pass """
+
+    columns = PhotoColumns()
+    bounds = []
+    for owner_id, photos in albums.items():
+        start = len(columns)
+        columns.extend(photos)
+        bounds.append((owner_id, start, len(columns)))
+
+    scores = columns.scores(weights)
+    ranked = {}
+    for owner_id, start, end in bounds:
+        best = heapq.nlargest(k, range(start, end), key=scores.__getitem__)
+        ranked[owner_id] = [(columns.ids[i], columns.owners[i]) for i in best]
+    return ranked
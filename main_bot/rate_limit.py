@@ -0,0 +1,164 @@
+""" Central limiter of the VK API calls.
+
+Every VK method call goes through token buckets: one per access token and one per method of the token
+(the limits of VK methods are counted per token, so every token of the pool adds its own budget).
+The state of the buckets lives in shared memory, so the worker processes forked after this module
+is imported share the same budgets. When a bucket is empty the call waits for its turn instead of failing,
+which keeps bursts below the VK limits and away from error 6 ("Too many requests per second"). """
+
+import multiprocessing
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import vk_api
+from vk_api.exceptions import ApiError
+
+from main_bot.breaker import DEFAULT_TIMEOUT, METHOD_TIMEOUTS, TimeoutSession, breakers, is_brownout
+from main_bot.concurrency import limits
+
+TOO_MANY_REQUESTS = 6
+
+# requests per second allowed for every kind of token
+TOKEN_RATES = {
+    'user': 3,
+    'group': 20,
+}
+
+# requests per second allowed for particular methods of every token
+METHOD_RATES = {
+    'users.search': 2,
+    'photos.get': 3,
+    'database.getCities': 3,
+    'database.getRegions': 3,
+    'messages.send': 20,
+}
+
+
+class TokenBucket:
+
+    """Token bucket stored in shared memory.
+    The number of tokens may go below zero: it is the queue of callers who have already reserved their turn"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._state = multiprocessing.RawArray('d', [self.capacity, time.monotonic()])
+        self._lock = multiprocessing.Lock()
+
+    def reserve(self) -> float:
+
+        """ Takes a token and returns how many seconds the caller has to wait for it """
+
+        with self._lock:
+            now = time.monotonic()
+            tokens = min(self.capacity, self._state[0] + (now - self._state[1]) * self.rate) - 1
+            self._state[0] = tokens
+            self._state[1] = now
+        return -tokens / self.rate if tokens < 0 else 0
+
+    def drain(self) -> None:
+
+        """ Empties the bucket after VK has complained about the request rate """
+
+        with self._lock:
+            self._state[0] = min(self._state[0], 0) - self.capacity
+            self._state[1] = time.monotonic()
+
+
+class RateLimiter:
+
+    """Set of per-token buckets and per-method buckets of every token, keyed by (token, method).
+    Buckets must be created before the worker processes are forked"""
+
+    def __init__(self, token_rates: Dict[str, float] = None, method_rates: Dict[str, float] = None):
+        self.method_rates = dict(method_rates or {})
+        self.tokens: Dict[str, TokenBucket] = {}
+        self.methods: Dict[Tuple[str, str], TokenBucket] = {}
+        for name, rate in (token_rates or {}).items():
+            self.add_token(name, rate)
+
+    def add_token(self, name: str, rate: float) -> None:
+
+        """ Buckets of the token and of its methods """
+
+        if name not in self.tokens:
+            self.tokens[name] = TokenBucket(rate)
+            for method, method_rate in self.method_rates.items():
+                self.methods[(name, method)] = TokenBucket(method_rate)
+
+    def acquire(self, token: str, method: str) -> None:
+
+        """ Waits until both the token and its method have a free slot """
+
+        delay = 0
+        for bucket in (self.tokens.get(token), self.methods.get((token, method))):
+            if bucket is not None:
+                delay = max(delay, bucket.reserve())
+        if delay:
+            time.sleep(delay)
+
+    def penalize(self, token: str) -> None:
+        bucket = self.tokens.get(token)
+        if bucket is not None:
+            bucket.drain()
+
+
+limiter = RateLimiter(TOKEN_RATES, METHOD_RATES)
+
+
+class LimitedVkApi(vk_api.VkApi):
+
+    """VkApi session whose calls are paced by the shared limiter.
+    On error 6 the token bucket is drained and the call is repeated, up to RETRIES times
+    (retries=0 for the calls of a token pool, which moves on to another token instead).
+    Calls have the timeout of their method and go through the circuit breaker of the bucket and the method;
+    the number of calls in flight in the process is kept within the adaptive limit"""
+
+    # pacing is done by the shared limiter instead of the per-session delay of vk_api
+    RPS_DELAY = 0
+    RETRIES = int(os.getenv("VKINDER_RATE_RETRIES", 3))
+
+    # main_bot.replay: records every call or answers it from a trace instead of VK
+    tape = None
+
+    def __init__(self, *args, bucket: str = 'user', limiter: RateLimiter = limiter, **kwargs):
+        kwargs.setdefault('session', TimeoutSession())
+        super().__init__(*args, **kwargs)
+        self.bucket = bucket
+        self.limiter = limiter
+
+    def method(self, method, values=None, captcha_sid=None, captcha_key=None, raw=False,
+               retries: Optional[int] = None):
+        if self.tape is not None:
+            return self.tape.call(self, method, values,
+                                  lambda: self._paced_method(method, values, captcha_sid, captcha_key, raw, retries))
+        return self._paced_method(method, values, captcha_sid, captcha_key, raw, retries)
+
+    def _paced_method(self, method, values=None, captcha_sid=None, captcha_key=None, raw=False, retries=None):
+        retries = self.RETRIES if retries is None else retries
+        breaker = breakers.get(self.bucket, method)
+        breaker.before_call()
+        if isinstance(self.http, TimeoutSession):
+            self.http.local.timeout = METHOD_TIMEOUTS.get(method, DEFAULT_TIMEOUT)
+
+        for attempt in range(retries + 1):
+            self.limiter.acquire(self.bucket, method)
+            try:
+                with limits.vk.slot():
+                    response = super().method(method, values, captcha_sid=captcha_sid, captcha_key=captcha_key,
+                                              raw=raw)
+            except Exception as error:
+                too_many = isinstance(error, ApiError) and error.code == TOO_MANY_REQUESTS
+                if too_many:
+                    limits.vk.congestion()
+                    self.limiter.penalize(self.bucket)
+                if too_many and attempt < retries:
+                    continue
+                if is_brownout(error):
+                    breaker.failure()
+                else:
+                    breaker.neutral()
+                raise
+            breaker.success()
+            return response
@@ -0,0 +1,273 @@
+""" Recording of real traffic of the bot and its replay without network access.
+
+A trace is a JSON-lines file with the LongPoll events received by the bot and the VK API calls
+made by it, with the time of each record. Ids of VK users are replaced by stable pseudonyms,
+names, links and photo addresses are removed, sent messages are not stored.
+
+    python run_bot.py --record trace.jsonl
+    python -m main_bot.replay trace.jsonl --speed 10
+
+The replay feeds the events to a Bot at the recorded pace divided by the speed and answers its
+API calls from the trace, then prints the latency of replies and the throughput. It works with the
+configured database; with VKINDER_DB_URL=memory the reference tables are filled automatically. """
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List
+
+from vk_api.exceptions import ApiError
+from vk_api.longpoll import Event
+
+# keys holding VK ids of users ("id" only in profiles), and keys holding personal data which is dropped
+ID_KEYS = {'user_id', 'owner_id', 'peer_id', 'from_id', 'user_ids', 'peer_ids', 'owner_ids'}
+PRIVATE_KEYS = {'first_name', 'last_name', 'maiden_name', 'nickname', 'domain', 'screen_name', 'bdate',
+                'url', 'text', 'message', 'attachment', 'photo_50', 'photo_100', 'photo_200'}
+# ids of people inside the code of "execute"
+CODE_IDS = re.compile(r'("owner_id": )(-?\d+)')
+# calls whose answers are not looked up by their values
+UNKEYED = {'messages.send'}
+
+SALT = os.getenv("VKINDER_TRACE_SALT", 'vkinder')
+
+
+class TraceEnd(Exception):
+    """All events of the trace have been replayed"""
+
+
+class TraceMiss(ApiError):
+
+    """The trace has no answer for the call.
+    It is an API error, so the bot handles it like VK failing the call, and the miss is counted in the report"""
+
+    CODE = -1
+
+    def __init__(self, session, method: str, values: Dict[str, Any]):
+        super().__init__(session, method, values, False,
+                         {'error_code': self.CODE, 'error_msg': f'No recorded answer for {method}'})
+
+
+def pseudonym(vk_id: int) -> int:
+    if not vk_id:
+        return vk_id
+    digest = hashlib.sha1(f'{SALT}:{abs(vk_id)}'.encode()).digest()
+    value = 10 ** 9 + int.from_bytes(digest[:4], 'big') % 10 ** 9
+    return -value if vk_id < 0 else value
+
+
+def _ids(value):
+    if isinstance(value, int):
+        return pseudonym(value)
+    if isinstance(value, str):
+        return ','.join(str(pseudonym(int(item))) if item.strip().lstrip('-').isdigit() else item
+                        for item in value.split(','))
+    if isinstance(value, list):
+        return [_ids(item) for item in value]
+    return value
+
+
+def anonymize(value, key: str = None):
+
+    """ Copy of a response or of call values without personal data """
+
+    if key in ID_KEYS:
+        return _ids(value)
+    if key in PRIVATE_KEYS or (key and key.startswith('photo_')):
+        # the type is kept, so the code handling the answer works the same way
+        return '' if isinstance(value, str) else None
+    if key == 'code' and isinstance(value, str):
+        return CODE_IDS.sub(lambda match: f'{match[1]}{pseudonym(int(match[2]))}', value)
+    if isinstance(value, dict):
+        profile = 'first_name' in value or 'last_name' in value
+        return {k: _ids(v) if profile and k == 'id' else anonymize(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize(item, key) for item in value]
+    return value
+
+
+def anonymize_event(raw: List[Any]) -> List[Any]:
+
+    """ Raw LongPoll update: [code, message id, flags, peer id, time, text, extra values, attachments] """
+
+    raw = list(raw)
+    if len(raw) > 3 and isinstance(raw[3], int):
+        raw[3] = pseudonym(raw[3])
+    if len(raw) > 6 and isinstance(raw[6], dict):
+        raw[6] = {k: str(pseudonym(int(v))) if k == 'from' and str(v).isdigit() else v for k, v in raw[6].items()}
+    if len(raw) > 7:
+        raw[7] = {}
+    return raw
+
+
+def call_key(method: str, values: Dict[str, Any]) -> str:
+    values = {k: v for k, v in (values or {}).items() if k != 'random_id'}
+    return f'{method}:{json.dumps(values, sort_keys=True, ensure_ascii=False, default=str)}'
+
+
+class Recorder:
+
+    """ Writes the events and the API calls of a running bot to a trace file """
+
+    def __init__(self, path: str):
+        self.file = open(path, 'a', encoding='utf-8')
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        record['t'] = round(time.monotonic() - self.started, 4)
+        with self.lock:
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            self.file.flush()
+
+    def events(self, events: Iterable[Event]) -> Iterable[Event]:
+        for event in events:
+            self._write({'kind': 'event', 'raw': anonymize_event(event.raw)})
+            yield event
+
+    def call(self, session, method: str, values: Dict[str, Any], send: Callable[[], Any]) -> Any:
+        try:
+            response = send()
+        except ApiError as error:
+            self._write({'kind': 'call', 'method': method, 'values': anonymize(values),
+                         'error': anonymize(error.error)})
+            raise
+        self._write({'kind': 'call', 'method': method, 'values': anonymize(values),
+                     'response': None if method in UNKEYED else anonymize(response)})
+        return response
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class Player:
+
+    """ Serves the recorded events and answers and measures the replies of the bot """
+
+    def __init__(self, path: str, speed: float = 1):
+        self.speed = speed
+        self.events_list = []
+        self.answers = defaultdict(deque)
+        self.by_method = defaultdict(deque)
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['kind'] == 'event':
+                    self.events_list.append(record)
+                else:
+                    # [taken, error, response]; the same answer is queued by its values and by its method
+                    answer = [False, record.get('error'), record.get('response')]
+                    self.answers[call_key(record['method'], record['values'])].append(answer)
+                    self.by_method[record['method']].append(answer)
+
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.misses = Counter()
+        self.waiting = {}
+        self.latencies = []
+        self.started = None
+        self.finished = None
+
+    def events(self) -> Iterable[Event]:
+        self.started = time.monotonic()
+        for record in self.events_list:
+            delay = self.started + record['t'] / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            event = Event(record['raw'])
+            user_id = getattr(event, 'user_id', None)
+            if user_id and getattr(event, 'to_me', False):
+                with self.lock:
+                    self.waiting.setdefault(user_id, time.monotonic())
+            yield event
+        self.finished = time.monotonic()
+        raise TraceEnd
+
+    def call(self, session, method: str, values: Dict[str, Any], send: Callable[[], Any]) -> Any:
+        with self.lock:
+            self.calls[method] += 1
+            if method == 'messages.send':
+                sent_at = self.waiting.pop(values.get('user_id') or values.get('peer_id'), None)
+                if sent_at is not None:
+                    self.latencies.append(time.monotonic() - sent_at)
+
+            answer = self._take(self.answers.get(call_key(method, values))) or self._take(self.by_method.get(method))
+            if not answer:
+                if method in UNKEYED:
+                    return 0
+                self.misses[method] += 1
+                raise TraceMiss(session, method, values)
+            answer[0] = True
+            _, error, response = answer
+
+        if error:
+            raise ApiError(session, method, values, False, error)
+        return response
+
+    @staticmethod
+    def _take(queue):
+        while queue and queue[0][0]:
+            queue.popleft()
+        return queue.popleft() if queue else None
+
+    def report(self) -> str:
+        duration = (self.finished or time.monotonic()) - (self.started or time.monotonic())
+        latencies = sorted(self.latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+
+        lines = [
+            f'Events: {len(self.events_list)} in {duration:.2f} s '
+            f'({len(self.events_list) / duration if duration else 0:.1f} events/s), speed x{self.speed:g}',
+            f'API calls: {sum(self.calls.values())} '
+            f'({sum(self.calls.values()) / duration if duration else 0:.1f} calls/s)',
+            f'Reply latency, ms: p50 {percentile(0.5):.1f}, p90 {percentile(0.9):.1f}, '
+            f'p99 {percentile(0.99):.1f}, max {percentile(1):.1f} ({len(latencies)} replies)',
+        ]
+        for method, count in self.calls.most_common():
+            lines.append(f'    {method}: {count}')
+        if self.misses:
+            lines.append(f'Calls missing from the trace: {dict(self.misses)}')
+        return '\n'.join(lines)
+
+
+def replay(path: str, speed: float = 1) -> Player:
+
+    """ Running the dialogue loop of a Bot over the trace until its events are over """
+
+    # no real session is created: the user token is a placeholder and every call is answered by the player
+    os.environ.setdefault('VK_USER_TOKEN', 'replay')
+
+    from main_bot.rate_limit import LimitedVkApi
+    from main_bot.vk_bot import Bot, serve
+
+    player = Player(path, speed)
+    LimitedVkApi.tape = player
+    try:
+        serve(Bot(events=player.events()))
+    except (TraceEnd, TraceMiss):
+        # a miss the dialogue does not handle ends the replay, the report shows it
+        pass
+    finally:
+        LimitedVkApi.tape = None
+    return player
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Replay of a recorded trace of the bot')
+    parser.add_argument('trace', help='JSON-lines file written by run_bot.py --record')
+    parser.add_argument('--speed', type=float, default=1, help='1, 10, 100... times faster than recorded')
+    args = parser.parse_args()
+
+    now = datetime.now()
+    print(replay(args.trace, args.speed).report())
+    print(datetime.now() - now)
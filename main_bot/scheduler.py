@@ -0,0 +1,167 @@
+""" Background re-run of saved searches.
+
+Off-peak (VKINDER_OFF_PEAK, hours of the local time, "1-7" by default) the latest search of every user
+which has not been run for VKINDER_RESEARCH_HOURS is repeated: new people are appended as candidates
+of the query and the photos of the first of them are fetched into the photo cache.
+Only the users who have talked to the bot during the last VKINDER_RESEARCH_ACTIVE_DAYS are served,
+so the searches of those who left stop being repeated and their history can be archived.
+Users with new people get one notification, sent to up to 100 users at once with "peer_ids".
+A search which failed (VK is unavailable) does not count as finding anyone.
+
+The scheduler runs as a thread of the bot (VKINDER_SCHEDULER=1) so that the photo cache it warms
+is the one the dialogues read; it can also be run once from cron: python -m main_bot.scheduler """
+
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from random import randrange
+from typing import List, NamedTuple, Tuple
+
+from sqlalchemy import func
+
+from db.database import Connect, Query, SearchState, User
+from main_bot.breaker import VK_FAILURES
+from main_bot.keyboards import keyboards
+from main_bot.main_menu import VKDatingUser
+
+logger = logging.getLogger(__name__)
+
+OFF_PEAK = tuple(int(hour) for hour in os.getenv("VKINDER_OFF_PEAK", '1-7').split('-'))
+ENABLED = os.getenv("VKINDER_SCHEDULER") == '1'
+RESEARCH_AFTER = timedelta(hours=int(os.getenv("VKINDER_RESEARCH_HOURS", 24)))
+ACTIVE_FOR = timedelta(days=int(os.getenv("VKINDER_RESEARCH_ACTIVE_DAYS", 14)))
+INTERVAL = int(os.getenv("VKINDER_SCHEDULER_INTERVAL", 15 * 60))
+BATCH_SIZE = int(os.getenv("VKINDER_SCHEDULER_BATCH", 100))
+PREFETCH_PHOTOS = int(os.getenv("VKINDER_SCHEDULER_PHOTOS", 10))
+
+# maximum number of recipients of one messages.send
+PEER_IDS_LIMIT = 100
+
+NOTIFICATION = ('&#128276; По твоему последнему поиску нашлись новые люди! '
+                'Нажми «Результаты последнего поиска», чтобы посмотреть.')
+
+
+class SavedUser(NamedTuple):
+
+    """The owner of a saved search: the search needs only the id, not the VK profile"""
+
+    user_id: int
+
+
+def off_peak(now: datetime = None) -> bool:
+    start, end = OFF_PEAK
+    hour = (now or datetime.now()).hour
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class Scheduler:
+
+    def __init__(self, bot):
+        self.bot = bot
+        # the thread must not share the session of the dialogues
+        self.bot.session = Connect.Session()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def due_searches(self, now: datetime) -> List[Tuple[int, Query]]:
+
+        """ The latest search of every recently active user, if it has not been run recently """
+
+        session = self.bot.session
+        latest = session.query(SearchState.user_id, func.max(SearchState.last_run).label('last_run')
+                               ).group_by(SearchState.user_id).subquery()
+        return (session.query(SearchState.user_id, Query)
+                .join(latest, (latest.c.user_id == SearchState.user_id) & (latest.c.last_run == SearchState.last_run))
+                .join(Query, Query.id == SearchState.query_id)
+                .join(User, User.id == SearchState.user_id)
+                .filter(SearchState.last_run < now - RESEARCH_AFTER, User.last_seen >= now - ACTIVE_FOR)
+                .order_by(SearchState.last_run)
+                .limit(BATCH_SIZE)
+                .all())
+
+    def research(self, user_id: int, query: Query) -> int:
+
+        """ Repeats the search, warms the photos of the first new people; returns the number of new people """
+
+        values = {'city': query.city_id, 'sex': query.sex_id, 'age_from': query.age_from,
+                  'age_to': query.age_to, 'status': query.status_id, 'sort': query.sort_id}
+        collected = self.bot._collect_candidates(SavedUser(user_id), values, incremental=True, append=True)
+        if not collected:
+            return 0
+        # nobody new, or the search fell back to the stored candidates
+        query_id, new_users = collected
+        if not new_users:
+            return 0
+        self.bot.store_candidates(user_id, query_id, new_users)
+
+        dating_users = self.bot.get_datingusers_from_db(user_id, query_id) or []
+        VKDatingUser.get_photos_batch(dating_users[:PREFETCH_PHOTOS])
+        return len(new_users)
+
+    def notify(self, user_ids: List[int]) -> None:
+        for start in range(0, len(user_ids), PEER_IDS_LIMIT):
+            recipients = user_ids[start:start + PEER_IDS_LIMIT]
+            peer_ids = ','.join(str(user_id) for user_id in recipients)
+            try:
+                self.bot.vk_bot.method('messages.send', {'peer_ids': peer_ids, 'message': NOTIFICATION,
+                                                         'random_id': randrange(10 ** 7),
+                                                         'keyboard': keyboards.get('welcome_back')})
+            except VK_FAILURES as error:
+                logger.warning('Notification of %s users is not sent: %s', len(recipients), error)
+
+    def run_once(self) -> int:
+
+        """ One pass over the due searches; returns the number of notified users """
+
+        notified = []
+        for user_id, query in self.due_searches(datetime.utcnow()):
+            if self.stopped.is_set():
+                break
+            try:
+                if self.research(user_id, query):
+                    notified.append(user_id)
+            except Exception:
+                self.bot.session.rollback()
+                logger.exception('Saved search of user %s failed', user_id)
+        self.notify(notified)
+        return len(notified)
+
+    def _loop(self) -> None:
+        while not self.stopped.wait(INTERVAL):
+            if not off_peak():
+                continue
+            # a failed pass must not end the thread, the next one may succeed
+            try:
+                logger.info('Saved searches: %s users notified', self.run_once())
+            except Exception:
+                self.bot.session.rollback()
+                logger.exception('Pass of the saved searches failed')
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._loop, name='vkinder-scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+def start_scheduler():
+
+    """ Starting the scheduler thread of the process, if it is enabled """
+
+    if not ENABLED:
+        return None
+    from main_bot.vk_bot import Bot
+    scheduler = Scheduler(Bot(events=iter(())))
+    scheduler.start()
+    return scheduler
+
+
+if __name__ == '__main__':
+
+    from main_bot.vk_bot import Bot
+
+    now = datetime.now()
+    print(f'Users notified: {Scheduler(Bot(events=iter(()))).run_once()}')
+    print(datetime.now() - now)
@@ -0,0 +1,68 @@
+""" Streaming delivery of search results.
+
+The first viable candidate is stored and sent to the user right after the VK search returns,
+while the rest of the found people are written to the database and their photos are prefetched
+in a background thread. """
+
+import threading
+from typing import Any, Dict, Iterator, List
+
+from db.database import Candidate, Decision
+from main_bot.breaker import VK_FAILURES
+from main_bot.main_menu import VKDatingUser
+
+# how many of the next candidates get their photos fetched in advance
+PREFETCH_PHOTOS = 3
+
+
+class SearchStream:
+
+    """Iterable of the candidates of a search, available before all of them are stored"""
+
+    def __init__(self, bot, user_id: int, query_id: int, new_users: List[Dict[str, Any]], found: int):
+        self.bot = bot
+        self.user_id = user_id
+        self.query_id = query_id
+        self.new_users = new_users
+        self.found = found
+        self._ingest = None
+
+    def __iter__(self) -> Iterator[VKDatingUser]:
+        rows = list(self.new_users)
+        first = None
+        if rows:
+            row = rows.pop(0)
+            self.bot.upsert(Candidate, [row])
+            decision = self.bot.insert_to_db(Decision, {'user_id': self.user_id, 'vk_id': row['vk_id'],
+                                                        'query_id': self.query_id, 'viewed': False})
+            first = VKDatingUser(decision.id, row['vk_id'], row['first_name'], row['last_name'], row['link'])
+
+        self._ingest = threading.Thread(target=self._store, args=(rows,), name=f'ingest-{self.query_id}')
+        self._ingest.start()
+
+        if first:
+            first.photos = first.get_photo()
+            yield first
+
+        # the rest of the candidates are read back once they are stored; the first one is still pending
+        self._ingest.join()
+        for d_user in self.bot.get_datingusers_from_db(self.user_id, self.query_id) or []:
+            if first is None or d_user.db_id != first.db_id:
+                yield d_user
+
+    def _store(self, rows: List[Dict[str, Any]]) -> None:
+
+        """ Background part: bulk insert with a separate session and prefetch of photos """
+
+        session = self.bot.Session()
+        try:
+            self.bot.store_candidates(self.user_id, self.query_id, rows, session=session)
+        finally:
+            session.close()
+
+        prefetch = [VKDatingUser(None, row['vk_id'], row['first_name'], row['last_name'], row['link'])
+                    for row in rows[:PREFETCH_PHOTOS]]
+        try:
+            VKDatingUser.get_photos_batch(prefetch)
+        except VK_FAILURES:
+            pass
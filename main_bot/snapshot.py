@@ -0,0 +1,167 @@
+""" Warm restart of the bot.
+
+On shutdown (SIGTERM, Ctrl+C or the end of the program) the state kept in memory is written to a local
+file (VKINDER_SNAPSHOT, "vkinder.snapshot" by default, an empty value turns it off):
+    - the VK profiles of the users in dialogue, so they are not requested again,
+    - the fresh part of the photo cache and of the geo cache,
+    - the messages received but not answered yet, and the position in VkLongPoll, so the messages sent
+      to the bot during the restart are answered after it.
+On startup the file is read and removed: a snapshot is applied once and never after a crash.
+The place of a user in a dialogue is not saved: the user who was in the middle of a dialogue is told
+that the bot was restarted, and their saved messages, which answer the questions of that dialogue,
+are dropped. The others are greeted again with the menu.
+
+The file is a gzip-compressed pickle of plain data, written to a temporary file and renamed,
+so a snapshot is either complete or absent. Only the built-in types and datetime are unpickled. """
+
+import atexit
+import gzip
+import logging
+import os
+import pickle
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from itertools import chain
+from typing import Any, Dict, Optional
+
+from vk_api.longpoll import Event
+
+from main_bot.main_menu import VKDatingUser, VKUser
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = os.getenv("VKINDER_SNAPSHOT", 'vkinder.snapshot')
+# an older snapshot is ignored; unanswered messages and the LongPoll position are kept for a shorter time
+MAX_AGE = int(os.getenv("VKINDER_SNAPSHOT_MAX_AGE", 24 * 60 * 60))
+EVENTS_MAX_AGE = 10 * 60
+VERSION = 1
+
+
+class _Unpickler(pickle.Unpickler):
+
+    """Unpickler of plain data: a snapshot file cannot make it import or call anything"""
+
+    ALLOWED = {('datetime', 'datetime')}
+
+    def find_class(self, module, name):
+        if (module, name) not in self.ALLOWED:
+            raise pickle.UnpicklingError(f'{module}.{name} is not allowed in a snapshot')
+        return super().find_class(module, name)
+
+
+def new_state(**fields) -> Dict[str, Any]:
+    return {'version': VERSION, 'saved': time.time(), **fields}
+
+
+class Snapshot:
+
+    def __init__(self, path: str = SNAPSHOT_PATH, photos: bool = True):
+        self.path = path
+        # in the multi-process mode the shared photo cache is saved by one worker
+        self.photos = photos
+
+    def collect(self, bot) -> Dict[str, Any]:
+        state = new_state(
+            users=[user.snapshot() for user in list(bot.users.values())],
+            geo={key: entry for key, entry in list(bot.geo_cache.memory.items()) if entry[0] > datetime.utcnow()},
+            events=[],
+            longpoll_ts=None,
+            dialogue_user=getattr(bot, 'dialogue_user', None),
+        )
+        now = state['saved']
+        if self.photos:
+            cache = VKDatingUser.photo_cache
+            state['photos'] = {vk_id: entry for vk_id, entry in list(cache.storage.items())
+                               if now - entry[0] <= cache.ttl}
+        if bot.inbox is not None:
+            with bot.inbox.condition:
+                state['events'] = [event.raw for queue in bot.inbox.queues.values() for event in queue]
+        longpoll = getattr(bot, 'longpoll', None)
+        if longpoll is not None:
+            state['longpoll_ts'] = longpoll.ts
+        return state
+
+    def save(self, bot) -> None:
+        if self.path:
+            self.write(self.collect(bot))
+
+    def write(self, state: Dict[str, Any]) -> None:
+        temporary = f'{self.path}.tmp'
+        with gzip.open(temporary, 'wb', compresslevel=5) as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.path)
+        logger.info('Snapshot saved: %s users, %s photos, %s messages', len(state.get('users', ())),
+                    len(state.get('photos', ())), len(state.get('events', ())))
+
+    def load(self) -> Optional[Dict[str, Any]]:
+
+        """ The snapshot, if there is a usable one; the file is removed in any case """
+
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with gzip.open(self.path, 'rb') as f:
+                state = _Unpickler(f).load()
+        except (OSError, EOFError, pickle.UnpicklingError) as error:
+            logger.warning('Snapshot %s is not read: %s', self.path, error)
+            state = None
+        finally:
+            os.remove(self.path)
+
+        if not isinstance(state, dict) or state.get('version') != VERSION \
+                or time.time() - state.get('saved', 0) > MAX_AGE:
+            return None
+        return state
+
+    @staticmethod
+    def fresh_events(state: Dict[str, Any]) -> bool:
+
+        """ Whether the unanswered messages and the LongPoll position of the snapshot are still worth using """
+
+        return time.time() - state['saved'] <= EVENTS_MAX_AGE
+
+    def restore(self, bot) -> bool:
+        state = self.load()
+        if state is None:
+            return False
+
+        for fields in state.get('users', ()):
+            user = VKUser.restore(fields)
+            bot.users[user.user_id] = user
+        bot.geo_cache.memory.update(state.get('geo', {}))
+        if 'photos' in state:
+            VKDatingUser.photo_cache.storage.update(state['photos'])
+
+        # the answers to the questions of an interrupted dialogue would start a new one
+        dialogue_user = state.get('dialogue_user')
+        events = [Event(raw) for raw in state.get('events', ())]
+        events = [event for event in events if getattr(event, 'user_id', None) != dialogue_user]
+        if dialogue_user in bot.users:
+            bot.write_msg(dialogue_user, '&#128260; Бот был перезапущен, поэтому начнём сначала.',
+                          keyboard=bot.empty_keyboard)
+
+        if self.fresh_events(state):
+            # the unanswered messages go before the new ones
+            if events:
+                bot.events = chain(events, bot.events)
+            bot.longpoll_ts = state.get('longpoll_ts')
+
+        logger.info('Snapshot restored: %s users, %s photos, %s messages', len(state.get('users', ())),
+                    len(state.get('photos', ())), len(events))
+        return True
+
+
+def warm_restart(bot, path: str = SNAPSHOT_PATH) -> Snapshot:
+
+    """ Restoring the snapshot into the bot and saving it again when the process exits """
+
+    snapshot = Snapshot(path)
+    snapshot.restore(bot)
+    atexit.register(snapshot.save, bot)
+    # SIGTERM ends the process without running atexit unless it is turned into an exit
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    return snapshot
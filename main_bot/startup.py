@@ -0,0 +1,126 @@
+""" Cold-start benchmark of the bot.
+
+Every run starts a fresh interpreter which imports the bot, creates a Bot and answers one "Привет"
+of a new user, with VK answered locally (no network), and reports:
+    import   - import of main_bot.vk_bot,
+    cities   - prepare_city_search(): the trigram index of cities built in memory when its file is missing,
+    bot      - creation of the Bot (reference data and keyboards),
+    reply    - the first messages.send, counted from the start of the interpreter.
+The slowest imports are listed from "python -X importtime".
+
+    python -m main_bot.startup --runs 5
+
+The database is the configured one; with VKINDER_DB_URL=memory the reference tables are filled
+from db/fix/primary_data.json. """
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+USER_ID = 1
+PROFILE = {'id': USER_ID, 'first_name': 'Иван', 'last_name': 'Иванов', 'sex': 2, 'domain': 'id1',
+           'city': {'id': 1, 'title': 'Москва'}, 'country': {'id': 1, 'title': 'Россия'}}
+
+
+class FirstReply(Exception):
+    pass
+
+
+class LocalVk:
+
+    """Answers of VK for the cold start: the profile of the user and the sending of a message"""
+
+    def __init__(self, started: float):
+        self.started = started
+        self.replied = None
+
+    def call(self, session, method, values, send):
+        if method == 'users.get':
+            return [PROFILE]
+        if method == 'messages.send':
+            self.replied = time.perf_counter() - self.started
+            raise FirstReply
+        return {'count': 0, 'items': []}
+
+
+def child() -> None:
+
+    """ One cold start, run in a fresh interpreter; prints the timings as JSON """
+
+    started = time.perf_counter()
+
+    from main_bot.vk_bot import Bot, prepare_city_search, serve
+    imported = time.perf_counter()
+
+    # like main(), before the Bot
+    prepare_city_search()
+    cities_built = time.perf_counter()
+
+    from vk_api.longpoll import Event
+    from main_bot.rate_limit import LimitedVkApi
+
+    local_vk = LimitedVkApi.tape = LocalVk(started)
+
+    bot_started = time.perf_counter()
+    bot = Bot(events=iter([Event([4, 1, 1, USER_ID, int(time.time()), 'Привет', {}, {}])]))
+    bot_created = time.perf_counter()
+
+    try:
+        serve(bot)
+    except FirstReply:
+        pass
+    print(json.dumps({'import': imported - started, 'cities': cities_built - imported, 'bot': bot_created - bot_started,
+                      'reply': local_vk.replied}))
+
+
+def _run(*options: str) -> subprocess.CompletedProcess:
+    env = dict(os.environ, VK_USER_TOKEN=os.getenv('VK_USER_TOKEN') or 'startup')
+    return subprocess.run([sys.executable, *options, '-m', 'main_bot.startup', '--child'],
+                          env=env, capture_output=True, text=True, check=True)
+
+
+def slowest_imports(count: int = 10):
+
+    """ Modules with the largest cumulative import time, in microseconds """
+
+    imports = []
+    for line in _run('-X', 'importtime').stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def benchmark(runs: int) -> None:
+    results = [json.loads(_run().stdout.splitlines()[-1]) for _ in range(runs)]
+    for stage in ('import', 'cities', 'bot', 'reply'):
+        values = [result[stage] * 1000 for result in results if result[stage] is not None]
+        if values:
+            print(f'{stage:>7}: median {statistics.median(values):8.1f} ms, max {max(values):8.1f} ms')
+        else:
+            print(f'{stage:>7}: no reply')
+
+    print('Slowest imports (cumulative):')
+    for cumulative, name in slowest_imports():
+        print(f'{cumulative / 1000:8.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Cold-start benchmark of the bot')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child()
+    else:
+        now = datetime.now()
+        benchmark(args.runs)
+        print(datetime.now() - now)
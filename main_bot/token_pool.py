@@ -0,0 +1,137 @@
+""" Pool of VK user tokens used for the heavy search and photo requests.
+
+Tokens are taken from the VK_USER_TOKENS variable (comma separated) in addition to the main user token.
+Every call goes to the least loaded healthy token; tokens that hit a captcha, flood control
+or a rate limit are taken out of rotation for a while, and a token whose circuit breaker is open
+is skipped. Every token has its own rate limits
+(main_bot.rate_limit), so the buckets of the tokens are created here, before the workers are forked. """
+
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import date
+from typing import Any, Dict, List, Optional
+
+from vk_api.exceptions import ApiError, Captcha, VkApiError
+
+from main_bot.breaker import CircuitOpen
+from main_bot.rate_limit import LimitedVkApi, TOKEN_RATES, limiter
+
+# error code -> seconds for which the token is taken out of rotation
+COOLDOWNS = {
+    6: 60,          # too many requests per second
+    9: 60 * 60,     # flood control
+    14: 10 * 60,    # captcha needed
+    29: 6 * 60 * 60,  # rate limit of the method is reached
+}
+
+# calls per day allowed for a single token, 0 - no limit
+DAILY_QUOTAS = {
+    'users.search': int(os.getenv("VKINDER_SEARCH_QUOTA", 0)),
+    'photos.get': int(os.getenv("VKINDER_PHOTOS_QUOTA", 0)),
+}
+
+
+class TokenPoolExhausted(VkApiError):
+    """ All tokens of the pool are out of rotation """
+
+
+class PooledToken:
+
+    """A token of the pool with its health and usage counters"""
+
+    def __init__(self, name: str, session: LimitedVkApi):
+        self.name = name
+        self.session = session
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.disabled_until = 0.0
+        self.quota_day = date.today()
+        self.quota_used = defaultdict(int)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.disabled_until
+
+    def has_quota(self, method: str) -> bool:
+        if self.quota_day != date.today():
+            self.quota_day = date.today()
+            self.quota_used.clear()
+        quota = DAILY_QUOTAS.get(method)
+        return not quota or self.quota_used[method] < quota
+
+    def disable(self, seconds: float) -> None:
+        self.failures += 1
+        self.disabled_until = time.monotonic() + seconds
+
+
+class TokenPool:
+
+    """Least-loaded balancing of VK calls between user tokens"""
+
+    def __init__(self, tokens: List[PooledToken]):
+        self.tokens = tokens
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, session: LimitedVkApi) -> 'TokenPool':
+
+        """ The main user session plus sessions of the tokens from VK_USER_TOKENS """
+
+        tokens = [PooledToken(session.bucket, session)]
+        extra_tokens = [token.strip() for token in os.getenv("VK_USER_TOKENS", '').split(',') if token.strip()]
+        for number, token in enumerate(extra_tokens, start=1):
+            name = f'user:{number}'
+            limiter.add_token(name, TOKEN_RATES['user'])
+            tokens.append(PooledToken(name, LimitedVkApi(token=token, bucket=name)))
+        return cls(tokens)
+
+    def _select(self, method: str, exclude: set) -> Optional[PooledToken]:
+        with self._lock:
+            candidates = [token for token in self.tokens
+                          if token.name not in exclude and token.healthy and token.has_quota(method)]
+            if not candidates:
+                return None
+            token = min(candidates, key=lambda t: (t.in_flight, t.calls))
+            token.in_flight += 1
+            token.calls += 1
+            token.quota_used[method] += 1
+            return token
+
+    def method(self, method: str, values: Dict[str, Any] = None) -> Any:
+
+        """ Calls the VK method with the least loaded token, switching tokens on captcha and rate errors """
+
+        tried = set()
+        last_error = None
+        while True:
+            token = self._select(method, tried)
+            if token is None:
+                if last_error:
+                    raise last_error
+                raise TokenPoolExhausted(f'No VK user token is available for {method}')
+            tried.add(token.name)
+            # with other tokens at hand error 6 is not waited out on the same token
+            retries = 0 if len(self.tokens) > 1 else None
+            try:
+                return token.session.method(method, values=values, retries=retries)
+            except Captcha as error:
+                token.disable(COOLDOWNS[14])
+                last_error = error
+            except CircuitOpen as error:
+                last_error = error
+            except ApiError as error:
+                if error.code not in COOLDOWNS:
+                    raise
+                token.disable(COOLDOWNS[error.code])
+                last_error = error
+            finally:
+                with self._lock:
+                    token.in_flight -= 1
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [{'name': token.name, 'healthy': token.healthy, 'in_flight': token.in_flight,
+                 'calls': token.calls, 'failures': token.failures, 'quota_used': dict(token.quota_used)}
+                for token in self.tokens]
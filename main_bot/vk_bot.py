@@ -4,63 +4,123 @@
     - sending search results for processing,
     - delivery of results to the user """
 
+import itertools
+import json
+import logging
 import os
-import re
-from datetime import datetime
+from datetime import datetime, timedelta
 from random import randrange
-from typing import Dict, Any, Tuple, List
+from typing import Dict, Any, Tuple, List, Iterable, NamedTuple, Optional
 
-import vk_api
+from sqlalchemy import func
 from vk_api.keyboard import VkKeyboard, VkKeyboardColor
-from vk_api.longpoll import VkLongPoll, VkEventType
-
-from db.database import User, City, Status, Sex, Sort, Query, DatingUser, Country, Region, Connect
+from vk_api.longpoll import VkLongPoll
+
+from db.database import User, City, Status, Sex, Sort, Query, Candidate, Decision, Country, Region, Connect, \
+    SearchState
+from db.city_search import SUGGESTIONS, city_search, prepare_city_search
+from db.geo_index import GeoCity, geo_index
+from db.reference import reference
+from main_bot.breaker import VK_FAILURES
+from main_bot.concurrency import limits
+from main_bot.geo_cache import GeoCache
+from main_bot.inbox import AnswerTimeout, Inbox, InboxClosed
 from main_bot.main_menu import VKUser, VKDatingUser, VKAuth
+from main_bot.keyboards import CAROUSEL_SIZE, LABEL_LENGTH, carousel, carousel_element, keyboards, scan_request
+from main_bot.rate_limit import LimitedVkApi
+from main_bot.search_stream import SearchStream
+
+logger = logging.getLogger(__name__)
+
+# window of the incremental search and the age of the last search after which everything is requested again
+SEARCH_WINDOW = 100
+# users.search "sort": the newest profiles come first only in the order of the registration date,
+# so only such searches are repeated incrementally
+SORT_BY_DATE = 1
+
+# people per message in the lists of liked and disliked people (each line is about 100 characters,
+# so a page stays below the 4096 characters limit of a VK message)
+PAGE_SIZE = 20
+FULL_SEARCH_INTERVAL = timedelta(days=int(os.getenv("VKINDER_FULL_SEARCH_DAYS", 7)))
+
+# seconds the dialogue waits for its user's answer while other users are waiting
+ANSWER_TIMEOUT = float(os.getenv("VKINDER_ANSWER_TIMEOUT", 5 * 60))
+
+# "messages": a candidate per message with a question; "carousel": up to 10 candidates per message
+DELIVERY = os.getenv("VKINDER_DELIVERY", 'messages')
 
 
 class Bot(VKAuth, Connect):
-    def __init__(self):
+    def __init__(self, events=None):
 
         # укажите Ваш токен сообщества Вконтакте вместо os.getenv("VKINDER_TOKEN")
         TOKEN = os.getenv("VKINDER_TOKEN")
-        self.vk_bot = vk_api.VkApi(token=TOKEN)
-        self.longpoll = VkLongPoll(self.vk_bot)
+        self.vk_bot = LimitedVkApi(token=TOKEN, bucket='group')
+
+        # events may come from another source (e.g. a supervisor process), otherwise we listen to VkLongPoll
+        if events is None:
+            events = self._longpoll_events()
+        self.events = events
+        self.inbox = None
+        # the user of the dialogue in progress, only their messages are taken from the inbox
+        self.dialogue_user = None
+        # position in VkLongPoll to continue from, e.g. after a warm restart
+        self.longpoll_ts = None
         self.empty_keyboard = VkKeyboard().get_empty_keyboard()
+
+        # static prompts are served from memory: reference tables and keyboards are prepared at startup
+        reference.load()
+        keyboards.build_all()
+        self.geo_cache = GeoCache()
         self.users = {}
 
+    def _longpoll_events(self):
+
+        """ VkLongPoll connects to its server when the first event is awaited, not when the bot is created """
+
+        self.longpoll = VkLongPoll(self.vk_bot)
+        if self.longpoll_ts:
+            self.longpoll.ts = self.longpoll_ts
+        yield from self.longpoll.listen()
 
     def _check_city_and_region(self, user) -> None:
         """A method for checking the presence of a city and a region in the database.
          If there is no data - collection and addition to the database"""
 
-        if not self.select_from_db(City.id, City.id == user.city['id']).first():
+        index = geo_index()
+        if index and index.city(user.city['id']):
+            return
+        if not self.geo_cache.city_known(user.city['id']):
             city, region = self._get_city(user.country['id'], user.city['title'])
-            if not self.select_from_db(Region.id, Region.id == region['id']).first():
-                self.insert_to_db(Region, region)
-            self.insert_to_db(City, city)
+            if city:
+                self.geo_cache.write_through(city, region)
 
     def _get_region(self, country_id: int, region_title: str) -> Dict[str, Any]:
 
         """ Method for searching the user's region if the data is not in the database """
 
         search_values = {'country_id': country_id, 'q': region_title}
-        return self.vk_session.method('database.getRegions', values=search_values)
+        return self.geo_cache.lookup('database.getRegions', search_values,
+                                     lambda: self.vk_session.method('database.getRegions', values=search_values))
 
     def _get_city(self, country_id, city_title):
 
         """ Method for finding the user's city, if the data is not in the database """
 
         search_values = {'country_id': country_id, 'q': city_title, 'need_all': 1}
-        city = self.vk_session.method('database.getCities', values=search_values)
+        city = self.geo_cache.lookup('database.getCities', search_values,
+                                     lambda: self.vk_session.method('database.getCities', values=search_values))
         city_items = city['items']
         if city_items:
-            city_items = city_items[0]
+            # the answer is held by the geo cache, the region is added to a copy
+            city_items = dict(city_items[0])
             region_title = city_items.get('region')
             if region_title:
                 region_title = region_title.split()[0]
                 region = self._get_region(country_id, region_title)
-                region_items = region['items'][0]
-                region_items.update({'country_id': country_id})
+                if not region['items']:
+                    return city_items, None
+                region_items = dict(region['items'][0], country_id=country_id)
                 city_items['region_id'] = region_items['id']
                 return city_items, region_items
             return city_items, None
@@ -77,28 +137,30 @@ class Bot(VKAuth, Connect):
         if keyboard:
             values['keyboard'] = keyboard
 
-        self.vk_bot.method('messages.send', values)
+        try:
+            self.vk_bot.method('messages.send', values)
+        except VK_FAILURES as error:
+            logger.warning('Message to %s is not sent: %s', user_id, error)
 
-    def listen_msg(self, scan=True):
+    def listen_msg(self, scan=True, payload=False):
 
         """Waiting for messages from the user and processing them.
-        The method monitors events in VKLongPoll
-        and at the first event from the user initializes its VKUser instance """
+        The method takes the messages collected from VKLongPoll by the inbox
+        and at the first message from the user initializes its VKUser instance.
+        During a dialogue only the messages of its user are taken.
+        With payload=True the payload of the pressed button (or None) is returned as well """
 
-        def scan_request(event):
+        if self.inbox is None:
+            self.inbox = Inbox(self.events)
+            self.inbox.start()
+            # unanswered messages let the concurrency limits grow
+            limits.watch(self.inbox)
 
-            request = event.text.lower().strip()
-            query = re.findall(r'([А-Яа-яЁёA-Za-z0-9]+)', request)
-            if len(query) > 1:
-                query = ' '.join(query)
+        while True:
+            if self.dialogue_user is None:
+                event = self.inbox.get()
             else:
-                try:
-                    query = query[0]
-                except IndexError:
-                    query = request
-            return query
-
-        for event in self.longpoll.listen():
+                event = self.inbox.get(self.dialogue_user, ANSWER_TIMEOUT)
             try:
                 user = self.users.get(event.user_id)
                 if not user:
@@ -107,13 +169,22 @@ class Bot(VKAuth, Connect):
                 if not user.welcomed:
                     self.welcome_user(user)
 
-                if event.type == VkEventType.MESSAGE_NEW:
-                    if event.to_me:
-                        if scan is True:
-                            return scan_request(event), user
-                        return event.text, user
-            except AttributeError:
-                pass
+                text = scan_request(event.text) if scan is True else event.text
+                if payload:
+                    return text, user, button_payload(event)
+                return text, user
+            except VK_FAILURES as error:
+                # the user will be welcomed with the next message
+                logger.warning('Message of %s is skipped: %s', event.user_id, error)
+
+    def listen_answer(self) -> 'Answer':
+
+        """Waiting for a message and finding its command: from the payload of the pressed button
+        or, for a typed message, from the button with the same label"""
+
+        text, user, payload = self.listen_msg(scan=False, payload=True)
+        payload = payload or keyboards.command(text) or {}
+        return Answer(payload.get('command'), payload.get('id'), text.strip(), user)
 
     def create_user(self, id):
         self.users[id] = VKUser(id)
@@ -123,6 +194,8 @@ class Bot(VKAuth, Connect):
     def check_user_city(self, user):
 
         self._check_city_and_region(user)
+        # the user's row refers to the city, so it must be written already
+        self.geo_cache.ensure(user.city['id'])
 
         # we check if the user wants to change the city
         user_db_city = self.select_from_db(User.city_id, User.id == user.user_id).first()
@@ -148,11 +221,64 @@ class Bot(VKAuth, Connect):
             'sort_id': search_values['sort'],
             'user_id': user_id
         }
-        self.insert_to_db(Query, fields)
+        # the id comes back from the INSERT itself (RETURNING or lastrowid), not from a search of the latest row
+        return self.insert_to_db(Query, fields).id
+
+    def search_users(self, vk_user, values: Dict[str, Any] = None, incremental: bool = True):
 
-        return self.select_from_db(Query.id, Query.id == Query.id).order_by(Query.datetime.desc()).first()[0]
+        """ Search of people by the conditions and recording of new candidates in the database """
 
-    def search_users(self, vk_user, values: Dict[str, Any] = None):
+        collected = self._collect_candidates(vk_user, values, incremental)
+        if not collected:
+            return
+        query_id, new_users = collected
+        self.store_candidates(vk_user.user_id, query_id, new_users)
+
+        d_users = self._count_pending(query_id)
+        if not d_users:
+            return
+        return d_users, query_id
+
+    def search_stream(self, vk_user, values: Dict[str, Any] = None, incremental: bool = True):
+
+        """ The same search, but the first candidate is delivered to the user at once
+        while the rest of them are stored in the background """
+
+        collected = self._collect_candidates(vk_user, values, incremental)
+        if not collected:
+            return
+        query_id, new_users = collected
+        found = len(new_users) + self._count_pending(query_id)
+        if not found:
+            return
+        return SearchStream(self, vk_user.user_id, query_id, new_users, found)
+
+    def _count_pending(self, query_id: int) -> int:
+        return self.select_from_db(func.count(Decision.id), (Decision.query_id == query_id,
+                                                             Decision.viewed.is_(False))).scalar()
+
+    def store_candidates(self, user_id: int, query_id: int, candidates: List[Dict[str, Any]], session=None) -> None:
+
+        """ Recording found people: the profile is stored once per VK id,
+        the user gets a pending decision for every one of them """
+
+        if not candidates:
+            return
+        session = session or self.session
+        self.upsert(Candidate, candidates, session=session)
+        decisions = [{'user_id': user_id, 'vk_id': candidate['vk_id'], 'query_id': query_id, 'viewed': False}
+                     for candidate in candidates]
+        session.bulk_insert_mappings(Decision, decisions)
+        session.commit()
+
+    def _collect_candidates(self, vk_user, values: Dict[str, Any] = None, incremental: bool = True,
+                            append: bool = False):
+
+        """ Requests people by the conditions and returns the query id with the rows of new candidates.
+        If the user has already searched with the same conditions sorted by date, only the newest profiles
+        are requested and the candidates are appended to the previous query.
+        With append=True (a repeated search of the scheduler) they are appended to it whatever the sort order.
+        If VK fails, the query of the previous search is returned with no new candidates """
 
         search_values = {
             'city': 1,
@@ -171,68 +297,109 @@ class Bot(VKAuth, Connect):
         if values:
             search_values.update(values)
 
-        users_list = self.vk_session.method('users.search', values=search_values)['items']
+        criteria = search_criteria(search_values)
+        state = self.select_from_db(SearchState, (SearchState.user_id == vk_user.user_id,
+                                                  SearchState.criteria == criteria)).first()
+        incremental = (incremental and search_values['sort'] == SORT_BY_DATE and state
+                       and datetime.utcnow() - state.last_run < FULL_SEARCH_INTERVAL)
 
-        if not users_list:
-            return
-        query_id = self.insert_query(vk_user.user_id, search_values)
-        d_users = 0
-        for user in users_list:
-            if user['is_closed'] == 1:
-                continue
+        # everyone who has ever been found for this user
+        seen = {row[0] for row in self.select_from_db(Decision.vk_id, Decision.user_id == vk_user.user_id)}
 
-            user['vk_id'] = user.pop('id')
-            user['city_id'] = search_values['city']
-            user['city_title'] = self.select_from_db(City.title, City.id == search_values['city']).first()[0]
-            user['link'] = 'https://vk.com/' + user.pop('domain')
-            user['verified'] = user.get('verified')
-            user['query_id'] = query_id
-            user['viewed'] = False
-
-            user.pop('is_closed')
-            user.pop('can_access_closed')
-            user.pop('track_code')
-
-            shown_user = self.select_from_db(DatingUser.viewed, (DatingUser.vk_id == user['vk_id'],
-                                                                 DatingUser.query_id == query_id)).first()
-            if shown_user:
-                if shown_user[0] is True:
-                    continue
-                elif shown_user[0] is False:
-                    last_query = self.select_from_db(Query.id,
-                                                     Query.user_id == user.user_id).order_by(
-                        Query.datetime.desc()).first()[0]
-
-                    self.update_data(DatingUser.id,
-                                     expression=(DatingUser.vk_id == user['vk_id'],
-                                                 DatingUser.query_id == last_query,
-                                                 DatingUser.viewed.is_(False)),
-                                     fields={DatingUser.query_id: query_id})
-                    d_users += 1
+        try:
+            if incremental:
+                users_list = self._search_newest(search_values, seen)
             else:
-                self.insert_to_db(DatingUser, user)
-                d_users += 1
+                users_list = self.token_pool.method('users.search', values=search_values)['items']
+        except VK_FAILURES as error:
+            # the candidates stored by the previous run of the search are shown instead
+            if not state:
+                raise
+            logger.warning('Search of %s falls back to stored candidates: %s', vk_user.user_id, error)
+            return state.query_id, []
+
+        if incremental or (append and state):
+            query_id = state.query_id
+            self.update_data(Query.id, Query.id == query_id, {Query.datetime: datetime.utcnow()})
+        else:
+            if not users_list:
+                return
+            query_id = self.insert_query(vk_user.user_id, search_values)
 
-        return d_users, query_id
+            # candidates found earlier but not shown yet go to the new query
+            self.update_data(Decision.id,
+                             expression=(Decision.user_id == vk_user.user_id,
+                                         Decision.vk_id.in_([user['id'] for user in users_list]),
+                                         Decision.viewed.is_(False)),
+                             fields={Decision.query_id: query_id})
 
-    def show_results(self, user, results: Tuple[int, int] = None, datingusers: List[VKDatingUser] = None):
+        city_title = self.select_from_db(City.title, City.id == search_values['city']).first()[0]
+        new_users = []
+        for user in users_list:
+            if user['is_closed'] == 1 or user['id'] in seen:
+                continue
+            seen.add(user['id'])
+            new_users.append({
+                'vk_id': user['id'],
+                'first_name': user['first_name'],
+                'last_name': user['last_name'],
+                'city_id': search_values['city'],
+                'city_title': city_title,
+                'link': 'https://vk.com/' + user['domain'],
+                'verified': user.get('verified')
+            })
+
+        if state:
+            self.update_data(SearchState.id, SearchState.id == state.id,
+                             {SearchState.query_id: query_id, SearchState.last_run: datetime.utcnow(),
+                              SearchState.found: len(new_users)})
+        else:
+            self.insert_to_db(SearchState, {'user_id': vk_user.user_id, 'criteria': criteria, 'query_id': query_id,
+                                            'last_run': datetime.utcnow(), 'found': len(new_users)})
+        return query_id, new_users
+
+    def _search_newest(self, search_values: Dict[str, Any], seen: set) -> List[Dict[str, Any]]:
+
+        """ Requests the newest profiles (the search is sorted by date) window by window
+        until a window brings nobody new """
+
+        values = dict(search_values, count=SEARCH_WINDOW, offset=0)
+        users_list = []
+        while values['offset'] < search_values['count']:
+            items = self.token_pool.method('users.search', values=values)['items']
+            new_items = [user for user in items if user['id'] not in seen and not user['is_closed']]
+            users_list.extend(new_items)
+            if len(items) < SEARCH_WINDOW or not new_items:
+                break
+            values['offset'] += SEARCH_WINDOW
+        return users_list
+
+    def show_results(self, user, results: Tuple[int, int] = None, datingusers: Iterable[VKDatingUser] = None):
+
+        if results:
+            remainder = results[0] % 10
+            if remainder == 0 or remainder >= 5 or (10 <= results[0] <= 19) or (10 <= results[0] % 100 <= 19):
+                var = 'вариантов'
+            elif remainder == 1:
+                var = 'вариант'
+            else:
+                var = 'варианта'
+            self.write_msg(user.user_id, f'&#129395;Мы нашли {results[0]} {var}!!! &#129395;')
 
         if datingusers:
             dating_users = datingusers
+        elif results:
+            dating_users = self.get_datingusers_from_db(user.user_id, results[1])
         else:
-            if results:
-                remainder = results[0] % 10
-                if remainder == 0 or remainder >= 5 or (10 <= results[0] <= 19) or (10 <= results[0] % 100 <= 19):
-                    var = 'вариантов'
-                elif remainder == 1:
-                    var = 'вариант'
-                else:
-                    var = 'варианта'
-                self.write_msg(user.user_id, f'&#129395;Мы нашли {results[0]} {var}!!! &#129395;')
-                query_id = results[1]
-                dating_users = self.get_datingusers_from_db(user.user_id, query_id)
-            else:
-                dating_users = self.get_datingusers_from_db(user.user_id)
+            dating_users = self.get_datingusers_from_db(user.user_id)
+
+        if DELIVERY == 'carousel' and dating_users:
+            return self._show_carousel(user, dating_users)
+        return self._show_messages(user, dating_users)
+
+    def _show_messages(self, user, dating_users: Iterable[VKDatingUser]):
+
+        """ Candidates one by one: the profile with photos, then a question with the keyboard """
 
         if dating_users:
             # get a list of users from the database
@@ -255,34 +422,29 @@ class Bot(VKAuth, Connect):
                     message = f'{name} {link} \n Фотографий нет.\n'
                     photos = ''
 
-                keyboard = VkKeyboard(one_time=False)
-                keyboard.add_button("Да", color=VkKeyboardColor.POSITIVE)
-                keyboard.add_button("Нет", color=VkKeyboardColor.NEGATIVE)
-                keyboard.add_line()
-                keyboard.add_button("Отмена", color=VkKeyboardColor.SECONDARY)
-                keyboard = keyboard.get_keyboard()
+                keyboard = keyboards.get('decision')
                 if photos:
                     self.write_msg(user.user_id, message=message, attachment=photos)
                 else:
                     self.write_msg(user.user_id, message=message)
                 self.write_msg(user.user_id, message='Нравится?', keyboard=keyboard)
 
-                expected_answers = ['да', 'нет', 'отмена']
-                answer = self.listen_msg()[0]
+                expected_answers = {'yes', 'no', 'cancel'}
+                answer = self.listen_answer().command
                 while answer not in expected_answers:
                     self.write_msg(user.user_id, "&#128280; Попробуй использовать кнопки! &#128280;",
                                    keyboard=keyboard)
-                    answer = self.listen_msg()[0]
+                    answer = self.listen_answer().command
                 else:
-                    if answer == "да":
-                        fields = {DatingUser.viewed: True, DatingUser.black_list: False}
-                        self.update_data(DatingUser.id, DatingUser.id == d_user.db_id, fields=fields)
+                    if answer == "yes":
+                        fields = {Decision.viewed: True, Decision.black_list: False}
+                        self.update_data(Decision.id, Decision.id == d_user.db_id, fields=fields)
                         return 'Пришло время для новых знакомств!'
-                    elif answer == "нет":
-                        fields = {DatingUser.viewed: True, DatingUser.black_list: True}
-                        self.update_data(DatingUser.id, DatingUser.id == d_user.db_id, fields=fields)
+                    elif answer == "no":
+                        fields = {Decision.viewed: True, Decision.black_list: True}
+                        self.update_data(Decision.id, Decision.id == d_user.db_id, fields=fields)
                         return 'обнови страницу и попробуй заного'
-                    elif answer == "отмена":
+                    elif answer == "cancel":
                         self.write_msg(user.user_id, "Попробуем еще?  &#128540;",
                                        keyboard=self.empty_keyboard)
                         return
@@ -290,104 +452,201 @@ class Bot(VKAuth, Connect):
                        keyboard=self.empty_keyboard)
         return
 
+    def _show_carousel(self, user, dating_users: Iterable[VKDatingUser]):
+
+        """ Candidates in carousels of up to 10 with "like" and "dislike" buttons under every profile.
+        A decision is taken from the payload of the button and is not answered, "Ещё" shows the next carousel.
+        If VK does not accept the carousel, the rest of the candidates is shown by messages """
+
+        self.write_msg(user.user_id, '&#128071; Отмечай, кто нравится, кнопками под анкетами. '
+                                     '«Ещё» — следующие анкеты.', keyboard=keyboards.get('carousel'))
+        dating_users = iter(dating_users)
+        while True:
+            batch = list(itertools.islice(dating_users, CAROUSEL_SIZE))
+            if not batch:
+                break
+            buttons = self._send_carousel(user, batch)
+            if buttons is None:
+                return self._show_messages(user, itertools.chain(batch, dating_users))
+
+            pending = {d_user.db_id for d_user in batch}
+            while pending:
+                answer = self.listen_answer()
+                command, db_id = answer.command, answer.value
+                if command is None:
+                    command, db_id = buttons.get(scan_request(answer.text), (None, None))
+                if command in ('like', 'dislike') and db_id in pending:
+                    fields = {Decision.viewed: True, Decision.black_list: command == 'dislike'}
+                    self.update_data(Decision.id, Decision.id == db_id, fields=fields)
+                    pending.discard(db_id)
+                elif command == 'more':
+                    break
+                elif command == 'cancel':
+                    self.write_msg(user.user_id, "Попробуем еще?  &#128540;", keyboard=self.empty_keyboard)
+                    return
+                elif command not in ('like', 'dislike'):
+                    self.write_msg(user.user_id, "&#128280; Попробуй использовать кнопки! &#128280;",
+                                   keyboard=keyboards.get('carousel'))
+
+        self.write_msg(user.user_id, "&#128564; Поиск завершен. Начать новый поиск?  &#128540;",
+                       keyboard=self.empty_keyboard)
+
+    def _send_carousel(self, user, batch: List[VKDatingUser]) -> Optional[Dict[str, Tuple[str, int]]]:
+
+        """ Sending a carousel of the candidates; returns the commands of its buttons by their text
+        (for clients which do not send the payload), None if VK has not accepted it.
+        The best photos are shown if every candidate has one and VK accepts them (the format of VK requires
+        13:8 pictures), otherwise the carousel is sent without photos """
+
+        VKDatingUser.get_photos_batch(batch)
+        buttons = {}
+        elements = []
+        for d_user in batch:
+            name = f'{d_user.first_name} {d_user.last_name}'
+            like, dislike = f'Нравится {name}', f'Не нравится {name}'
+            buttons[scan_request(like[:LABEL_LENGTH])] = ('like', d_user.db_id)
+            buttons[scan_request(dislike[:LABEL_LENGTH])] = ('dislike', d_user.db_id)
+            elements.append(carousel_element(
+                name, d_user.link, d_user.link,
+                [(like, VkKeyboardColor.POSITIVE, {'command': 'like', 'id': d_user.db_id}),
+                 (dislike, VkKeyboardColor.NEGATIVE, {'command': 'dislike', 'id': d_user.db_id})]))
+
+        attempts = [elements]
+        if all(d_user.photos for d_user in batch):
+            photo_ids = [f'{d_user.photos[0][1]}_{d_user.photos[0][0]}' for d_user in batch]
+            attempts.insert(0, [dict(element, photo_id=photo_id) for element, photo_id in zip(elements, photo_ids)])
+
+        for attempt in attempts:
+            values = {'user_id': user.user_id, 'message': 'Кто нравится?', 'template': carousel(attempt),
+                      'random_id': randrange(10 ** 7)}
+            try:
+                self.vk_bot.method('messages.send', values)
+                return buttons
+            except VK_FAILURES as error:
+                logger.warning('Carousel to %s is not sent: %s', user.user_id, error)
+        return None
+
     def get_datingusers_from_db(self, user_id, query_id=None, blacklist=None):
 
         fields = (
-            DatingUser.id,
-            DatingUser.vk_id,
-            DatingUser.first_name,
-            DatingUser.last_name,
-            DatingUser.link,
+            Decision.id,
+            Candidate.vk_id,
+            Candidate.first_name,
+            Candidate.last_name,
+            Candidate.link,
         )
 
         if query_id:
-            vk_users = self.select_from_db(fields, (DatingUser.query_id == query_id,
-                                                    DatingUser.viewed.is_(False))).all()
+            vk_users = self.select_from_db(fields, (Decision.query_id == query_id,
+                                                    Decision.viewed.is_(False)), join=Candidate).all()
         else:
             if blacklist is None:
                 query_id = self.select_from_db(Query.id,
                                                Query.user_id == user_id).order_by(Query.datetime.desc()).first()[0]
-                vk_users = self.select_from_db(fields, (DatingUser.query_id == query_id,
-                                                        DatingUser.viewed.is_(False))).all()
-
-            elif blacklist is False:
-                vk_users = self.select_from_db(model_fields=fields,
-                                               join=Query,
-                                               expression=(Query.user_id == user_id, DatingUser.black_list.is_(False)))
+                vk_users = self.select_from_db(fields, (Decision.query_id == query_id,
+                                                        Decision.viewed.is_(False)), join=Candidate).all()
 
             else:
                 vk_users = self.select_from_db(model_fields=fields,
-                                               join=Query,
-                                               expression=(Query.user_id == user_id, DatingUser.black_list.is_(True)))
+                                               join=Candidate,
+                                               expression=(Decision.user_id == user_id,
+                                                           Decision.black_list.is_(blacklist))).all()
         if vk_users:
             dating_users = [VKDatingUser(user[0], user[1], user[2], user[3], user[4]) for user in vk_users]
             return dating_users
         return
 
+    def get_datingusers_page(self, user_id: int, blacklist: bool, after_id: int = 0,
+                             page_size: int = PAGE_SIZE) -> Tuple[List[VKDatingUser], Optional[int]]:
+
+        """ A page of liked (blacklist=False) or disliked (blacklist=True) people.
+        Keyset pagination: the page starts after the given id, the cursor of the next page is returned
+        (None on the last page) """
+
+        fields = (
+            Decision.id,
+            Candidate.vk_id,
+            Candidate.first_name,
+            Candidate.last_name,
+            Candidate.link,
+        )
+
+        rows = self.select_from_db(model_fields=fields,
+                                   join=Candidate,
+                                   expression=(Decision.user_id == user_id,
+                                               Decision.black_list.is_(blacklist),
+                                               Decision.id > after_id)
+                                   ).order_by(Decision.id).limit(page_size + 1).all()
+
+        next_cursor = rows[page_size - 1][0] if len(rows) > page_size else None
+        return [VKDatingUser(*row) for row in rows[:page_size]], next_cursor
+
+    def show_list(self, user, blacklist: bool) -> None:
+
+        """ Paged view of the liked or disliked people, the next page is sent on request """
+
+        cursor, num = 0, 0
+        while cursor is not None:
+            dating_users, cursor = self.get_datingusers_page(user.user_id, blacklist, after_id=cursor)
+            if not dating_users:
+                break
+
+            lines = []
+            for num, d_user in enumerate(dating_users, start=num + 1):
+                lines.append(f'{num}. {d_user}')
+            message = '\n'.join(lines)
+
+            if cursor is None:
+                self.write_msg(user.user_id, message, keyboard=self.empty_keyboard)
+                break
+            self.write_msg(user.user_id, message, keyboard=keyboards.get('next_page'))
+
+            expected_answers = {'next_page', 'cancel'}
+            answer = self.listen_answer().command
+            while answer not in expected_answers:
+                self.write_msg(user.user_id, "&#128280; Используй кнопки. &#128280;", keyboard=keyboards.get('next_page'))
+                answer = self.listen_answer().command
+            if answer == 'cancel':
+                break
+
                 #dialogue methods
 
     def welcome_user(self, user):
 
-        keyboard = VkKeyboard(one_time=False)
         user_in_db = user.select_from_db(User.id, User.id == user.user_id).first()
 
         if not user_in_db:
             user.insert_self_to_db()
 
-            keyboard.add_button("Привет", color=VkKeyboardColor.SECONDARY)
-            keyboard.add_button("Новый поиск", color=VkKeyboardColor.POSITIVE)
-
             self.write_msg(user.user_id, f"&#9995;  Привет, {user.first_name.capitalize()}! &#128515;",
-                           keyboard=keyboard.get_keyboard())
+                           keyboard=keyboards.get('welcome'))
 
         else:
-            check_query = user.select_from_db(Query.id, Query.user_id == user.user_id).all()
+            self.update_data(User.id, User.id == user.user_id, {User.last_seen: datetime.utcnow()})
+            check_query = user.select_from_db(Query.id, Query.user_id == user.user_id).first()
             if not check_query:
-
-                keyboard.add_button("Привет", color=VkKeyboardColor.SECONDARY)
-                keyboard.add_button("Новый поиск", color=VkKeyboardColor.POSITIVE)
-
                 self.write_msg(user.user_id,
                                f"&#128522; Привет, {user.first_name.capitalize()}! Попробуем поискать кого-нибудь?",
-                               keyboard=keyboard.get_keyboard())
+                               keyboard=keyboards.get('welcome'))
             else:
-                keyboard.add_button("Привет", color=VkKeyboardColor.SECONDARY)
-                keyboard.add_button("Новый поиск", color=VkKeyboardColor.POSITIVE)
-                keyboard.add_line()
-                keyboard.add_button(f"Результаты последнего поиска", color=VkKeyboardColor.SECONDARY)
-                keyboard.add_line()
-                keyboard.add_button(f"Все, кто понравился", color=VkKeyboardColor.POSITIVE)
-                keyboard.add_button(f"кто не понравился", color=VkKeyboardColor.NEGATIVE)
                 self.write_msg(user.user_id,
                                f"&#128522; Привет, {user.first_name.capitalize()}! Попробуем поискать кого-нибудь?",
-                               keyboard=keyboard.get_keyboard())
+                               keyboard=keyboards.get('welcome_back'))
         user.welcomed = True
         return user.welcomed
 
     def get_sex(self, user):
 
-        sex = [name[0] for name in user.select_from_db(Sex.title, Sex.id == Sex.id).all()]
-        sex.append("Отмена")
-
-        keyboard = VkKeyboard(one_time=False)
-        keyboard.add_button(sex[1].capitalize(), VkKeyboardColor.NEGATIVE)
-        keyboard.add_button(sex[2].capitalize(), VkKeyboardColor.PRIMARY)
-        keyboard.add_line()
-        keyboard.add_button(sex[0].capitalize(), VkKeyboardColor.SECONDARY)
-        keyboard.add_button('Отмена', VkKeyboardColor.NEGATIVE)
-        keyboard = keyboard.get_keyboard()
-
-        self.write_msg(user.user_id, f'Людей какого пола мы будем искать?', keyboard=keyboard)
-
-        answer = self.listen_msg()[0].strip().lower()
+        self.write_msg(user.user_id, f'Людей какого пола мы будем искать?', keyboard=keyboards.get('sex'))
 
-        while answer not in sex:
+        answer = self.listen_answer()
+        while answer.command not in ('sex', 'cancel'):
             self.write_msg(user.user_id, '&#129300; Извините, я не разобрал. Выберите ответ повторно. &#128071;')
-            answer = self.listen_msg()[0].strip().lower()
+            answer = self.listen_answer()
         else:
-            if answer == "отмена":
+            if answer.command == "cancel":
                 return
-            return sex.index(answer)
+            return answer.value
 
     def get_city(self, user):
 
@@ -396,171 +655,172 @@ class Bot(VKAuth, Connect):
                                      f'самый Нью-Йорк следует написать так: '
                                      f'New York City.',
                        keyboard=cancel_button())
+        answer = self.listen_answer()
         while True:
-            answer = self.listen_msg(scan=False)[0].strip().lower()
-            if answer == "отмена":
+            if answer.command == "cancel":
                 return
-            try:
-                symbol = re.search(r'\W', answer)[0]
-                words = re.split(symbol, answer)
-                if len(words) < 3:
-                    for word in words:
-                        words[words.index(word)] = word.capitalize()
-                    answer = symbol.join(words)
-                else:
-                    if '-' == symbol:
-                        words[0] = words[0].capitalize()
-                        words[-1] = words[-1].capitalize()
-                        answer = symbol.join(words)
-                    else:
-                        answer = answer.title()
-            except TypeError:
-                answer = answer.capitalize()
 
-            city = user.select_from_db(City, City.title.startswith(answer)).order_by(City.region).all()
+            city = self._find_cities(answer.text)
+            if city:
+                return self._choose_city(user, city)
+
+            index = city_search()
+            suggestions = index.search(answer.text) if index else []
+            if suggestions:
+                self.write_msg(user.user_id, f'Я не нашёл такого города. Возможно, ты имел в виду один из этих?',
+                               keyboard=self._city_choice(suggestions))
+                answer = self.listen_answer()
+                chosen = self._chosen_city(answer, suggestions)
+                if chosen:
+                    return chosen
+                continue
 
-            if not city:
-                self.write_msg(user.user_id, f'&#128530; Я не знаю такого города... '
-                                             f'Выбери другой или попробуй написать иначе. '
-                                             f'Не забывай про пробелы и дефисы')
-            else:
-                break
+            self.write_msg(user.user_id, f'&#128530; Я не знаю такого города... '
+                                         f'Выбери другой или попробуй написать иначе.', keyboard=cancel_button())
+            answer = self.listen_answer()
+
+    def _city_label(self, num: int, city: GeoCity) -> str:
+        if city.region and city.region != city.title:
+            return f'{num} - {city.title}, {city.region}'
+        return f'{num} - {city.title}, {self._country_title(city)}'
+
+    def _city_choice(self, cities: List[GeoCity]) -> str:
+        return keyboards.choice((self._city_label(num, found), {'command': 'city', 'id': found.id})
+                                for num, found in enumerate(cities, start=1))
+
+    def _chosen_city(self, answer: 'Answer', cities: List[GeoCity]) -> Optional[int]:
+
+        """ Id of the city picked by its button or by its number """
+
+        if answer.command == 'city' and any(city.id == answer.value for city in cities):
+            return answer.value
+        number = answer.text.split(' ', 1)[0]
+        if number.isdigit() and 1 <= int(number) <= len(cities):
+            return cities[int(number) - 1].id
+        return None
+
+    def _choose_city(self, user, city: List[GeoCity]) -> Optional[int]:
 
         if len(city) == 1:
             return city[0].id
-        elif len(city) > 1:
-            self.write_msg(user.user_id, f'Нужно уточнить, какой город ты имеешь в виду:')
-            ids = [(city.id, city.title) for city in city]
-            ids.sort(key=lambda x: x[0])
-            cities = {}
-
-            message_list = []
-            message = ''
-
-            for num, (id, title) in enumerate(ids, start=1):
-                cities[str(num)] = id
-
-                try:
-                    region_name, region_id, area = user.select_from_db((City.region, City.region_id, City.area),
-                                                                       City.id == id).first()
-
-                    country = user.select_from_db(Country.title, Region.id == region_id,
-                                                  join=(Region, Country.id == Region.country_id)).first()[0]
-                except TypeError:
-                    area = None
-                    region_name = 'Нет информации'
-                    country = 'Нет информации'
-
-                if area:
-                    string = f'{num} - {title}, {region_name}, {area} ({country})\n'
-                else:
-                    string = f'{num} - {title}, {region_name} ({country})\n'
-
-                if len(message + string) > 4097:  # maximum length of a VK message
-                    message_list.append(message)
-                    message = ''
-                message += string
-            message_list.append(message)
-            for message in message_list:
-                self.write_msg(user.user_id, message)
-
-            expected_answers = [str(i) for i in range(1, len(city) + 1)]
-            answer = self.listen_msg()[0].strip()
-            expected_answers.append('отмена')
-            while answer not in expected_answers:
-                self.write_msg(user.user_id, f'Мне нужен один из порядковых номеров, которые ты видишь чуть выше.')
-                answer = self.listen_msg()[0].strip()
+
+        self.write_msg(user.user_id, f'Нужно уточнить, какой город ты имеешь в виду:')
+        city = sorted(city, key=lambda x: x.id)
+
+        message_list = []
+        message = ''
+
+        for num, found in enumerate(city, start=1):
+            title, area = found.title, found.area
+            region_name = found.region or 'Нет информации'
+            country = self._country_title(found)
+
+            if area:
+                string = f'{num} - {title}, {region_name}, {area} ({country})\n'
             else:
-                if answer == "отмена":
-                    return
-                return cities[answer]
+                string = f'{num} - {title}, {region_name} ({country})\n'
+
+            if len(message + string) > 4097:  # maximum length of a VK message
+                message_list.append(message)
+                message = ''
+            message += string
+        message_list.append(message)
+        keyboard = None
+        if len(city) <= SUGGESTIONS:
+            keyboard = self._city_choice(city)
+        for number, message in enumerate(message_list, start=1):
+            self.write_msg(user.user_id, message, keyboard=keyboard if number == len(message_list) else None)
+
+        answer = self.listen_answer()
+        while not self._chosen_city(answer, city):
+            if answer.command == "cancel":
+                return
+            self.write_msg(user.user_id, f'Мне нужен один из порядковых номеров, которые ты видишь чуть выше.')
+            answer = self.listen_answer()
+        return self._chosen_city(answer, city)
+
+    def _find_cities(self, answer: str) -> List[GeoCity]:
+
+        """ Cities whose title starts with the answer: from the geo index if it is built, otherwise from the DB.
+        The DB is also asked when the index has no such city: cities resolved through VK after the index
+        was built are written to the DB only """
+
+        index = geo_index()
+        if index:
+            cities = index.find(answer)
+            if cities:
+                return cities
+        cities = self.select_from_db(City, func.lower(City.title).startswith(answer.lower()))
+        cities = cities.order_by(City.region).all()
+        return [GeoCity(city.id, city.title, city.area, city.region, city.region_id, None, city.important)
+                for city in cities]
+
+    def _country_title(self, city: GeoCity) -> str:
+        index = geo_index()
+        title = index.country_title(city.country_id) if index and city.country_id else None
+        if title:
+            return title
+        country = self.select_from_db(Country.title, Region.id == city.region_id,
+                                      join=(Region, Country.id == Region.country_id)).first()
+        return country[0] if country else 'Нет информации'
 
     def get_age_from(self, user):
 
         self.write_msg(user.user_id, f'Укажи минимальный возраст в цифрах.', keyboard=cancel_button())
         while True:
-            answer = self.listen_msg()[0].strip().lower()
+            answer = self.listen_answer()
+            if answer.command == "cancel":
+                return
             try:
-                answer = int(answer)
+                age = int(answer.text)
             except ValueError:
-                if answer == "отмена":
-                    return
-                else:
-                    self.write_msg(user.user_id, f'Укажи минимальный возраст в цифрах!')
-            return abs(answer)
+                self.write_msg(user.user_id, f'Укажи минимальный возраст в цифрах!')
+            else:
+                return abs(age)
 
     def get_age_to(self, user):
 
         self.write_msg(user.user_id, f'Укажи максимальный возраст в цифрах или отправь 0, если это неважно.',
                        keyboard=cancel_button())
         while True:
-            answer = self.listen_msg()[0].strip().lower()
+            answer = self.listen_answer()
+            if answer.command == "cancel":
+                return
             try:
-                answer = int(answer)
+                age = int(answer.text)
             except ValueError:
-                if answer == "отмена":
-                    return
-                else:
-                    self.write_msg(user.user_id,
-                                   f'Укажи максимальный возраст в цифрах или отправь 0, если это неважно.')
+                self.write_msg(user.user_id,
+                               f'Укажи максимальный возраст в цифрах или отправь 0, если это неважно.')
             else:
-                if answer != 0:
-                    return abs(answer)
+                if age != 0:
+                    return abs(age)
                 return 100
 
     def get_status(self, user):
 
-        statuses = [name[0] for name in user.select_from_db(Status.title, Status.id == Status.id).all()]
-        statuses.append("Отмена")
-
-        keyboard = VkKeyboard(one_time=False)
-        keyboard.add_button(statuses[0], VkKeyboardColor.POSITIVE)
-        keyboard.add_button(statuses[1], VkKeyboardColor.PRIMARY)
-        keyboard.add_line()
-        keyboard.add_button(statuses[2], VkKeyboardColor.SECONDARY)
-        keyboard.add_button(statuses[3], VkKeyboardColor.NEGATIVE)
-        keyboard.add_line()
-        keyboard.add_button(statuses[5], VkKeyboardColor.POSITIVE)
-        keyboard.add_button(statuses[4], VkKeyboardColor.PRIMARY)
-        keyboard.add_line()
-        keyboard.add_button(statuses[6], VkKeyboardColor.SECONDARY)
-        keyboard.add_button(statuses[7], VkKeyboardColor.NEGATIVE)
-        keyboard.add_line()
-        keyboard.add_button("Отмена", VkKeyboardColor.NEGATIVE)
-        keyboard = keyboard.get_keyboard()
-
-        self.write_msg(user.user_id, f'Какой из статусов тебя интересует?', keyboard=keyboard)
-
-        answer = self.listen_msg(scan=False)[0].strip()
-
-        while answer not in statuses:
+        self.write_msg(user.user_id, f'Какой из статусов тебя интересует?', keyboard=keyboards.get('status'))
+
+        answer = self.listen_answer()
+        while answer.command not in ('status', 'cancel'):
             self.write_msg(user.user_id, '&#129300; Попробуй еще раз ... &#128071;')
-            answer = self.listen_msg()[0].strip()
+            answer = self.listen_answer()
         else:
-            if answer == "Отмена":
+            if answer.command == "cancel":
                 return
-            return statuses.index(answer) + 1
+            return answer.value
 
     def get_sort(self, user):
 
-        sort_names = [name[0] for name in user.select_from_db(Sort.title, Sort.id == Sort.id).all()]
-        sort_names.append("отмена")
-        keyboard = VkKeyboard(one_time=False)
-        keyboard.add_button(sort_names[0], VkKeyboardColor.POSITIVE)
-        keyboard.add_button(sort_names[1], VkKeyboardColor.PRIMARY)
-        keyboard.add_line()
-        keyboard.add_button("Отмена", VkKeyboardColor.NEGATIVE)
-        keyboard = keyboard.get_keyboard()
-        self.write_msg(user.user_id, f'Как отсортировать пользователей?', keyboard=keyboard)
-
-        answer = self.listen_msg()[0].strip()
-        while answer not in sort_names:
+        self.write_msg(user.user_id, f'Как отсортировать пользователей?', keyboard=keyboards.get('sort'))
+
+        answer = self.listen_answer()
+        while answer.command not in ('sort', 'cancel'):
             self.write_msg(user.user_id, '&#129300; Я не понимаю... Используй кнопки! &#128071;')
-            answer = self.listen_msg()[0].strip()
+            answer = self.listen_answer()
         else:
-            if answer == "отмена":
+            if answer.command == "cancel":
                 return
-            return sort_names.index(answer)
+            return answer.value
 
     def questionnaire(self, user, values=None, full=False) -> Dict[str, Any] or int:
 
@@ -614,46 +874,57 @@ class Bot(VKAuth, Connect):
 
     def initial_questionnaire(self, user, search_values) -> Tuple[int, int] or int:
 
-        expected_answers = ['да', 'нет']
-        answer = self.listen_msg()[0].strip()
+        expected_answers = {'yes', 'no'}
+        answer = self.listen_answer().command
         while answer not in expected_answers:
             self.write_msg(user.user_id, '&#129300; Я не понимаю... Просто скажи "да" или "нет" '
                                          'или используй кнопки! &#128071;')
-            answer = self.listen_msg()[0].strip()
+            answer = self.listen_answer().command
         else:
-            if answer == 'да':
-
-                keyboard = VkKeyboard(one_time=False)
-                keyboard.add_button("обычный", VkKeyboardColor.PRIMARY)
-                keyboard.add_button("подробный", VkKeyboardColor.SECONDARY)
-                keyboard.add_line()
-                keyboard.add_button("отмена", VkKeyboardColor.NEGATIVE)
-                keyboard = keyboard.get_keyboard()
-                self.write_msg(user.user_id, f"Какой вид поиска будем использовать? &#128071;", keyboard=keyboard)
-
-                expected_answers = ["обычный", "подробный", "отмена"]
-                answer = self.listen_msg()[0].strip()
+            if answer == 'yes':
+
+                self.write_msg(user.user_id, f"Какой вид поиска будем использовать? &#128071;",
+                               keyboard=keyboards.get('search_type'))
+
+                expected_answers = {"simple", "detailed", "cancel"}
+                answer = self.listen_answer().command
                 while answer not in expected_answers:
                     self.write_msg(user.user_id, '&#128280; Не понимаю... Используй кнопки. &#128280;')
-                    answer = self.listen_msg()[0].strip()
+                    answer = self.listen_answer().command
                 else:
-                    if answer == "обычный":
+                    if answer == "simple":
                         self.write_msg(user.user_id, f"&#128150; Прекрасный выбор! &#128150;")
                         return search_values
-                    elif answer == "подробный":
+                    elif answer == "detailed":
                         self.write_msg(user.user_id,
                                        f"&#128076; Хорошо! Тебе нужно будет ответить на несколько вопросов.")
                         return self.questionnaire(user, search_values)
                     else:
                         return
-            elif answer == 'нет':
+            elif answer == 'no':
                 return self.questionnaire(user, full=True)
 
     def start(self):
         """The main_bot method of the bot operation, which is responsible for the program
          of the user's dialogue with the bot."""
 
-        answer, user = self.listen_msg()
+        answer = self.listen_answer()
+        user = answer.user
+        self.dialogue_user = user.user_id
+
+        handlers = {
+            'hello': self._hello,
+            'new_search': self._new_search,
+            'last_results': self._last_results,
+            'liked': lambda user: self._show_list(user, blacklist=False),
+            'disliked': lambda user: self._show_list(user, blacklist=True),
+        }
+        while answer.command not in handlers:
+            self.write_msg(user.user_id, "&#128280; Не понимаю... Используй кнопки. &#128280;")
+            answer = self.listen_answer()
+        return handlers[answer.command](user)
+
+    def _hello(self, user):
 
         search_values = {
             'city': user.city['id'],
@@ -663,116 +934,157 @@ class Bot(VKAuth, Connect):
             'status': 6,
             'sort': 0,
         }
+        keyboard = keyboards.get('yes_no')
+
+        if user.sex == 2:
+            search_values['sex'] = 1
+            self.write_msg(user.user_id, f"Ищем девушку?", keyboard=keyboard)
+            search_values = self.initial_questionnaire(user, search_values)
+
+        elif user.sex == 1:
+            search_values['sex'] = 2
+            self.write_msg(user.user_id, f"Ищем парня?", keyboard=keyboard)
+            search_values = self.initial_questionnaire(user, search_values)
 
-        expected_answers = ['привет', 'новый поиск', "результаты последнего поиска",
-                            "все, кто понравился", "все, кто не понравился"]
-        while answer not in expected_answers:
-            self.write_msg(user.user_id, "&#128280; Не понимаю... Используй кнопки. &#128280;")
-            answer = self.listen_msg()[0]
         else:
-            if answer == "привет":
-                keyboard = VkKeyboard(one_time=False)
-                keyboard.add_button("Да", VkKeyboardColor.POSITIVE)
-                keyboard.add_button("Нет", VkKeyboardColor.NEGATIVE)
+            search_values = self.questionnaire(user, full=True)
+
+        if search_values:
+            return user, search_values
+        return user, None
+
+    def _new_search(self, user):
+        search_values = self.questionnaire(user, full=True)
+        if search_values:
+            return user, search_values
+        return user, None
+
+    def _last_results(self, user):
+        last_user_query = self.get_datingusers_from_db(user.user_id)
+        if last_user_query:
+            return user, last_user_query
+        return user
 
-                if user.sex == 2:
-                    search_values['sex'] = 1
-                    self.write_msg(user.user_id, f"Ищем девушку?", keyboard=keyboard.get_keyboard())
-                    search_values = self.initial_questionnaire(user, search_values)
+    def _show_list(self, user, blacklist: bool):
+        self.show_list(user, blacklist=blacklist)
+        return user
 
-                elif user.sex == 1:
-                    search_values['sex'] = 2
-                    self.write_msg(user.user_id, f"Ищем парня?", keyboard=keyboard.get_keyboard())
-                    search_values = self.initial_questionnaire(user, search_values)
 
-                else:
-                    search_values = self.questionnaire(user, full=True)
-
-                if search_values:
-                    return user, search_values
-                return user, None
-
-            elif answer == "новый поиск":
-                search_values = self.questionnaire(user, full=True)
-                if search_values:
-                    return user, search_values
-                return user, None
-
-            elif answer == "результаты последнего поиска":
-                last_user_query = self.get_datingusers_from_db(user.user_id)
-                if last_user_query:
-                    return user, last_user_query
-                return user
-
-            elif answer == "все, кто понравился":
-                liked_users = self.get_datingusers_from_db(user.user_id, blacklist=False)
-                if liked_users:
-                    message_list = []
-                    message = ''
-                    for num, d_user in enumerate(liked_users, start=1):
-                        if len(message + f'{num}. {d_user}\n') > 4097:
-                            message_list.append(message)
-                            message = ''
-                        message += f'{num}. {d_user}\n'
-                    message_list.append(message)
-                    for message in message_list:
-                        self.write_msg(user.user_id, message)
-                    return user, liked_users
-                return user
-
-            elif answer == "все, кто не понравился":
-                blacklist = self.get_datingusers_from_db(user.user_id, blacklist=True)
-                if blacklist:
-                    message_list = []
-                    message = ''
-                    for num, d_user in enumerate(blacklist, start=1):
-                        if len(message + f'{num}. {d_user}\n') > 4097:
-                            message_list.append(message)
-                            message = ''
-                        message += f'{num}. {d_user}\n'
-                    message_list.append(message)
-                    for message in message_list:
-                        self.write_msg(user.user_id, message)
-                    return user, blacklist
-                return user
-
-
-def cancel_button() -> VkKeyboard:
+class Answer(NamedTuple):
+
+    """A message of the user: the command and the value of the pressed button
+    (or of the button with the label equal to the typed text), the text itself and its sender"""
+
+    command: Optional[str]
+    value: Any
+    text: str
+    user: VKUser
+
+
+def button_payload(event) -> Optional[Dict[str, Any]]:
+
+    """Payload of the button which sent the message"""
+
+    try:
+        payload = json.loads(getattr(event, 'payload', None) or 'null')
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+
+def search_criteria(search_values: Dict[str, Any]) -> str:
+
+    """Key of the search conditions, the sort order does not matter for it"""
+
+    keys = ('sex', 'city', 'age_from', 'age_to', 'status')
+    return ':'.join(str(search_values[key]) for key in keys)
+
+
+def cancel_button() -> str:
 
     """Emergency exit button from the dialogue with the bot"""
 
-    keyboard = VkKeyboard(one_time=False)
-    keyboard.add_button("Отмена", color=VkKeyboardColor.NEGATIVE)
-    return keyboard.get_keyboard()
+    return keyboards.get('cancel')
 
 
-def main():
-    bot = Bot()
+def serve(bot):
+
+    """Endless loop of dialogues of the bot with users, until the events are over"""
+
     while True:
-        start = bot.start()
-        if isinstance(start, VKUser):
-            user = start
-            bot.write_msg(user.user_id, "&#128579; Поиск завершен. Начать новый? &#128373;",
-                          keyboard=bot.empty_keyboard)
-        else:
-            user, values = start
-            if isinstance(values, dict):
-                results = bot.search_users(user, values)
-                if not results:
-                    bot.write_msg(user.user_id,
-                                  f'&#128530; Похоже, что в этом городе нет никого, кто отвечал бы таким '
-                                  f'условиям поиска.\nПопробуй использовать подробный поиск или '
-                                  f'изменить условия запроса.', keyboard=bot.empty_keyboard)
-                else:
-                    bot.show_results(user, results=results)
+        try:
+            user = dialogue(bot)
+        except InboxClosed:
+            return
+        except AnswerTimeout as timeout:
+            user = bot.users[timeout.user_id]
+            bot.write_msg(user.user_id, '&#8987; Ответа долго не было, поэтому диалог завершён. '
+                                        'Напиши мне, чтобы начать сначала.', keyboard=bot.empty_keyboard)
+        finally:
+            bot.dialogue_user = None
+        user.welcomed = False
+
+
+def dialogue(bot) -> VKUser:
+
+    """One dialogue with a user: from the greeting to the search results"""
 
-            elif isinstance(values, list):
-                bot.show_results(user, datingusers=values)
-            elif not values:
+    start = bot.start()
+    if isinstance(start, VKUser):
+        user = start
+        bot.write_msg(user.user_id, "&#128579; Поиск завершен. Начать новый? &#128373;",
+                      keyboard=bot.empty_keyboard)
+        return user
+
+    user, values = start
+    if isinstance(values, dict):
+        try:
+            stream = bot.search_stream(user, values)
+        except VK_FAILURES as error:
+            logger.warning('Search of %s failed: %s', user.user_id, error)
+            bot.write_msg(user.user_id, f'&#128533; ВКонтакте сейчас не отвечает. Попробуй повторить поиск '
+                                        f'через несколько минут.', keyboard=bot.empty_keyboard)
+        else:
+            if not stream:
                 bot.write_msg(user.user_id,
-                              f'&#128521; Ок, начнём сначала!', keyboard=bot.empty_keyboard)
+                              f'&#128530; Похоже, что в этом городе нет никого, кто отвечал бы таким '
+                              f'условиям поиска.\nПопробуй использовать подробный поиск или '
+                              f'изменить условия запроса.', keyboard=bot.empty_keyboard)
+            else:
+                bot.show_results(user, results=(stream.found, stream.query_id), datingusers=stream)
 
-        user.welcomed = False
+    elif isinstance(values, list):
+        bot.show_results(user, datingusers=values)
+    elif not values:
+        bot.write_msg(user.user_id,
+                      f'&#128521; Ок, начнём сначала!', keyboard=bot.empty_keyboard)
+    return user
+
+
+def main(workers: int = 1, record: Optional[str] = None):
+    if workers > 1:
+        from main_bot.workers import Supervisor
+        Supervisor(workers).run()
+        return
+
+    from main_bot.scheduler import start_scheduler
+    from main_bot.snapshot import warm_restart
+    VKAuth.authorize()
+    prepare_city_search()
+    start_scheduler()
+    limits.start_report()
+    bot = Bot()
+    warm_restart(bot)
+    if record:
+        from main_bot.replay import Recorder
+        recorder = LimitedVkApi.tape = Recorder(record)
+        bot.events = recorder.events(bot.events)
+        try:
+            serve(bot)
+        finally:
+            recorder.close()
+    else:
+        serve(bot)
 
 
 if __name__ == '__main__':
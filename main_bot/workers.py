@@ -0,0 +1,185 @@
+""" Multi-process mode of the bot:
+    - the supervisor listens to VkLongPoll and routes every event to a worker process
+      by a consistent hash of the user id, so the dialogue of a user always stays on one worker,
+    - every worker runs its own Bot over the events of its shard of users,
+    - shared resources (DB connections, photo cache, VK rate limiter) are split or shared between the workers.
+On SIGTERM or Ctrl+C the supervisor asks the workers to finish (they ignore the signals themselves and save
+their snapshots), waits for them up to VKINDER_STOP_TIMEOUT seconds and saves the events not yet taken by
+the workers with the position in VkLongPoll; they are dispatched again on the next start. """
+
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue as queues
+import signal
+import sys
+import time
+
+from vk_api.longpoll import VkLongPoll, Event
+
+from db.city_search import prepare_city_search
+from db.database import Connect
+from main_bot.concurrency import limits
+from main_bot.main_menu import VKAuth, VKDatingUser
+from main_bot.rate_limit import LimitedVkApi
+from main_bot.scheduler import start_scheduler
+from main_bot.snapshot import SNAPSHOT_PATH, Snapshot, new_state
+from main_bot.vk_bot import Bot, serve
+
+logger = logging.getLogger(__name__)
+
+# total number of DB connections for all workers together
+DB_POOL_SIZE = int(os.getenv("VKINDER_DB_POOL_SIZE", 10))
+# seconds the workers are given to finish their dialogues and save their snapshots
+STOP_TIMEOUT = float(os.getenv("VKINDER_STOP_TIMEOUT", 30))
+
+
+class HashRing:
+
+    """Consistent hash ring mapping user ids to worker numbers.
+    Changing the number of workers moves only a small part of the users to other workers"""
+
+    def __init__(self, nodes: int, replicas: int = 100):
+        ring = sorted((self._hash(f'{node}:{replica}'), node) for node in range(nodes) for replica in range(replicas))
+        self._keys = [key for key, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def _hash(key) -> int:
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def get_node(self, user_id: int) -> int:
+        index = bisect.bisect(self._keys, self._hash(user_id)) % len(self._keys)
+        return self._nodes[index]
+
+
+def queue_events(queue):
+
+    """Turning raw LongPoll events received from the supervisor back into Event objects"""
+
+    for raw in iter(queue.get, None):
+        yield Event(raw)
+
+
+def run_worker(number: int, workers: int, queue) -> None:
+
+    """Entry point of a worker process"""
+
+    # the worker is stopped by the supervisor through its queue, after it has read all events sent to it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # connections of the parent process must not be reused after fork,
+    # and all workers together must not exceed the size of the DB pool
+    pool_size = max(1, DB_POOL_SIZE // workers)
+    Connect.reconnect(pool_size=pool_size, max_overflow=0)
+    limits.db.resize(pool_size)
+    limits.start_report()
+    # nor the HTTP connections of the VK sessions authorized by the supervisor
+    for token in VKAuth.token_pool.tokens:
+        token.session.http.close()
+    logger.info('Worker %s started (pid %s)', number, os.getpid())
+    if number == 0:
+        # saved searches are re-run by one worker; it shares the photo cache with the others
+        start_scheduler()
+    bot = Bot(events=queue_events(queue))
+    # every worker keeps its own users; the shared photo cache is saved by the first one
+    snapshot = Snapshot(f'{SNAPSHOT_PATH}.{number}' if SNAPSHOT_PATH else '', photos=number == 0)
+    snapshot.restore(bot)
+    try:
+        serve(bot)
+    finally:
+        snapshot.save(bot)
+
+
+class Supervisor:
+
+    """Runs N worker processes and routes incoming LongPoll events to them"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.ring = HashRing(workers)
+        self.queues = [multiprocessing.Queue() for _ in range(workers)]
+        self.processes = [None] * workers
+        self.longpoll = None
+        self.snapshot = Snapshot(SNAPSHOT_PATH)
+
+        # the photo cache is shared between the workers through a manager process
+        self.manager = multiprocessing.Manager()
+        VKDatingUser.photo_cache.storage = self.manager.dict()
+
+    def _start_worker(self, number: int) -> None:
+        process = multiprocessing.Process(target=run_worker, args=(number, self.workers, self.queues[number]),
+                                          name=f'vkinder-worker-{number}', daemon=True)
+        process.start()
+        self.processes[number] = process
+
+    def dispatch(self, event) -> None:
+
+        """Sending the event to the worker responsible for its user"""
+
+        user_id = getattr(event, 'user_id', None)
+        if user_id is None:
+            return
+        number = self.ring.get_node(user_id)
+        if not self.processes[number].is_alive():
+            logger.warning('Worker %s exited with code %s, restarting', number, self.processes[number].exitcode)
+            self._start_worker(number)
+        self.queues[number].put(event.raw)
+
+    def run(self) -> None:
+        # authorized, with the rate limits of all tokens, and built once here and shared by the forked workers
+        VKAuth.authorize()
+        prepare_city_search()
+        state = self.snapshot.load()
+        for number in range(self.workers):
+            self._start_worker(number)
+
+        # the finally below saves the state on SIGTERM as well
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self.longpoll = VkLongPoll(LimitedVkApi(token=os.getenv("VKINDER_TOKEN"), bucket='group'))
+            if state and Snapshot.fresh_events(state):
+                for raw in state.get('events', ()):
+                    self.dispatch(Event(raw))
+                if state.get('longpoll_ts'):
+                    self.longpoll.ts = state['longpoll_ts']
+            for event in self.longpoll.listen():
+                self.dispatch(event)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=max(0.0, deadline - time.monotonic()))
+
+        # the events of the workers which have not finished in time
+        events = []
+        for queue in self.queues:
+            events.extend(raw for raw in self._drain(queue) if raw is not None)
+        if self.snapshot.path:
+            self.snapshot.write(new_state(events=events, longpoll_ts=getattr(self.longpoll, 'ts', None)))
+
+        for number, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                logger.warning('Worker %s has not finished in %s s, killing it', number, STOP_TIMEOUT)
+                process.kill()
+                process.join()
+        # the first worker has saved the shared photo cache by now
+        self.manager.shutdown()
+
+    @staticmethod
+    def _drain(queue):
+        while True:
+            try:
+                yield queue.get(timeout=0.1)
+            except queues.Empty:
+                return
+
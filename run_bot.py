@@ -1,10 +1,22 @@
+import argparse
+import logging
 from datetime import datetime
 
 from main_bot.vk_bot import main
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='VKinder bot')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes; users are sharded between them by user id')
+    parser.add_argument('--record', metavar='TRACE',
+                        help='write anonymized events and VK API calls to a trace for main_bot.replay')
+    args = parser.parse_args()
+    if args.record and args.workers > 1:
+        parser.error('--record works with one worker only')
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(name)s: %(message)s')
     print(datetime.now())
-    main()
+    main(workers=args.workers, record=args.record)
 
 
-#1 - как сделать, чтобы при добавлении человека в список понравился / не понравился  не падала программа
\ No newline at end of file
+#1 - как сделать, чтобы при добавлении человека в список понравился / не понравился  не падала программа
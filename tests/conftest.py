@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+# no PostgreSQL and no VK account are needed by the tests
+os.environ.setdefault('VKINDER_DB_URL', 'memory')
+os.environ.setdefault('VK_USER_TOKEN', 'test')
+
+from db import database  # noqa: E402
+from db.database import Connect  # noqa: E402
+
+# the reference tables of the in-memory database are filled from a small copy of db/fix/primary_data.json
+database.PRIMARY_DATA = os.path.join(os.path.dirname(__file__), 'fixtures', 'reference.json')
+
+
+@pytest.fixture
+def db():
+
+    """ A new in-memory database with the reference data """
+
+    from db.reference import reference
+
+    Connect.reconnect('memory')
+    reference.invalidate()
+    yield Connect()
+    Connect.session.close()
+    Connect.engine.dispose()
+
+
+class FakeVk:
+
+    """The VK session of the community: the messages are recorded instead of being sent"""
+
+    def __init__(self):
+        self.sent = []
+
+    def method(self, method, values=None, **kwargs):
+        self.sent.append((method, values))
+        return 1
+
+
+class FakeTokenPool:
+
+    """users.search of the user tokens answered from a list, or failing like an open circuit breaker"""
+
+    def __init__(self):
+        self.items = []
+        self.error = None
+
+    def method(self, method, values=None):
+        if self.error is not None:
+            raise self.error
+        return {'count': len(self.items), 'items': self.items}
+
+
+@pytest.fixture
+def bot(db, monkeypatch):
+
+    """ The bot without VK: no LongPoll, no profile and photo requests """
+
+    from main_bot.main_menu import VKDatingUser
+    from main_bot.vk_bot import Bot
+
+    monkeypatch.setattr(Bot, 'token_pool', FakeTokenPool())
+    monkeypatch.setattr(VKDatingUser, 'get_photo', lambda self: [])
+    monkeypatch.setattr(VKDatingUser, 'get_photos_batch', staticmethod(lambda users: None))
+    bot = Bot.__new__(Bot)
+    bot.vk_bot = FakeVk()
+    bot.users = {}
+    bot.empty_keyboard = '{}'
+    return bot
+
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+from db.archive import archive_history
+from db.database import Candidate, Decision, DecisionArchive, Query, QueryArchive, SearchState, User
+
+NOW = datetime.utcnow()
+
+
+def query(db, user_id, days_ago):
+    return db.insert_to_db(Query, {'user_id': user_id, 'datetime': NOW - timedelta(days=days_ago), 'sex_id': 1,
+                                   'city_id': 1, 'age_from': 20, 'age_to': 30, 'status_id': 6, 'sort_id': 0}).id
+
+
+def decision(db, query_id, vk_id, viewed=False, black_list=None):
+    db.upsert(Candidate, [{'vk_id': vk_id, 'first_name': 'Имя', 'last_name': 'Фамилия', 'city_id': 1,
+                           'city_title': 'Москва', 'link': f'https://vk.com/id{vk_id}', 'verified': 0}])
+    return db.insert_to_db(Decision, {'user_id': 1, 'vk_id': vk_id, 'query_id': query_id, 'viewed': viewed,
+                                      'black_list': black_list}).id
+
+
+def ids(db, column, *expression):
+    return sorted(row[0] for row in db.select_from_db(column, expression or (column.isnot(None),)))
+
+
+def test_old_queries_are_archived(db):
+    db.insert_to_db(User, {'id': 1, 'first_name': 'Анна'})
+    old, latest = query(db, 1, 400), query(db, 1, 1)
+    pending = decision(db, old, 101)
+    liked = decision(db, old, 102, viewed=True, black_list=False)
+
+    assert archive_history(retention_days=180) == 1
+    assert ids(db, Query.id) == [latest]
+    assert ids(db, QueryArchive.id) == [old]
+    assert ids(db, DecisionArchive.id) == [pending]
+    # the liked person is never shown again, but the query is gone
+    assert db.select_from_db((Decision.id, Decision.query_id), Decision.id > 0).all() == [(liked, None)]
+
+
+def test_latest_and_repeated_queries_are_kept(db):
+    db.insert_to_db(User, {'id': 1, 'first_name': 'Анна'})
+    repeated, latest = query(db, 1, 400), query(db, 1, 300)
+    db.insert_to_db(SearchState, {'user_id': 1, 'criteria': 'x', 'query_id': repeated, 'last_run': NOW})
+
+    assert archive_history(retention_days=180) == 0
+    assert ids(db, Query.id) == [repeated, latest]
+
+
+def test_unused_search_states_are_deleted(db):
+    db.insert_to_db(User, {'id': 1, 'first_name': 'Анна'})
+    latest = query(db, 1, 1)
+    db.insert_to_db(SearchState, {'user_id': 1, 'criteria': 'x', 'query_id': latest,
+                                  'last_run': NOW - timedelta(days=200)})
+    archive_history(retention_days=180)
+    assert ids(db, SearchState.id) == []
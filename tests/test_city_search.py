@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+
+import pytest
+
+from db.city_search import TrigramFile, TrigramIndex, trigrams
+from db.geo_index import GeoCity
+
+CITIES = [
+    GeoCity(1, 'Москва', None, None, None, 1, 1),
+    GeoCity(2, 'Санкт-Петербург', None, None, None, 1, 1),
+    GeoCity(3, 'Ростов-на-Дону', None, None, None, 1, 1),
+    GeoCity(4, 'Ростов', None, 'Ярославская область', None, 1, None),
+]
+
+
+def titles(cities):
+    return [city.title for city in cities]
+
+
+def test_trigrams_are_padded_like_pg_trgm():
+    assert trigrams('Ус') == {'  у', ' ус', 'ус '}
+
+
+def test_typo_and_latin_letters():
+    index = TrigramIndex(CITIES)
+    assert titles(index.search('Масква'))[0] == 'Москва'
+    # Latin "o", "c" and "a" in a Cyrillic title
+    assert titles(index.search('Mocквa'))[0] == 'Москва'
+    assert titles(index.search('санкт петербург'))[0] == 'Санкт-Петербург'
+
+
+def test_important_city_first_among_equally_similar():
+    index = TrigramIndex([CITIES[3], GeoCity(5, 'Ростов', None, None, None, 1, 1)])
+    assert [city.id for city in index.search('Ростов')] == [5, 4]
+
+
+def test_nothing_similar():
+    index = TrigramIndex(CITIES)
+    assert index.search('Владивосток') == []
+    assert index.search('!!') == []
+
+
+def test_file_gives_the_same_answers(tmp_path):
+    path = str(tmp_path / 'trigrams.idx')
+    TrigramIndex(CITIES).save(path, geo_size=1234)
+    geo = SimpleNamespace(cities_count=len(CITIES), buffer=SimpleNamespace(size=lambda: 1234),
+                          city_at=lambda number: CITIES[number])
+    index = TrigramFile(path, geo)
+    for text in ('Масква', 'Ростов', 'петербург'):
+        assert index.search(text) == TrigramIndex(CITIES).search(text)
+
+
+def test_file_of_another_geo_index_is_refused(tmp_path):
+    path = str(tmp_path / 'trigrams.idx')
+    TrigramIndex(CITIES).save(path, geo_size=1234)
+    geo = SimpleNamespace(cities_count=len(CITIES), buffer=SimpleNamespace(size=lambda: 1), city_at=None)
+    with pytest.raises(ValueError):
+        TrigramFile(path, geo)
+
+
+def test_index_built_from_the_db(db, monkeypatch):
+    from db import city_search
+    from db.database import City
+
+    db.upsert(City, [{'id': 1, 'title': 'Москва', 'area': None, 'region': None, 'region_id': None, 'important': 1}])
+    monkeypatch.setattr(city_search, 'geo_index', lambda: None)
+    assert list(city_search._all_cities()) == [GeoCity(1, 'Москва', None, None, None, None, 1)]
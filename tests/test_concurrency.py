@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+from main_bot import concurrency
+from main_bot.concurrency import AdaptiveLimit
+
+
+@pytest.fixture(autouse=True)
+def adjust_every_time(monkeypatch):
+    monkeypatch.setattr(concurrency, 'ADJUST_INTERVAL', 0)
+
+
+def test_congestion_decreases_the_limit():
+    limit = AdaptiveLimit('vk', initial=10, maximum=16, target_p99=1)
+    limit.congestion()
+    assert int(limit.limit) == 7
+
+
+def test_slow_calls_decrease_the_limit():
+    limit = AdaptiveLimit('db', initial=4, maximum=8, target_p99=0.5)
+    limit.acquire()
+    limit.release(2.0)
+    assert int(limit.limit) == 2
+    assert not limit.latencies
+
+
+def test_demand_increases_the_limit_up_to_the_maximum():
+    limit = AdaptiveLimit('vk', initial=2, maximum=3, target_p99=1, demand=lambda: 5)
+    for _ in range(3):
+        with limit.slot():
+            pass
+    assert int(limit.limit) == 3
+
+
+def test_no_demand_keeps_the_limit():
+    limit = AdaptiveLimit('vk', initial=2, maximum=8, target_p99=1)
+    with limit.slot():
+        pass
+    assert int(limit.limit) == 2
+    assert limit.stats()['in_flight'] == 0
+
+
+def test_never_below_the_minimum():
+    limit = AdaptiveLimit('vk', initial=1, maximum=4, target_p99=1)
+    limit.congestion()
+    assert limit.limit == 1
+
+
+def test_limits_are_logged_periodically(monkeypatch, caplog):
+    monkeypatch.setattr(concurrency, 'REPORT_INTERVAL', 0.01)
+    caplog.set_level('INFO', logger=concurrency.__name__)
+    concurrency.Limits().start_report()
+    for _ in range(100):
+        if 'Concurrency limits' in caplog.text:
+            break
+        time.sleep(0.01)
+    assert "'backlog': 0" in caplog.text
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from db.database import City, Connect, Sex, Sort, Status, insert_statement, make_engine
+from db.reference import ReferenceDataMissing, reference
+
+
+def city(city_id, title, **fields):
+    return {'id': city_id, 'title': title, 'area': None, 'region': None, 'region_id': None, 'important': None,
+            **fields}
+
+
+def test_memory_database_has_the_reference_data(db):
+    assert reference.titles(Sex) == ('любой', 'женский', 'мужской')
+    assert len(reference.titles(Status)) == 8
+    assert reference.titles(Sort)[1] == 'По дате регистрации'
+
+
+def test_empty_reference_table_is_reported(db):
+    db.session.query(Sort).delete()
+    db.session.commit()
+    reference.invalidate()
+    with pytest.raises(ReferenceDataMissing, match='"sort"'):
+        reference.titles(Sort)
+
+
+def test_upsert_inserts_and_updates(db):
+    db.upsert(City, [city(1, 'Москва', important=1)])
+    db.upsert(City, [city(1, 'Москва (столица)', important=1), city(2, 'Тверь')])
+    assert db.select_from_db((City.id, City.title), City.id > 0).order_by(City.id).all() == \
+        [(1, 'Москва (столица)'), (2, 'Тверь')]
+
+
+def test_upsert_needs_a_known_dialect():
+    with pytest.raises(NotImplementedError):
+        insert_statement(City.__table__, 'mysql')
+
+
+def test_threads_write_at_the_same_time(db):
+    errors = []
+
+    def write(start):
+        session = Connect.Session()
+        try:
+            for city_id in range(start, start + 20):
+                db.upsert(City, [city(city_id, f'Город {city_id}')], session=session)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=write, args=(number * 100,)) for number in range(1, 7)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert db.select_from_db(City.id, City.id > 0).count() == 120
+
+
+def test_reader_waits_for_the_writer_of_another_thread(db):
+    writing = threading.Event()
+
+    def write():
+        session = Connect.Session()
+        try:
+            session.execute(City.__table__.insert().values(**city(1, 'Москва')))
+            writing.set()
+            time.sleep(0.2)
+            session.commit()
+        finally:
+            session.close()
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    writing.wait()
+    reader = Connect.Session()
+    try:
+        assert reader.query(City).count() == 1
+    finally:
+        reader.close()
+        thread.join()
+
+
+def test_sqlite_file_is_in_wal_mode(tmp_path):
+    engine = make_engine(f'sqlite:///{tmp_path / "vkinder.db"}')
+    try:
+        with engine.connect() as connection:
+            assert connection.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+            assert connection.exec_driver_sql('PRAGMA foreign_keys').scalar() == 1
+    finally:
+        engine.dispose()
@@ -0,0 +1,32 @@
+import pytest
+
+from db.database import City, Connect, Region
+from main_bot.geo_cache import GeoCache
+
+
+def test_batch_of_cities_with_and_without_region(db):
+    cache = GeoCache()
+    cache.write_through({'id': 1, 'title': 'Тверь', 'region': 'Тверская область', 'region_id': 5},
+                        {'id': 5, 'title': 'Тверская область', 'country_id': 1})
+    cache.write_through({'id': 2, 'title': 'Москва'})
+    cache.flush()
+    assert db.select_from_db((City.id, City.region_id), City.id > 0).order_by(City.id).all() == [(1, 5), (2, None)]
+    assert db.select_from_db(Region.id, Region.id > 0).all() == [(5,)]
+    assert cache.city_known(2)
+
+
+def test_failed_batch_stays_pending(db, monkeypatch):
+    cache = GeoCache()
+    cache.write_through({'id': 1, 'title': 'Тверь'})
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('the database is unavailable')
+
+    monkeypatch.setattr(Connect, 'upsert', fail)
+    with pytest.raises(RuntimeError):
+        cache.flush()
+    assert list(cache.pending_cities) == [1]
+
+    monkeypatch.undo()
+    cache.flush()
+    assert db.select_from_db(City.id, City.id > 0).all() == [(1,)]
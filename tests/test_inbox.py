@@ -0,0 +1,79 @@
+import queue
+import threading
+import time
+
+import pytest
+from vk_api.longpoll import Event
+
+from main_bot.inbox import AnswerTimeout, Inbox, InboxClosed
+
+
+def message(user_id, text):
+    return Event([4, 1, 1, user_id, int(time.time()), text, {}, {}])
+
+
+def filled(*events, **options):
+    inbox = Inbox(iter(events), **options)
+    inbox.start()
+    inbox.thread.join()
+    return inbox
+
+
+def test_users_take_turns():
+    inbox = filled(message(1, 'a'), message(1, 'b'), message(2, 'c'))
+    assert [inbox.get().text for _ in range(3)] == ['a', 'c', 'b']
+
+
+def test_dialogue_takes_only_its_user():
+    inbox = filled(message(1, 'a'), message(2, 'b'), message(1, 'c'))
+    assert [inbox.get(1).text, inbox.get(1).text] == ['a', 'c']
+    assert inbox.get().text == 'b'
+
+
+def test_repeated_and_superseded_messages_are_dropped():
+    inbox = filled(message(1, 'a'), message(1, 'a'), message(1, 'b'), message(1, 'c'), per_user=2)
+    assert [inbox.get().text, inbox.get().text] == ['b', 'c']
+    assert inbox.dropped == {'repeated': 1, 'superseded': 1}
+
+
+def test_end_of_events():
+    inbox = filled(message(1, 'a'))
+    inbox.get()
+    with pytest.raises(InboxClosed):
+        inbox.get()
+    with pytest.raises(InboxClosed):
+        inbox.get(1)
+
+
+def test_error_of_events_is_raised():
+    def events():
+        yield message(1, 'a')
+        raise ConnectionError('longpoll')
+
+    inbox = Inbox(events())
+    inbox.start()
+    inbox.thread.join()
+    assert inbox.get().text == 'a'
+    with pytest.raises(ConnectionError):
+        inbox.get()
+
+
+def test_answer_timeout_only_when_others_wait():
+    events = queue.Queue()
+    inbox = Inbox(iter(events.get, None))
+    inbox.start()
+    started = time.monotonic()
+    threading.Timer(0.05, events.put, [message(1, 'late')]).start()
+    # nobody else is waiting: the dialogue keeps waiting after the timeout
+    assert inbox.get(1, timeout=0.01).text == 'late'
+    assert time.monotonic() - started >= 0.05
+
+    events.put(message(2, 'b'))
+    with pytest.raises(AnswerTimeout) as error:
+        inbox.get(1, timeout=0.01)
+    assert error.value.user_id == 1
+    assert inbox.get().text == 'b'
+
+    events.put(None)
+    with pytest.raises(InboxClosed):
+        inbox.get(1, timeout=0.01)
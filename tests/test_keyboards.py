@@ -0,0 +1,48 @@
+import json
+
+from vk_api.keyboard import VkKeyboard, VkKeyboardColor
+
+from main_bot.keyboards import KeyboardCache, scan_request
+
+
+def yes_no_cache():
+    cache = KeyboardCache()
+
+    @cache.register('yes_no')
+    def yes_no():
+        keyboard = VkKeyboard(one_time=False)
+        cache.add_button(keyboard, 'Да', VkKeyboardColor.POSITIVE, 'yes')
+        cache.add_button(keyboard, 'Нет', VkKeyboardColor.NEGATIVE, 'no')
+        cache.add_button(keyboard, 'Женский', VkKeyboardColor.PRIMARY, 'sex', id=1)
+        return keyboard
+
+    return cache
+
+
+def test_scan_request():
+    assert scan_request('  Санкт-Петербург!! ') == 'санкт петербург'
+    assert scan_request('Да &#128150;') == 'да 128150'
+    assert scan_request('...') == '...'
+
+
+def test_typed_label_gives_the_command():
+    cache = yes_no_cache()
+    assert cache.command('да') == {'command': 'yes'}
+    assert cache.command(' НЕТ! ') == {'command': 'no'}
+    assert cache.command('Женский') == {'command': 'sex', 'id': 1}
+    assert cache.command('может быть') is None
+
+
+def test_buttons_carry_the_payload():
+    cache = yes_no_cache()
+    buttons = json.loads(cache.get('yes_no'))['buttons'][0]
+    assert [json.loads(button['action']['payload']) for button in buttons] == \
+        [{'command': 'yes'}, {'command': 'no'}, {'command': 'sex', 'id': 1}]
+
+
+def test_cleared_cache_is_built_again():
+    cache = yes_no_cache()
+    keyboard = cache.get('yes_no')
+    cache.clear()
+    assert cache.command('да') == {'command': 'yes'}
+    assert cache.get('yes_no') == keyboard
@@ -0,0 +1,38 @@
+import pytest
+
+from main_bot.rate_limit import RateLimiter, TokenBucket
+
+
+def test_bucket_allows_a_burst_then_paces():
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.02)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.02)
+
+
+def test_drained_bucket_waits_a_full_capacity():
+    bucket = TokenBucket(rate=10, capacity=5)
+    bucket.drain()
+    assert bucket.reserve() == pytest.approx(0.6, abs=0.02)
+
+
+def test_every_token_has_its_method_buckets():
+    limiter = RateLimiter({'user': 3}, {'users.search': 2})
+    limiter.add_token('user:1', 3)
+    assert set(limiter.tokens) == {'user', 'user:1'}
+    assert set(limiter.methods) == {('user', 'users.search'), ('user:1', 'users.search')}
+    assert limiter.methods['user', 'users.search'] is not limiter.methods['user:1', 'users.search']
+
+
+def test_method_budget_of_a_token_does_not_slow_another_one():
+    limiter = RateLimiter({'user': 100, 'user:1': 100}, {'users.search': 1})
+    limiter.acquire('user', 'users.search')
+    assert limiter.methods['user', 'users.search'].reserve() > 0
+    assert limiter.methods['user:1', 'users.search'].reserve() == 0
+
+
+def test_penalized_token_waits():
+    limiter = RateLimiter({'user': 10})
+    limiter.penalize('user')
+    assert limiter.tokens['user'].reserve() > 0
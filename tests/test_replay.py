@@ -0,0 +1,15 @@
+import json
+import time
+
+from main_bot.replay import replay
+
+
+def test_missing_call_is_reported(db, tmp_path):
+    trace = tmp_path / 'trace.jsonl'
+    event = [4, 1, 1, 5, int(time.time()), 'Привет', {}, {}]
+    trace.write_text(json.dumps({'kind': 'event', 'raw': event, 't': 0}) + '\n', encoding='utf-8')
+
+    # the profile of the user is not in the trace: the bot skips the message like a failed VK call
+    player = replay(str(trace), speed=100)
+    assert player.misses == {'users.get': 1}
+    assert "Calls missing from the trace: {'users.get': 1}" in player.report()
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from db.database import City, Query, SearchState, User
+from main_bot.breaker import CircuitOpen
+from main_bot.scheduler import SavedUser, Scheduler
+
+VALUES = {'city': 1, 'sex': 1, 'age_from': 20, 'age_to': 30, 'status': 6, 'sort': 0}
+NOW = datetime.utcnow()
+
+
+def person(vk_id):
+    return {'id': vk_id, 'first_name': f'Имя{vk_id}', 'last_name': f'Фамилия{vk_id}', 'domain': f'id{vk_id}',
+            'is_closed': 0}
+
+
+def searched(bot, db, user_id, last_seen):
+    db.insert_to_db(User, {'id': user_id, 'first_name': 'Анна', 'city_id': 1, 'last_seen': last_seen})
+    bot.token_pool.items = [person(user_id * 100)]
+    query_id, new_users = bot._collect_candidates(SavedUser(user_id), VALUES)
+    bot.store_candidates(user_id, query_id, new_users)
+    db.update_data(SearchState.id, SearchState.user_id == user_id, {SearchState.last_run: NOW - timedelta(days=2)})
+
+
+def scheduler(bot, db):
+    db.upsert(City, [{'id': 1, 'title': 'Москва', 'area': None, 'region': None, 'region_id': None,
+                      'important': 1}])
+    searched(bot, db, 1, NOW)
+    searched(bot, db, 2, NOW - timedelta(days=60))
+    return Scheduler(bot)
+
+
+def notified(bot):
+    return [values['peer_ids'] for method, values in bot.vk_bot.sent if method == 'messages.send']
+
+
+def test_only_active_users_are_searched_again(bot, db):
+    assert [user_id for user_id, _ in scheduler(bot, db).due_searches(datetime.utcnow())] == [1]
+
+
+def test_new_people_are_notified_once(bot, db):
+    jobs = scheduler(bot, db)
+    bot.token_pool.items = [person(100), person(150)]
+    assert jobs.run_once() == 1
+    assert notified(bot) == ['1']
+    # the repeated search goes to the same query
+    assert db.select_from_db(Query.id, Query.user_id == 1).count() == 1
+
+
+def test_failed_search_notifies_nobody(bot, db):
+    jobs = scheduler(bot, db)
+    bot.token_pool.error = CircuitOpen('users.search', 30)
+    assert jobs.run_once() == 0
+    assert notified(bot) == []
@@ -0,0 +1,23 @@
+from itertools import islice
+
+from db.database import City, User
+from main_bot.scheduler import SavedUser
+
+VALUES = {'city': 1, 'sex': 1, 'age_from': 20, 'age_to': 30, 'status': 6, 'sort': 0}
+
+
+def person(vk_id):
+    return {'id': vk_id, 'first_name': f'Имя{vk_id}', 'last_name': f'Фамилия{vk_id}', 'domain': f'id{vk_id}',
+            'is_closed': 0}
+
+
+def test_every_candidate_is_delivered_once(bot, db):
+    db.upsert(City, [{'id': 1, 'title': 'Москва', 'area': None, 'region': None, 'region_id': None,
+                      'important': 1}])
+    db.insert_to_db(User, {'id': 1, 'first_name': 'Анна', 'city_id': 1})
+    bot.token_pool.items = [person(vk_id) for vk_id in range(101, 106)]
+
+    stream = bot.search_stream(SavedUser(1), VALUES)
+    assert stream.found == 5
+    # a carousel takes up to 10 of them at once
+    assert [d_user.id for d_user in islice(stream, 10)] == [101, 102, 103, 104, 105]
@@ -0,0 +1,52 @@
+from types import SimpleNamespace
+
+from db.slow_queries import SqlProfile
+
+
+class FakeCursor:
+
+    def __init__(self, executed, failing):
+        self.executed = executed
+        self.failing = failing
+
+    def execute(self, statement, parameters=None):
+        self.executed.append(statement)
+        if statement.startswith(self.failing):
+            raise RuntimeError('syntax error')
+
+    def fetchall(self):
+        return [('Seq Scan on city',)]
+
+    def close(self):
+        pass
+
+
+def connection(dialect, failing='-'):
+    executed = []
+    dbapi = SimpleNamespace(cursor=lambda: FakeCursor(executed, failing))
+    return SimpleNamespace(dialect=SimpleNamespace(name=dialect), connection=dbapi), executed
+
+
+def test_select_is_analyzed_in_a_savepoint():
+    conn, executed = connection('postgresql')
+    assert SqlProfile.explain(conn, 'SELECT 1', ()) == 'Seq Scan on city'
+    assert executed == ['SAVEPOINT vkinder_explain', 'EXPLAIN (ANALYZE, BUFFERS) SELECT 1',
+                        'RELEASE SAVEPOINT vkinder_explain']
+
+
+def test_change_is_not_run_again():
+    conn, executed = connection('postgresql')
+    SqlProfile.explain(conn, 'UPDATE city SET important = 1', ())
+    assert executed[1] == 'EXPLAIN UPDATE city SET important = 1'
+
+
+def test_failed_explain_keeps_the_transaction():
+    conn, executed = connection('postgresql', failing='EXPLAIN')
+    assert SqlProfile.explain(conn, 'SELECT 1', ()) is None
+    assert executed[-2:] == ['ROLLBACK TO SAVEPOINT vkinder_explain', 'RELEASE SAVEPOINT vkinder_explain']
+
+
+def test_sqlite_plan():
+    conn, executed = connection('sqlite')
+    SqlProfile.explain(conn, 'SELECT 1', ())
+    assert executed == ['EXPLAIN QUERY PLAN SELECT 1']
@@ -0,0 +1,87 @@
+import gzip
+import os
+import pickle
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from main_bot.main_menu import VKUser
+from main_bot.snapshot import Snapshot
+
+PROFILE = {'user_id': 5, 'first_name': 'Анна', 'last_name': 'Иванова', 'sex': 1, 'link': 'https://vk.com/id5',
+           'city': {'id': 1, 'title': 'Москва'}, 'country': {'id': 1, 'title': 'Россия'}}
+
+
+class FakeBot:
+
+    def __init__(self):
+        self.users = {}
+        self.geo_cache = SimpleNamespace(memory={})
+        self.inbox = None
+        self.dialogue_user = None
+        self.events = iter(())
+        self.longpoll_ts = None
+        self.empty_keyboard = '{}'
+        self.sent = []
+
+    def write_msg(self, user_id, message, attachment=None, keyboard=None):
+        self.sent.append((user_id, message))
+
+
+def raw_message(user_id, text):
+    return [4, 1, 1, user_id, int(time.time()), text, {}, {}]
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    return Snapshot(str(tmp_path / 'vkinder.snapshot'), photos=False)
+
+
+def test_round_trip(snapshot):
+    bot = FakeBot()
+    bot.users[5] = VKUser.restore(PROFILE)
+    expires = datetime.utcnow() + timedelta(hours=1)
+    bot.geo_cache.memory['database.getCities:q=Москва'] = (expires, {'items': []})
+    state = snapshot.collect(bot)
+    state['events'] = [raw_message(6, 'Привет')]
+    state['longpoll_ts'] = 42
+    snapshot.write(state)
+
+    restored = FakeBot()
+    assert snapshot.restore(restored)
+    assert restored.users[5].snapshot() == PROFILE
+    assert restored.geo_cache.memory == bot.geo_cache.memory
+    assert [event.text for event in restored.events] == ['Привет']
+    assert restored.longpoll_ts == 42
+    assert restored.sent == []
+    # a snapshot is applied once
+    assert not os.path.exists(snapshot.path)
+    assert not snapshot.restore(FakeBot())
+
+
+def test_interrupted_dialogue_starts_again(snapshot):
+    bot = FakeBot()
+    bot.users[5] = VKUser.restore(PROFILE)
+    bot.dialogue_user = 5
+    state = snapshot.collect(bot)
+    state['events'] = [raw_message(5, 'Да'), raw_message(6, 'Привет')]
+    snapshot.write(state)
+
+    restored = FakeBot()
+    snapshot.restore(restored)
+    assert [event.user_id for event in restored.events] == [6]
+    assert [user_id for user_id, _ in restored.sent] == [5]
+
+
+def test_only_plain_data_is_unpickled(snapshot):
+    with gzip.open(snapshot.path, 'wb') as f:
+        pickle.dump({'version': 1, 'saved': time.time(), 'users': [], 'hook': os.system}, f)
+    assert snapshot.load() is None
+    assert not os.path.exists(snapshot.path)
+
+
+def test_old_snapshot_is_ignored(snapshot):
+    snapshot.write({'version': 1, 'saved': 0, 'users': [PROFILE]})
+    assert not snapshot.restore(FakeBot())
@@ -0,0 +1,60 @@
+from db.database import Candidate, City, Decision, User
+from main_bot.breaker import CircuitOpen
+from main_bot.scheduler import SavedUser
+
+VALUES = {'city': 1, 'sex': 1, 'age_from': 20, 'age_to': 30, 'status': 6, 'sort': 0}
+
+
+def person(vk_id):
+    return {'id': vk_id, 'first_name': f'Имя{vk_id}', 'last_name': f'Фамилия{vk_id}', 'domain': f'id{vk_id}',
+            'is_closed': 0}
+
+
+def user(db, user_id=1):
+    db.upsert(City, [{'id': 1, 'title': 'Москва', 'area': None, 'region': None, 'region_id': None,
+                      'important': 1}])
+    db.insert_to_db(User, {'id': user_id, 'first_name': 'Анна', 'city_id': 1})
+
+
+def test_pages_of_liked_people(bot, db):
+    user(db)
+    db.upsert(Candidate, [{'vk_id': vk_id, 'first_name': 'Имя', 'last_name': 'Фамилия', 'city_id': 1,
+                           'city_title': 'Москва', 'link': f'https://vk.com/id{vk_id}', 'verified': 0}
+                          for vk_id in range(100, 145)])
+    for vk_id in range(100, 145):
+        db.insert_to_db(Decision, {'user_id': 1, 'vk_id': vk_id, 'viewed': True, 'black_list': vk_id % 2 == 1})
+
+    pages, cursor = [], 0
+    while cursor is not None:
+        page, cursor = bot.get_datingusers_page(1, blacklist=False, after_id=cursor, page_size=10)
+        pages.append([d_user.id for d_user in page])
+    assert [len(page) for page in pages] == [10, 10, 3]
+    assert sum(pages, []) == list(range(100, 145, 2))
+
+
+def test_search_stores_only_new_people(bot, db):
+    user(db)
+    bot.token_pool.items = [person(101), person(102), dict(person(103), is_closed=1)]
+    query_id, new_users = bot._collect_candidates(SavedUser(1), VALUES)
+    bot.store_candidates(1, query_id, new_users)
+    assert [row['vk_id'] for row in new_users] == [101, 102]
+
+    bot.token_pool.items = [person(102), person(104)]
+    _, new_users = bot._collect_candidates(SavedUser(1), VALUES)
+    assert [row['vk_id'] for row in new_users] == [104]
+
+
+def test_failed_search_falls_back_to_the_stored_candidates(bot, db):
+    user(db)
+    bot.token_pool.items = [person(101)]
+    query_id, _ = bot._collect_candidates(SavedUser(1), VALUES)
+    bot.token_pool.error = CircuitOpen('users.search', 30)
+    assert bot._collect_candidates(SavedUser(1), VALUES) == (query_id, [])
+
+
+def test_city_found_in_the_db_whatever_the_case(bot, db):
+    user(db)
+    db.upsert(City, [{'id': 2, 'title': 'Мосальск', 'area': None, 'region': 'Калужская область', 'region_id': None,
+                      'important': 0}])
+    assert [city.title for city in bot._find_cities('мос')] == ['Москва', 'Мосальск']
+    assert [city.id for city in bot._find_cities('МОСК')] == [1]